@@ -4,13 +4,29 @@ Sistema completo de anotación de documentos
 Qubiz.Team - 2024
 """
 
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, send_from_directory, url_for, Response, stream_with_context
 from werkzeug.utils import secure_filename
 import os
+import time
 import uuid
+import tempfile
+import threading
 from datetime import datetime
 from io import BytesIO
-import base64
+import export
+import jobs
+import llm
+import metrics
+import ocr
+import pagecache
+import profiling
+import retrieval
+import search
+import spatial
+import storage
+import strokes
+import thumbnails
+import variants
 
 # Inicializar Flask
 app = Flask(__name__)
@@ -21,8 +37,43 @@ app.config['SECRET_KEY'] = 'tu-clave-secreta-aqui'  # Cambiar en producción
 # Crear carpeta de uploads si no existe
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# Almacenamiento en memoria (usar base de datos en producción)
-documents = {}
+# Almacenamiento de documentos (SQLite compartido entre workers; DOCUMENT_STORE=memory para desarrollo)
+store = storage.open_store(upload_folder=app.config['UPLOAD_FOLDER'])
+
+# Cola de procesamiento en segundo plano (rasterizado + OCR)
+processing_queue = jobs.ProcessingQueue()
+
+# Índice de búsqueda de texto completo (en la misma base de datos); los documentos
+# anteriores al índice se indexan en segundo plano al arrancar
+search_index = search.open_index(store)
+threading.Thread(target=search.backfill, args=(search_index, store), daemon=True).start()
+
+# Fragmentos por página para el contexto del chatbot
+chat_index = retrieval.open_index(store)
+
+# Páginas anotadas ya pintadas: al reexportar solo se pintan las páginas que han cambiado
+page_cache = pagecache.PageCache(os.path.join(app.config['UPLOAD_FOLDER'], 'render_cache'))
+
+# Miniaturas de la primera página para la lista (en segundo plano, con sus anotaciones)
+thumbs = thumbnails.Thumbnails(store, os.path.join(app.config['UPLOAD_FOLDER'], 'thumbnails'))
+
+# Rejilla por página de las anotaciones: consultas por zona sin recorrer todo el documento
+annotation_index = spatial.AnnotationIndexes(store)
+
+# AQUÍ: Integra tu IA favorita (Claude, GPT, etc.): cualquier objeto con
+# generate_content(prompt).text. Por ahora, el modelo local de pruebas.
+# Las llamadas van en cola, con límite de peticiones y caché de respuestas
+chat_client = llm.LLMClient(llm.backend_from_env(retrieval.StubModel()))
+
+# Métricas de Prometheus en /metrics (METRICS_ENABLED=0 las apaga)
+metrics.init_app(app)
+metrics.watch_cache('render', page_cache.stats)
+metrics.watch_cache('thumbnails', thumbs.cache.stats)
+metrics.watch_llm(chat_client)
+metrics.watch_queue('processing', lambda: processing_queue.pending)
+
+# Perfilado bajo demanda (cabecera X-Profile o muestreo desde /admin/profiling; requiere PROFILE_TOKEN)
+profiling.init_app(app, os.path.join(app.config['UPLOAD_FOLDER'], 'profiles'))
 
 # Extensiones permitidas
 ALLOWED_EXTENSIONS = {'pdf', 'docx', 'txt', 'png', 'jpg', 'jpeg', 'gif'}
@@ -30,6 +81,66 @@ ALLOWED_EXTENSIONS = {'pdf', 'docx', 'txt', 'png', 'jpg', 'jpeg', 'gif'}
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_page_image(artifact_id, page_num, img):
+    """Guardar una página renderizada como PNG en disco (con sus variantes) y devolver su metadata"""
+    path = os.path.join(app.config['UPLOAD_FOLDER'], f"{artifact_id}_page_{page_num}.png")
+    with metrics.stage('page_encode'):
+        img.save(path, format="PNG", optimize=True)
+    return {'path': path, 'width': img.width, 'height': img.height, **variants.generate(img, path)}
+
+def publish_page(artifact_id, page_num, page):
+    """Hacer visible una página en cuanto está renderizada (para todos los documentos con ese contenido)"""
+    store.add_artifact_page(artifact_id, page_num, page)
+    metrics.PAGES.inc()
+
+def index_text(artifact_id, page_texts):
+    """Añadir el texto de cada página al índice de búsqueda y a los fragmentos del chatbot"""
+    try:
+        with metrics.stage('index_text'):
+            search_index.index_pages(artifact_id, page_texts)
+            chat_index.index_pages(artifact_id, page_texts)
+    except Exception as e:
+        print(f"⚠️ No se pudo indexar {artifact_id}: {e}")
+
+def processing_status(doc):
+    """Estado del procesamiento para el cliente; si quedó huérfano pasa a `failed` y el visor deja de esperar"""
+    processing = doc.get('processing') or {}
+    if doc.get('artifact_id') and jobs.is_orphaned(doc['artifact_id'], processing, processing_queue):
+        processing = jobs.fail_orphaned(store, doc['artifact_id'], processing)
+    return {k: v for k, v in processing.items() if k not in ('owner', 'updated_at')}
+
+def persist_job(job):
+    """Guardar el progreso del procesamiento en el artefacto (si sigue existiendo)"""
+    store.update_artifact(job.artifact_id, processing=job.to_dict())
+
+def page_response(doc_id, page_num, page):
+    """URL de la página, de sus variantes reducidas y, si la tiene, de su pirámide de teselas"""
+    data = {
+        'url': url_for('get_page_image', doc_id=doc_id, page_num=page_num),
+        'width': page['width'],
+        'height': page['height'],
+        'variants': [
+            {'width': v['width'], 'url': url_for('get_page_image', doc_id=doc_id, page_num=page_num, w=v['width'])}
+            for v in page.get('variants', [])
+        ]
+    }
+    if page.get('tiles'):
+        tiles = page['tiles']
+        data['tiles'] = {
+            'url': url_for('get_page_image', doc_id=doc_id, page_num=page_num) + '/tiles',
+            'size': tiles['size'],
+            'levels': tiles['levels'],
+            'format': tiles['format']
+        }
+    return data
+
+def document_response(doc):
+    """Vista pública del documento: metadata y URLs de páginas (sin imágenes)"""
+    data = {k: v for k, v in doc.items() if k not in ('pages', 'file_path')}
+    data['pages'] = [page_response(doc['id'], i, page) for i, page in enumerate(doc.get('pages', []))]
+    data['page_count'] = len(data['pages'])
+    return data
+
 # ==========================================
 # RUTAS PRINCIPALES
 # ==========================================
@@ -61,40 +172,47 @@ def upload():
         # Generar ID único
         doc_id = str(uuid.uuid4())
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{doc_id}_{filename}")
-        
-        # Guardar archivo
-        file.save(filepath)
-        
-        # Procesar documento según tipo
         file_ext = filename.rsplit('.', 1)[1].lower()
         
-        if file_ext == 'pdf':
-            image_data, text_content = process_pdf(filepath)
-        elif file_ext == 'docx':
-            image_data, text_content = process_docx(filepath)
-        elif file_ext == 'txt':
-            image_data, text_content = process_txt(filepath)
-        elif file_ext in ['png', 'jpg', 'jpeg', 'gif']:
-            image_data, text_content = process_image(filepath)
+        # Guardar por contenido: el mismo fichero se guarda y se procesa una sola vez
+        content_hash, tmp_path = storage.save_upload(file, app.config['UPLOAD_FOLDER'])
+        artifact, created = store.acquire_artifact(
+            storage.new_artifact(content_hash, app.config['UPLOAD_FOLDER'], file_ext))
+        if created:
+            os.replace(tmp_path, artifact['file_path'])
         else:
-            image_data, text_content = [], ""
+            os.remove(tmp_path)
         
-        # Guardar en memoria
-        documents[doc_id] = {
+        # Registrar el documento: apunta al contenido compartido y tiene sus propias anotaciones
+        store.create_document({
             'id': doc_id,
             'original_name': filename,
-            'file_path': filepath,
-            'upload_date': datetime.now().isoformat(),
-            'image_data': image_data,
-            'text_content': text_content,
-            'annotations': []
-        }
+            'file_type': file_ext,
+            'file_path': artifact['file_path'],
+            'artifact_id': artifact['id'],
+            'upload_date': datetime.now().isoformat()
+        })
+        
+        # Duplicado: páginas y texto ya están (o se están generando); solo se reintenta si
+        # falló o si quedó a medias (el worker que lo procesaba se reinició o se cayó)
+        processing = artifact.get('processing') or {}
+        if created or processing.get('state') == jobs.FAILED or \
+                jobs.is_orphaned(artifact['id'], processing, processing_queue):
+            job = jobs.Job(artifact['id'], persist_job)
+            future = processing_queue.submit(job, process_document, artifact['file_path'], artifact['file_type'])
+            future.add_done_callback(lambda _: thumbs.schedule(doc_id))
+            state = job.state
+        else:
+            state = processing.get('state', jobs.QUEUED)
+            if state == jobs.READY:
+                thumbs.schedule(doc_id)
         
         return jsonify({
             'success': True,
             'doc_id': doc_id,
-            'filename': filename
+            'filename': filename,
+            'state': state,
+            'duplicate': not created
         })
     
     except Exception as e:
@@ -105,57 +223,236 @@ def upload():
 def get_document(doc_id):
     """Obtener un documento por ID"""
     try:
-        if doc_id not in documents:
+        doc = store.get_document(doc_id)
+        if not doc:
             return jsonify({'error': 'Document not found'}), 404
         
-        return jsonify(documents[doc_id])
+        data = document_response(doc)
+        data['text_content'] = store.get_text(doc_id)
+        data['annotations'], data['annotations_version'] = store.get_annotation_state(doc_id)
+        return jsonify(data)
     
     except Exception as e:
         print(f"Error en get_document: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/document/<doc_id>/status')
+def document_status(doc_id):
+    """Estado del procesamiento y páginas ya disponibles"""
+    doc = store.get_document(doc_id)
+    if not doc:
+        return jsonify({'success': False, 'error': 'Document not found'}), 404
+    
+    data = document_response(doc)
+    return jsonify({
+        'success': True,
+        'doc_id': doc_id,
+        **processing_status(doc),
+        'pages': data['pages'],
+        'page_count': data['page_count']
+    })
+
+@app.route('/document/<doc_id>/page/<int:page_num>')
+def get_page_image(doc_id, page_num):
+    """Servir la imagen de una página como archivo binario"""
+    doc = store.get_document(doc_id)
+    if not doc:
+        return jsonify({'error': 'Document not found'}), 404
+    
+    pages = doc.get('pages', [])
+    if page_num < 0 or page_num >= len(pages) or not os.path.exists(pages[page_num]['path']):
+        return jsonify({'error': 'Page not found'}), 404
+    
+    # Con ?w= se sirve la variante más pequeña que cubre ese ancho
+    path = pages[page_num]['path']
+    width = request.args.get('w', type=int)
+    if width:
+        path = variants.pick(pages[page_num], width)
+    
+    # Las páginas no cambian una vez generadas: el navegador puede cachearlas
+    return send_file(path, max_age=86400)
+
+@app.route('/document/<doc_id>/page/<int:page_num>/tiles/<int:level>/<int:col>_<int:row>.<ext>')
+def get_page_tile(doc_id, page_num, level, col, row, ext):
+    """Servir una tesela de la pirámide de zoom de una página"""
+    doc = store.get_document(doc_id)
+    if not doc:
+        return jsonify({'error': 'Document not found'}), 404
+    
+    pages = doc.get('pages', [])
+    tiles = pages[page_num].get('tiles') if 0 <= page_num < len(pages) else None
+    if not tiles or ext != tiles['format']:
+        return jsonify({'error': 'Tile not found'}), 404
+    
+    return send_from_directory(tiles['path'], f"{level}/{col}_{row}.{ext}", max_age=86400)
+
+def thumbnail_url(doc):
+    """URL de la miniatura actual; si aún no la tiene, se genera en segundo plano para la próxima vez"""
+    if not doc.get('thumbnail'):
+        thumbs.schedule(doc['id'])
+        return None
+    return url_for('get_thumbnail', doc_id=doc['id'], key=doc['thumbnail'], ext=variants.extension())
+
 @app.route('/list_documents')
 def list_documents():
-    """Listar todos los documentos"""
+    """Listar documentos (más reciente primero), paginado con ?offset=&limit="""
     try:
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+        docs, total = store.list_documents(offset=offset, limit=limit)
+        
         docs_list = [
             {
                 'id': doc['id'],
                 'filename': doc['original_name'],
-                'date': doc['upload_date']
+                'date': doc['upload_date'],
+                'thumbnail': thumbnail_url(doc)
             }
-            for doc in documents.values()
+            for doc in docs
         ]
         
-        # Ordenar por fecha (más reciente primero)
-        docs_list.sort(key=lambda x: x['date'], reverse=True)
-        
-        return jsonify({'success': True, 'documents': docs_list})
+        return jsonify({
+            'success': True,
+            'documents': docs_list,
+            'total': total,
+            'offset': offset,
+            'limit': limit
+        })
     
     except Exception as e:
         print(f"Error en list_documents: {str(e)}")
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/document/<doc_id>/thumbnail/<key>.<ext>')
+def get_thumbnail(doc_id, key, ext):
+    """Miniatura de la primera página; la URL cambia con ella, así que se cachea sin caducidad"""
+    data = thumbs.get(doc_id, key) if ext == variants.extension() else None
+    if data is None:
+        return jsonify({'error': 'Thumbnail not found'}), 404
+    response = send_file(BytesIO(data), mimetype=f"image/{'jpeg' if ext == 'jpg' else ext}")
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/search')
+def search_documents():
+    """Buscar en el texto de todos los documentos: ?q=&limit=&offset="""
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'success': False, 'error': 'Query required'}), 400
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+        
+        start = time.perf_counter()
+        # Un mismo contenido puede estar en varios documentos (subidas duplicadas):
+        # total, offset y limit cuentan documentos
+        results, total = search_index.search(query, limit=limit, offset=offset,
+                                             documents=store.documents_by_content)
+        documents = [
+            {
+                'id': result['document']['id'],
+                'filename': result['document']['original_name'],
+                'date': result['document']['upload_date'],
+                'score': result['score'],
+                'matching_pages': result['page_count'],
+                'pages': result['pages']
+            }
+            for result in results
+        ]
+        
+        return jsonify({
+            'success': True,
+            'query': query,
+            'documents': documents,
+            'total': total,
+            'offset': offset,
+            'limit': limit,
+            'took_ms': round((time.perf_counter() - start) * 1000, 2)
+        })
+    
+    except Exception as e:
+        print(f"Error en search: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/save_annotations', methods=['POST'])
 def save_annotations():
     """Guardar anotaciones de un documento"""
     try:
         data = request.get_json()
         doc_id = data.get('doc_id')
-        annotations = data.get('annotations', [])
+        # Trazos simplificados y compactos (se aceptan también con la lista de puntos antigua)
+        annotations = strokes.compact_all(data.get('annotations', []))
         
-        if not doc_id or doc_id not in documents:
+        with metrics.stage('annotations_write'):
+            version = store.set_annotations(doc_id, annotations) if doc_id else None
+        if version is None:
             return jsonify({'success': False, 'error': 'Document not found'})
         
-        documents[doc_id]['annotations'] = annotations
-        documents[doc_id]['last_modified'] = datetime.now().isoformat()
+        annotation_index.saved(doc_id, version, annotations)
+        store.update_document(doc_id, last_modified=datetime.now().isoformat())
+        thumbs.schedule(doc_id)
         
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'version': version})
     
     except Exception as e:
         print(f"Error en save_annotations: {str(e)}")
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/annotations/<doc_id>')
+def get_annotations(doc_id):
+    """Anotaciones actuales y su versión (para rehacer un cambio rechazado)"""
+    annotations, version = store.get_annotation_state(doc_id)
+    if annotations is None:
+        return jsonify({'success': False, 'error': 'Document not found'}), 404
+    return jsonify({'success': True, 'annotations': annotations, 'version': version})
+
+@app.route('/annotations/<doc_id>/query')
+def query_annotations(doc_id):
+    """Anotaciones de un rango de páginas (?pages=2-5) que tocan un rectángulo
+    normalizado (?rect=x0,y0,x1,y1); sin parámetros, todas"""
+    try:
+        pages, rect = spatial.parse_query(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f"Invalid query: {e}"}), 400
+    annotations, version = annotation_index.query(doc_id, pages=pages, rect=rect)
+    if annotations is None:
+        return jsonify({'success': False, 'error': 'Document not found'}), 404
+    return jsonify({'success': True, 'annotations': annotations, 'version': version})
+
+@app.route('/annotations/<doc_id>/patch', methods=['POST'])
+def patch_annotations(doc_id):
+    """Guardado incremental: {base_version, add: [anotaciones con id], remove: [ids]}"""
+    try:
+        data = request.get_json() or {}
+        base_version = data.get('base_version')
+        add = data.get('add', [])
+        remove = data.get('remove', [])
+        
+        if not isinstance(base_version, int) or not all(isinstance(a, dict) and a.get('id') for a in add):
+            return jsonify({'success': False, 'error': 'base_version and annotation ids are required'}), 400
+        try:
+            add = strokes.compact_all(add)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        try:
+            with metrics.stage('annotations_write'):
+                version = store.patch_annotations(doc_id, base_version, add=add, remove=remove)
+        except storage.VersionConflict as e:
+            return jsonify({'success': False, 'error': 'Version conflict', 'version': e.version}), 409
+        
+        if version is None:
+            return jsonify({'success': False, 'error': 'Document not found'}), 404
+        
+        annotation_index.patched(doc_id, base_version, version, add=add, remove=remove)
+        store.update_document(doc_id, last_modified=datetime.now().isoformat())
+        thumbs.schedule(doc_id)
+        return jsonify({'success': True, 'version': version})
+    
+    except Exception as e:
+        print(f"Error en patch_annotations: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/delete_document', methods=['POST'])
 def delete_document():
     """Borrar un documento"""
@@ -163,19 +460,15 @@ def delete_document():
         data = request.get_json()
         doc_id = data.get('doc_id')
         
-        if not doc_id or doc_id not in documents:
+        doc = store.delete_document(doc_id) if doc_id else None
+        if not doc:
             return jsonify({'success': False, 'error': 'Document not found'})
         
-        # Borrar archivo físico
-        doc = documents[doc_id]
-        if 'file_path' in doc and os.path.exists(doc['file_path']):
-            try:
-                os.remove(doc['file_path'])
-            except Exception as e:
-                print(f"Error al borrar archivo: {e}")
-        
-        # Borrar del diccionario
-        del documents[doc_id]
+        # Borrar archivo físico, páginas renderizadas y texto indexado (si ningún otro documento los usa)
+        if not doc.get('shared'):
+            search_index.remove(doc.get('artifact_id') or doc['id'])
+            chat_index.remove(doc.get('artifact_id') or doc['id'])
+            storage.remove_files(storage.artifact_files(doc))
         
         return jsonify({'success': True})
     
@@ -191,41 +484,41 @@ def export_pdf():
         doc_id = data.get('doc_id')
         annotations = data.get('annotations', [])
         
-        if not doc_id or doc_id not in documents:
+        doc = store.get_document(doc_id) if doc_id else None
+        if not doc:
             return jsonify({'success': False, 'error': 'Document not found'})
         
-        doc = documents[doc_id]
-        
+        download_name = f"{doc['original_name']}_anotado.pdf"
+
+        # Páginas como imagen: se pintan (o salen de la caché), se escriben y se envían de una en una
+        is_pdf = doc.get('file_type') == 'pdf' and os.path.exists(doc.get('file_path') or '')
+        pages = [p['path'] for p in doc.get('pages', []) if os.path.exists(p['path'])]
+        if pages and not is_pdf:
+            jpegs = export.cached_pages(export.image_sources(pages), annotations, page_cache)
+            return Response(
+                stream_with_context(export.stream_jpeg_pdf(jpegs)),
+                mimetype='application/pdf',
+                headers=export.attachment_headers(download_name)
+            )
+
         # Intentar usar ReportLab
         try:
             from reportlab.pdfgen import canvas
             from reportlab.lib.pagesizes import A4
-            from reportlab.lib.utils import ImageReader
-            
-            # Crear PDF en memoria
-            buffer = BytesIO()
-            c = canvas.Canvas(buffer, pagesize=A4)
-            width, height = A4
             
-            # Si tiene imágenes (páginas)
-            if doc['image_data']:
-                for page_num, img_data in enumerate(doc['image_data']):
-                    # Dibujar imagen de fondo
-                    if img_data.startswith('data:image'):
-                        img_bytes = base64.b64decode(img_data.split(',')[1])
-                        img_buffer = BytesIO(img_bytes)
-                        img = ImageReader(img_buffer)
-                        c.drawImage(img, 0, 0, width, height, preserveAspectRatio=True)
-                    
-                    # Dibujar anotaciones de esta página
-                    page_annotations = [a for a in annotations if a.get('page') == page_num]
-                    draw_annotations_on_canvas(c, page_annotations, width, height)
-                    
-                    c.showPage()
+            # En memoria hasta EXPORT_MEMORY_BUDGET_MB; a partir de ahí, a disco
+            buffer = tempfile.SpooledTemporaryFile(max_size=export.EXPORT_MEMORY_BUDGET_MB * 1024 * 1024)
+
+            # PDF original: capa vectorial de anotaciones sobre las páginas originales
+            if is_pdf:
+                export.annotate_pdf(doc['file_path'], annotations, buffer,
+                                    image_widths=[p['width'] for p in doc.get('pages', [])])
             else:
                 # Documento de texto plano
+                c = canvas.Canvas(buffer, pagesize=A4)
+                width, height = A4
                 c.setFont("Helvetica", 12)
-                text_content = doc.get('text_content', '')
+                text_content = store.get_text(doc_id) or ''
                 
                 y = height - 50
                 for line in text_content.split('\n'):
@@ -234,15 +527,14 @@ def export_pdf():
                         y = height - 50
                     c.drawString(50, y, line[:100])
                     y -= 15
-            
-            c.save()
+                c.save()
+
             buffer.seek(0)
-            
             return send_file(
                 buffer,
                 mimetype='application/pdf',
                 as_attachment=True,
-                download_name=f"{doc['original_name']}_anotado.pdf"
+                download_name=download_name
             )
         
         except ImportError:
@@ -255,52 +547,26 @@ def export_pdf():
         print(f"Error en export_pdf: {str(e)}")
         return jsonify({'success': False, 'error': str(e)})
 
-def draw_annotations_on_canvas(c, annotations, width, height):
-    """Helper para dibujar anotaciones en el canvas de PDF"""
-    for ann in annotations:
-        color = ann.get('color', '#FFEB3B')
-        r, g, b = hex_to_rgb(color)
-        
-        if ann.get('type') == 'text':
-            c.setFillColorRGB(r, g, b)
-            c.setFont("Helvetica", ann.get('size', 3) * 10)
-            x = ann.get('x', 0) * width
-            y = height - (ann.get('y', 0) * height)
-            c.drawString(x, y, ann.get('text', ''))
-        
-        elif ann.get('type') in ['pen', 'highlighter']:
-            points = ann.get('points', [])
-            if len(points) > 1:
-                c.setStrokeColorRGB(r, g, b)
-                c.setLineWidth(ann.get('size', 3) * 2)
-                
-                if ann.get('type') == 'highlighter':
-                    c.setStrokeAlpha(0.3)
-                
-                p = c.beginPath()
-                first_point = points[0]
-                p.moveTo(first_point['x'] * width, height - (first_point['y'] * height))
-                
-                for point in points[1:]:
-                    p.lineTo(point['x'] * width, height - (point['y'] * height))
-                
-                c.drawPath(p, stroke=1, fill=0)
-                c.setStrokeAlpha(1)
-
-def hex_to_rgb(hex_color):
-    """Convertir color hexadecimal a tupla RGB (0-1)"""
-    hex_color = hex_color.lstrip('#')
-    if len(hex_color) == 3:
-        hex_color = ''.join([c*2 for c in hex_color])
-    r = int(hex_color[0:2], 16) / 255.0
-    g = int(hex_color[2:4], 16) / 255.0
-    b = int(hex_color[4:6], 16) / 255.0
-    return (r, g, b)
-
 # ==========================================
 # CHATBOT
 # ==========================================
 
+def chat_prompt(doc, question, chat_history):
+    """Contexto de una pregunta: solo los fragmentos relevantes, con su página. Devuelve (clave, fuentes, prompt)"""
+    key = doc.get('artifact_id') or doc['id']
+    if not chat_index.has(key):
+        # Documentos anteriores a los fragmentos: se trocean en la primera pregunta
+        chat_index.index_pages(key, search_index.pages(key) or [store.get_text(doc['id']) or ''])
+    chunks = chat_index.retrieve(key, question)
+    paged = bool(doc.get('pages'))  # texto sin páginas: se cita el fragmento
+    prompt = retrieval.build_prompt(retrieval.build_context(chunks, paged), question, chat_history)
+    return key, retrieval.sources(chunks, paged), prompt
+
+def busy_response(e):
+    """429 inmediato, sin esperar reintentos: el cliente vuelve a preguntar pasado retry_after"""
+    return jsonify({'success': False, 'error': str(e), 'retry_after': e.retry_after}), 429, \
+        {'Retry-After': str(e.retry_after)}
+
 @app.route('/ask_chatbot', methods=['POST'])
 def ask_chatbot():
     """Procesar pregunta del chatbot"""
@@ -310,62 +576,118 @@ def ask_chatbot():
         question = data.get('question')
         chat_history = data.get('chat_history', [])
         
-        if not doc_id or doc_id not in documents:
+        doc = store.get_document(doc_id) if doc_id else None
+        if not doc:
             return jsonify({'success': False, 'error': 'Document not found'})
         
-        doc = documents[doc_id]
+        key, sources, prompt = chat_prompt(doc, question, chat_history)
+        try:
+            answer = chat_client.ask(prompt, llm.cache_key(key, question, chat_history))
+        except llm.Busy as e:
+            return busy_response(e)
+        
+        return jsonify({'success': True, 'answer': answer, 'sources': sources})
+    
+    except Exception as e:
+        print(f"Error en ask_chatbot: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/ask_chatbot/stream', methods=['POST'])
+def ask_chatbot_stream():
+    """Pregunta del chatbot con la respuesta en streaming (Server-Sent Events)"""
+    try:
+        started = time.perf_counter()
+        data = request.get_json()
+        doc_id = data.get('doc_id')
+        question = data.get('question')
+        chat_history = data.get('chat_history', [])
         
-        # AQUÍ: Integra tu IA favorita (Claude, GPT, etc.)
-        # Por ahora, respuesta simple
-        answer = f"Pregunta recibida: '{question}' sobre el documento '{doc['original_name']}'"
+        doc = store.get_document(doc_id) if doc_id else None
+        if not doc:
+            return jsonify({'success': False, 'error': 'Document not found'})
         
-        # Ejemplo con contexto del documento
-        if doc['text_content']:
-            answer += f"\n\nEl documento tiene {len(doc['text_content'])} caracteres."
+        key, sources, prompt = chat_prompt(doc, question, chat_history)
+        try:
+            pieces = chat_client.stream(prompt, llm.cache_key(key, question, chat_history))
+        except llm.Busy as e:
+            return busy_response(e)
         
-        return jsonify({'success': True, 'answer': answer})
+        return Response(stream_with_context(llm.answer_events(pieces, sources, started)),
+                        mimetype='text/event-stream', headers=llm.SSE_HEADERS)
     
     except Exception as e:
-        print(f"Error en ask_chatbot: {str(e)}")
+        print(f"Error en ask_chatbot_stream: {str(e)}")
         return jsonify({'success': False, 'error': str(e)})
 
 # ==========================================
 # PROCESADORES DE DOCUMENTOS
 # ==========================================
 
-def process_pdf(filepath):
+def process_document(job, filepath, file_ext):
+    """Procesar un documento en segundo plano según su tipo"""
+    if file_ext == 'pdf':
+        text_content = process_pdf(filepath, job)
+    else:
+        if file_ext == 'docx':
+            pages, text_content = process_docx(filepath)
+        elif file_ext == 'txt':
+            pages, text_content = process_txt(filepath)
+        elif file_ext in ['png', 'jpg', 'jpeg', 'gif']:
+            pages, text_content = process_image(filepath)
+        else:
+            pages, text_content = [], ""
+        
+        job.set_state(jobs.RASTERIZING, len(pages))
+        for i, page in enumerate(pages):
+            publish_page(job.artifact_id, i, page)
+            job.page_done()
+        
+        index_text(job.artifact_id, [text_content])
+    
+    store.set_artifact_text(job.artifact_id, text_content)
+
+def process_pdf(filepath, job):
     """Procesar archivo PDF con fallback mejorado para Windows"""
+    artifact_id = job.artifact_id
     
     # INTENTO 1: pdf2image (funciona si poppler está instalado)
     try:
-        from pdf2image import convert_from_path
-        import pytesseract
+        from pdf2image import pdfinfo_from_path
         
         print("📄 Intentando procesar con pdf2image...")
-        images = convert_from_path(filepath, dpi=150)
-        
-        image_data = []
-        text_content = []
-        
-        for i, img in enumerate(images):
-            buffered = BytesIO()
-            img.save(buffered, format="PNG", optimize=True, quality=85)
-            img_str = base64.b64encode(buffered.getvalue()).decode()
-            image_data.append(f"data:image/png;base64,{img_str}")
-            
-            try:
-                text = pytesseract.image_to_string(img, lang='spa+eng')
-                text_content.append(text)
-            except:
-                text_content.append(f"[Página {i+1}]")
-        
-        print(f"✅ PDF procesado con imágenes: {len(images)} páginas")
-        return image_data, '\n\n'.join(text_content)
+        num_pages = pdfinfo_from_path(filepath)['Pages']
+        
+        # Las páginas con capa de texto no necesitan OCR
+        pdf_text = ocr.PdfText(filepath, lang='spa+eng')
+        
+        # Rasterizar por rangos (varios hilos de poppler): cada página se publica
+        # en cuanto está lista y, si no tiene texto, su OCR arranca en el pool
+        job.set_state(jobs.RASTERIZING, num_pages)
+        for i, img in ocr.rasterize_pdf(filepath, num_pages, dpi=150):
+            page = save_page_image(artifact_id, i, img)
+            publish_page(artifact_id, i, page)
+            pdf_text.page_rendered(i, page['path'])
+            job.page_done()
+        
+        job.set_state(jobs.OCR, pdf_text.ocr_pages)
+        texts = pdf_text.results(on_page=lambda i: job.page_done())
+        text_content = [t if t is not None else f"[Página {i+1}]" for i, t in enumerate(texts)]
+        index_text(artifact_id, [t or '' for t in texts])
+        
+        report = pdf_text.report()
+        store.update_artifact(artifact_id, text_extraction=report)
+        
+        print(f"✅ PDF procesado con imágenes: {num_pages} páginas "
+              f"({report['text_layer_pages']} con capa de texto, {report['ocr_pages']} con OCR)")
+        return '\n\n'.join(text_content)
     
     except Exception as e:
         print(f"⚠️ pdf2image no disponible: {e}")
         print("📄 Usando fallback: creando imágenes desde texto...")
     
+    # Descartar páginas a medio publicar del intento anterior
+    store.clear_artifact_pages(artifact_id)
+    
     # FALLBACK: Crear imágenes limpias desde el texto extraído
     try:
         import PyPDF2
@@ -393,9 +715,10 @@ def process_pdf(filepath):
             text_pages = ["[PDF sin texto extraíble]"]
         
         print(f"📄 Creando {len(text_pages)} imágenes desde texto...")
+        job.set_state(jobs.RASTERIZING, len(text_pages))
         
         # Crear imágenes desde el texto
-        image_data = []
+        pages = []
         full_text_parts = []
         
         for page_num, page_text in enumerate(text_pages):
@@ -457,24 +780,25 @@ def process_pdf(filepath):
             footer = f"Extraído de PDF - Página {page_num + 1}"
             draw.text((margin, img_height - 30), footer, fill='#999999', font=font_text)
             
-            # Convertir a base64
-            buffered = BytesIO()
-            img.save(buffered, format="PNG", optimize=True)
-            img_str = base64.b64encode(buffered.getvalue()).decode()
-            image_data.append(f"data:image/png;base64,{img_str}")
+            # Guardar la página en disco
+            page = save_page_image(artifact_id, page_num, img)
+            pages.append(page)
+            publish_page(artifact_id, page_num, page)
+            job.page_done()
             
             full_text_parts.append(f"=== PÁGINA {page_num + 1} ===\n{page_text}")
         
         full_text = '\n\n'.join(full_text_parts)
+        index_text(artifact_id, text_pages)
         
-        print(f"✅ Creadas {len(image_data)} imágenes desde texto extraído")
-        return image_data, full_text
+        print(f"✅ Creadas {len(pages)} imágenes desde texto extraído")
+        return full_text
     
     except Exception as e:
         import traceback
         print(f"❌ Error en fallback: {e}")
         print(traceback.format_exc())
-        return [], f"Error al procesar PDF: {str(e)}\n\nEl archivo se cargó pero no se pudo visualizar."
+        return f"Error al procesar PDF: {str(e)}\n\nEl archivo se cargó pero no se pudo visualizar."
 def process_docx(filepath):
     """Procesar archivo DOCX"""
     try:
@@ -495,24 +819,22 @@ def process_txt(filepath):
         return [], f"Error al leer TXT: {str(e)}"
 
 def process_image(filepath):
-    """Procesar archivo de imagen"""
+    """Procesar archivo de imagen (la propia imagen es la única página)"""
     try:
-        with open(filepath, 'rb') as f:
-            img_bytes = f.read()
-        
-        img_b64 = base64.b64encode(img_bytes).decode()
-        ext = filepath.rsplit('.', 1)[1].lower()
+        from PIL import Image
+        img = Image.open(filepath)
+        # El original queda para exportar; el visor pide las variantes reducidas
+        page = {'path': filepath, 'width': img.width, 'height': img.height, **variants.generate(img, filepath)}
         
         # Intentar OCR
         try:
             import pytesseract
-            from PIL import Image
-            img = Image.open(filepath)
-            text = pytesseract.image_to_string(img, lang='spa+eng')
+            with metrics.stage('ocr'):
+                text = pytesseract.image_to_string(img, lang='spa+eng')
         except:
             text = "Imagen cargada"
         
-        return [f"data:image/{ext};base64,{img_b64}"], text
+        return [page], text
     
     except Exception as e:
         return [], f"Error al procesar imagen: {str(e)}"
@@ -527,7 +849,7 @@ if __name__ == '__main__':
     print("=" * 50)
     print("📡 Servidor iniciando...")
     print(f"📁 Carpeta de uploads: {app.config['UPLOAD_FOLDER']}")
-    print(f"📄 Documentos en memoria: {len(documents)}")
+    print(f"📄 Documentos guardados: {store.count()}")
     print("=" * 50)
     print("✅ Servidor listo")
     print("🌐 Accede desde:")
@@ -0,0 +1,83 @@
+"""
+Benchmark: tiempo hasta el primer trozo frente a respuesta completa en el chatbot
+
+Uso:
+    python benchmarks/bench_chat_stream.py --questions 20 --latency 0.5 --token-delay 0.02
+
+Arranca la app (en un directorio temporal) con el modelo falso (CHAT_MODEL=fake):
+`latency` es lo que tarda en llegar el primer trozo y `token-delay` lo que tarda
+cada palabra siguiente. Sube un documento de texto y hace las mismas preguntas
+por /ask_chatbot (JSON al final) y por /ask_chatbot/stream (SSE), midiendo con
+el cliente de pruebas de Flask el primer trozo (TTFT) y el total (p50/p95).
+"""
+
+import os
+import io
+import sys
+import time
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = "contrato renta fianza arrendatario cláusula rescisión plazo pago aviso obra".split()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def make_text(paragraphs):
+    lines = []
+    for n in range(paragraphs):
+        word = WORDS[n % len(WORDS)]
+        lines.append(f"Apartado {n}. El {word} número {n} se rige por lo pactado en el anexo {n}. "
+                     f"La {WORDS[(n * 7) % len(WORDS)]} del apartado {n} vence a los {n % 30 + 1} días.")
+    return '\n\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--questions', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.5, help='segundos hasta el primer trozo')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='segundos entre palabras')
+    args = parser.parse_args()
+
+    os.environ.update(CHAT_MODEL='fake', FAKE_LLM_LATENCY=str(args.latency),
+                      FAKE_LLM_TOKEN_DELAY=str(args.token_delay), LLM_RATE_PER_MIN='100000',
+                      LLM_BURST='1000', DOCUMENT_STORE='memory')
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        import app as application
+        client = application.app.test_client()
+        doc_id = client.post('/upload', data={'file': (io.BytesIO(make_text(400).encode()), 'contrato.txt')}).get_json()['doc_id']
+        while client.get(f'/document/{doc_id}/status').get_json().get('state') not in ('ready', 'failed'):
+            time.sleep(0.05)
+
+        results = {}
+        for endpoint in ('/ask_chatbot', '/ask_chatbot/stream'):
+            ttfts, totals = [], []
+            for n in range(args.questions):
+                # Preguntas distintas en cada pasada para no acertar en la caché
+                body = {'doc_id': doc_id, 'question': f"¿Qué dice el apartado {n} sobre la {WORDS[n % len(WORDS)]}? ({endpoint})"}
+                start = time.perf_counter()
+                response = client.post(endpoint, json=body, buffered=False)
+                first = None
+                for chunk in response.response:
+                    if first is None and (b'data: {"text"' in chunk or b'"answer"' in chunk):
+                        first = time.perf_counter() - start
+                total = time.perf_counter() - start
+                ttfts.append((first or total) * 1000)
+                totals.append(total * 1000)
+            results[endpoint] = (ttfts, totals)
+
+        print(f"{'endpoint':<22}{'TTFT p50':>10}{'TTFT p95':>10}{'total p50':>11}{'total p95':>11}  (ms)")
+        for endpoint, (ttfts, totals) in results.items():
+            print(f"{endpoint:<22}{percentile(ttfts, 0.5):>10.0f}{percentile(ttfts, 0.95):>10.0f}"
+                  f"{percentile(totals, 0.5):>11.0f}{percentile(totals, 0.95):>11.0f}")
+
+
+if __name__ == '__main__':
+    main()
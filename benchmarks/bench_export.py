@@ -0,0 +1,151 @@
+"""
+Benchmark: exportación rasterizada frente a capa vectorial sobre el PDF original
+
+Uso:
+    python benchmarks/bench_export.py --pages 30 --annotated 5
+    python benchmarks/bench_export.py --memory --pages 50 100 200
+
+Genera un PDF con capa de texto y anotaciones en unas pocas páginas. El camino
+antiguo dibuja las anotaciones sobre las imágenes de página (como las deja el
+procesado a 200 dpi) y guarda un PDF con PIL; el nuevo fusiona la capa
+vectorial sobre el original. Mide tiempo y tamaño de salida.
+
+Con --memory compara el pico de memoria (RSS) de la exportación de páginas
+imagen acumulando todas en una lista frente al PDF en streaming, cada medida
+en un proceso aparte.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+import export
+import utils
+
+LOREM = ("El arrendatario se obliga a pagar la renta pactada dentro de los cinco "
+         "primeros días de cada mes. ")
+
+
+def make_pdf(path, pages):
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import A4
+
+    c = canvas.Canvas(path, pagesize=A4)
+    for n in range(pages):
+        y = 800
+        c.drawString(50, y, f"Página {n + 1}")
+        while y > 60:
+            y -= 14
+            c.drawString(50, y, LOREM[:90])
+        c.showPage()
+    c.save()
+
+
+def make_page_image(n, size=(1654, 2339)):
+    """Lo que deja el rasterizado a 200 dpi de una página A4"""
+    img = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(img)
+    for y in range(80, size[1] - 80, 40):
+        draw.text((80, y), f"{n + 1} " + LOREM[:90], fill='black')
+    return img
+
+
+def make_annotations(pages, annotated, strokes=20):
+    rnd = random.Random(0)
+    anns = []
+    for page in rnd.sample(range(pages), annotated):
+        for s in range(strokes):
+            points = [{'x': rnd.random(), 'y': rnd.random()} for _ in range(40)]
+            anns.append({'id': f'{page}-{s}', 'type': rnd.choice(['pen', 'highlighter']),
+                         'page': page, 'color': '#e53935', 'size': 3, 'points': points})
+        anns.append({'id': f'{page}-t', 'type': 'text', 'page': page, 'color': '#1e88e5',
+                     'size': 2, 'x': 0.1, 'y': 0.1, 'text': 'Revisar esta cláusula'})
+    return anns
+
+
+def _peak_rss(mode, images, anns, out_path, result):
+    """Exportar en un proceso limpio y devolver el pico de RSS en MB"""
+    if mode == 'lista':
+        out_imgs = [utils.process_annotations_on_image(Image.open(p).convert('RGB'), anns, i)
+                    for i, p in enumerate(images)]
+        out_imgs[0].save(out_path, "PDF", resolution=100.0, save_all=True, append_images=out_imgs[1:])
+    else:
+        pages = (export.load_page_image(p) for p in images)
+        with open(out_path, 'wb') as out:
+            for chunk in export.stream_image_pdf(export.annotated_pages(pages, anns)):
+                out.write(chunk)
+    result.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def bench_memory(page_counts, annotated):
+    ctx = multiprocessing.get_context('spawn')
+    print(f"{'páginas':>8}{'lista MB':>12}{'streaming MB':>15}")
+    with tempfile.TemporaryDirectory() as tmp:
+        image = os.path.join(tmp, 'page.png')
+        make_page_image(0).save(image)
+        for pages in page_counts:
+            images = [image] * pages
+            anns = make_annotations(pages, min(annotated, pages))
+            peaks = []
+            for mode in ('lista', 'streaming'):
+                result = ctx.Queue()
+                proc = ctx.Process(target=_peak_rss, args=(mode, images, anns, os.path.join(tmp, 'out.pdf'), result))
+                proc.start()
+                peaks.append(result.get())
+                proc.join()
+            print(f"{pages:>8}{peaks[0]:>12.0f}{peaks[1]:>15.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, nargs='+', default=[30])
+    parser.add_argument('--annotated', type=int, default=5, help='páginas con anotaciones')
+    parser.add_argument('--memory', action='store_true', help='medir pico de memoria lista vs streaming')
+    args = parser.parse_args()
+
+    if args.memory:
+        return bench_memory(args.pages, args.annotated)
+
+    args.pages = args.pages[0]
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'src.pdf')
+        make_pdf(src, args.pages)
+        anns = make_annotations(args.pages, min(args.annotated, args.pages))
+        images = []
+        for n in range(args.pages):
+            path = os.path.join(tmp, f'page_{n}.png')
+            make_page_image(n).save(path)
+            images.append(path)
+
+        start = time.perf_counter()
+        out_imgs = [utils.process_annotations_on_image(Image.open(p).convert('RGB'), anns, i)
+                    for i, p in enumerate(images)]
+        raster_path = os.path.join(tmp, 'raster.pdf')
+        out_imgs[0].save(raster_path, "PDF", resolution=100.0, save_all=True, append_images=out_imgs[1:])
+        raster_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vector_path = os.path.join(tmp, 'vector.pdf')
+        export.annotate_pdf(src, anns, vector_path, image_widths=[1654] * args.pages)
+        vector_s = time.perf_counter() - start
+
+        raster_kb = os.path.getsize(raster_path) / 1024
+        vector_kb = os.path.getsize(vector_path) / 1024
+        print(f"Original: {os.path.getsize(src) / 1024:.0f} KB, {args.pages} páginas, "
+              f"{args.annotated} con anotaciones ({len(anns)} anotaciones)")
+        print(f"{'método':<10}{'segundos':>10}{'KB':>10}")
+        print(f"{'raster':<10}{raster_s:>10.2f}{raster_kb:>10.0f}")
+        print(f"{'vectorial':<10}{vector_s:>10.2f}{vector_kb:>10.0f}")
+        print(f"Tiempo: x{raster_s / vector_s:.1f} más rápido · tamaño: {vector_kb / raster_kb:.1%} del raster")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark: reexportar un documento anotado con y sin la caché de páginas pintadas
+
+Uso:
+    python benchmarks/bench_export_cache.py --pages 100 --strokes 40
+
+Genera N páginas PNG y anotaciones en todas ellas y exporta el PDF cuatro
+veces: sin caché (como hasta ahora), con la caché vacía, sin cambios y tras
+editar una sola página. Para cada exportación muestra el tiempo y cuántas
+páginas se han tenido que pintar; tras editar una página solo debe pintarse esa.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+import export
+import pagecache
+
+
+def make_pages(folder, count, size=(1240, 1754)):
+    paths = []
+    for i in range(count):
+        img = Image.new('RGB', size, 'white')
+        draw = ImageDraw.Draw(img)
+        for y in range(80, size[1] - 80, 35):
+            draw.text((60, y), f"Página {i + 1} · cláusula {y // 35}: el arrendatario se obliga a pagar la renta", fill='black')
+        path = os.path.join(folder, f"doc_page_{i}.png")
+        img.save(path)
+        paths.append(path)
+    return paths
+
+
+def make_annotations(rnd, pages, strokes):
+    anns = []
+    for page in range(pages):
+        for _ in range(strokes):
+            x, y = rnd.random() * 0.8, rnd.random()
+            kind = rnd.choice(['pen', 'highlighter'])
+            anns.append({'type': kind, 'page': page, 'color': '#e91e63', 'size': 3,
+                         'points': [{'x': x + i * 0.01, 'y': y + rnd.uniform(-0.005, 0.005)} for i in range(15)]})
+    return anns
+
+
+def export_pdf(paths, anns, cache):
+    start = time.perf_counter()
+    misses = cache.misses if cache else len(paths)
+    if cache:
+        chunks = export.stream_jpeg_pdf(export.cached_pages(export.image_sources(paths), anns, cache))
+    else:
+        chunks = export.stream_image_pdf(export.annotated_pages((export.load_page_image(p) for p in paths), anns))
+    data = b''.join(chunks)
+    rendered = (cache.misses - misses) if cache else len(paths)
+    return time.perf_counter() - start, rendered, data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--strokes', type=int, default=40, help='trazos por página')
+    parser.add_argument('--cache-mb', type=int, default=512)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        print(f"Generando {args.pages} páginas...")
+        paths = make_pages(folder, args.pages)
+        anns = make_annotations(random.Random(0), args.pages, args.strokes)
+        cache = pagecache.PageCache(os.path.join(folder, 'render_cache'), args.cache_mb)
+
+        print(f"{'exportación':<22}{'segundos':>10}{'pintadas':>10}{'MB':>8}")
+        runs = [('sin caché', None, anns), ('caché vacía', cache, anns), ('sin cambios', cache, anns)]
+        edited = anns + [{'type': 'text', 'page': args.pages // 2, 'color': '#000000', 'size': 2,
+                          'x': 0.1, 'y': 0.1, 'text': 'Revisar'}]
+        runs.append(('una página editada', cache, edited))
+        outputs = []
+        for label, run_cache, run_anns in runs:
+            seconds, rendered, data = export_pdf(paths, run_anns, run_cache)
+            outputs.append(data)
+            print(f"{label:<22}{seconds:>10.2f}{rendered:>10}{len(data) / 1024 / 1024:>8.1f}")
+        print(f"PDF idéntico con y sin caché: {outputs[0] == outputs[1] == outputs[2]}")
+        print(f"Caché: {cache.stats()}")
+
+
+if __name__ == '__main__':
+    main()
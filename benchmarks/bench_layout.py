@@ -0,0 +1,124 @@
+"""
+Benchmark: maquetación de texto en páginas, implementación anterior frente a layout.py
+
+Uso:
+    python benchmarks/bench_layout.py --size-mb 1
+    python benchmarks/bench_layout.py --file contrato.txt --render 5
+
+La implementación anterior mide con draw.textbbox la línea entera cada vez que
+añade una palabra; layout.py suma anchos de palabra cacheados. Se compara el
+tiempo de maquetar (líneas y páginas, sin pintar), el número de páginas y
+cuántas líneas salen idénticas. Con --render se pintan además las primeras N
+páginas con cada una.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+import layout
+
+WORDS = ("el la de que arrendatario arrendador contrato renta mensual fianza cláusula rescisión "
+         "plazo obligaciones partes notificación indemnización domicilio vivienda acuerdo").split()
+
+
+def legacy_wrap_text(text, font, max_width, draw):
+    """utils.wrap_text tal como estaba"""
+    lines = []
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    for paragraph in text.split('\n'):
+        if not paragraph:
+            lines.append('')
+            continue
+        words = paragraph.split(' ')
+        current_line = []
+        for word in words:
+            test_line = ' '.join(current_line + [word])
+            bbox = draw.textbbox((0, 0), test_line, font=font)
+            if bbox[2] - bbox[0] <= max_width:
+                current_line.append(word)
+            else:
+                lines.append(' '.join(current_line))
+                current_line = [word]
+        if current_line:
+            lines.append(' '.join(current_line))
+    return lines
+
+
+def legacy_paginate(lines, height=layout.PAGE_HEIGHT, margin=layout.MARGIN, line_height=layout.LINE_HEIGHT):
+    """Paginación de utils.iter_pages_from_text tal como estaba (sin pintar)"""
+    pages, current, y = [], [], margin
+    for line in lines:
+        current.append(line)
+        y += line_height
+        if y > height - margin:
+            pages.append(current)
+            current, y = [], margin
+    if current or not pages:
+        pages.append(current)
+    return pages
+
+
+def make_text(size_mb, rnd):
+    paragraphs, size = [], 0
+    while size < size_mb * 1024 * 1024:
+        paragraph = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(20, 200))) + '.'
+        paragraphs.append(paragraph)
+        size += len(paragraph.encode('utf-8')) + 1
+    return '\n'.join(paragraphs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=float, default=1.0, help='tamaño del texto sintético')
+    parser.add_argument('--file', help='maquetar este fichero en lugar del texto sintético')
+    parser.add_argument('--render', type=int, default=0, help='pintar también las primeras N páginas')
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, encoding='utf-8') as f:
+            text = f.read()
+    else:
+        text = make_text(args.size_mb, random.Random(0))
+    font = layout.get_font()
+    max_width = layout.PAGE_WIDTH - 2 * layout.MARGIN
+    print(f"Texto: {len(text.encode('utf-8')) / 1024 / 1024:.2f} MB, fuente {getattr(font, 'size', '?')} px")
+
+    start = time.perf_counter()
+    draw = ImageDraw.Draw(Image.new('RGB', (100, 100)))
+    old_pages = legacy_paginate(legacy_wrap_text(text, font, max_width, draw))
+    old_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new_pages = layout.paginate(text, font)
+    new_s = time.perf_counter() - start
+
+    old_lines = [line for page in old_pages for line in page]
+    new_lines = [line.text for page in new_pages for line in page]
+    same = sum(a == b for a, b in zip(old_lines, new_lines))
+    print(f"{'método':<10}{'segundos':>10}{'páginas':>9}{'líneas':>9}")
+    print(f"{'anterior':<10}{old_s:>10.2f}{len(old_pages):>9}{len(old_lines):>9}")
+    print(f"{'layout':<10}{new_s:>10.2f}{len(new_pages):>9}{len(new_lines):>9}")
+    print(f"x{old_s / new_s:.0f} más rápido · líneas idénticas: {same / max(len(old_lines), 1):.1%}")
+
+    if args.render:
+        start = time.perf_counter()
+        for lines in old_pages[:args.render]:
+            img = Image.new('RGB', (layout.PAGE_WIDTH, layout.PAGE_HEIGHT), 'white')
+            d = ImageDraw.Draw(img)
+            for n, line in enumerate(lines):
+                d.text((layout.MARGIN, layout.MARGIN + n * layout.LINE_HEIGHT), line, font=font, fill="black")
+        old_r = time.perf_counter() - start
+        start = time.perf_counter()
+        for lines in new_pages[:args.render]:
+            layout.render_page(lines, font)
+        print(f"Pintar {args.render} páginas: anterior {old_r:.2f} s, layout {time.perf_counter() - start:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
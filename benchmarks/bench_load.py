@@ -0,0 +1,312 @@
+"""
+Benchmark: prueba de carga del servidor con el modelo falso
+
+Uso:
+    python benchmarks/bench_load.py --workers 1 2 4 --concurrency 4 16 32 --duration 30
+    python benchmarks/bench_load.py --server flask --concurrency 8      # sin gunicorn
+    python benchmarks/bench_load.py --url http://localhost:5001          # servidor ya arrancado
+
+Arranca `gunicorn app:app` como en el Dockerfile (gthread, --threads hilos por
+worker) en una carpeta temporal, una vez por cada número de workers, con el
+modelo falso (CHAT_MODEL=fake) con la latencia y la proporción de 429 que se
+indiquen. Sube unos documentos de partida y, para cada concurrencia, lanza
+otros tantos usuarios que repiten durante --duration segundos una mezcla de
+peticiones (--mix): get_document, list_documents, save_annotations, upload,
+download (/export_pdf) y ask_chatbot. Muestra el rendimiento (peticiones/s) y
+la latencia p50/p95/p99 por endpoint, los errores y los 429, y al final una
+tabla workers x concurrencia.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import requests
+from PIL import Image, ImageDraw
+import strokes
+
+WORDS = "contrato renta fianza arrendatario cláusula rescisión plazo pago aviso obra".split()
+DEFAULT_MIX = 'get_document=35,list_documents=20,save_annotations=15,ask_chatbot=15,upload=5,download=10'
+SERVER_START_TIMEOUT = 60
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def make_text(paragraphs, tag=''):
+    lines = [tag] if tag else []
+    for n in range(paragraphs):
+        word = WORDS[n % len(WORDS)]
+        lines.append(f"Apartado {n}. El {word} número {n} se rige por lo pactado en el anexo {n}. "
+                     f"La {WORDS[(n * 7) % len(WORDS)]} del apartado {n} vence a los {n % 30 + 1} días.")
+    return '\n\n'.join(lines)
+
+
+def make_png(tag):
+    img = Image.new('RGB', (1240, 1754), 'white')
+    draw = ImageDraw.Draw(img)
+    for y in range(80, 1680, 35):
+        draw.text((60, y), f"{tag} " + ' '.join(WORDS), fill='black')
+    out = BytesIO()
+    img.save(out, 'PNG')
+    return out.getvalue()
+
+
+def make_annotations(rnd, count):
+    anns = []
+    for i in range(count):
+        x, y = rnd.random(), rnd.random()
+        points = [{'x': min(1.0, x + k * 0.003), 'y': min(1.0, y + rnd.gauss(0, 0.002))} for k in range(40)]
+        anns.append({'id': f"a{i}", 'type': rnd.choice(['pen', 'highlighter']), 'page': 0,
+                     'color': '#e91e63', 'size': 3, 'points': points})
+    # Lo que envía el visor: trazos en formato compacto
+    return strokes.compact_all(anns)
+
+
+# ==========================================
+# SERVIDOR
+# ==========================================
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, workers, folder):
+    """Arrancar el servidor en `folder` (uploads y base de datos propios) y esperar a que responda"""
+    port = free_port()
+    env = dict(os.environ, CHAT_MODEL='fake', FAKE_LLM_LATENCY=str(args.latency),
+               FAKE_LLM_429_RATE=str(args.rate_429), FAKE_LLM_TOKEN_DELAY=str(args.token_delay),
+               LLM_RATE_PER_MIN=str(args.llm_rate), LLM_BURST=str(max(1, int(args.llm_rate / 60))),
+               PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    if args.server == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f"127.0.0.1:{port}",
+               '--workers', str(workers), '--worker-class', 'gthread', '--threads', str(args.threads),
+               '--timeout', '120', '--chdir', folder]
+    else:
+        cmd = [sys.executable, '-c', f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    log = open(os.path.join(folder, 'server.log'), 'w')
+    proc = subprocess.Popen(cmd, cwd=folder, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"El servidor no arrancó (ver {log.name})")
+        try:
+            requests.get(f"{url}/list_documents", timeout=1)
+            return proc, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"El servidor no respondió en {SERVER_START_TIMEOUT} s")
+
+
+def seed(url, docs, strokes_per_doc):
+    """Documentos de partida (texto e imagen, alternos) con anotaciones guardadas"""
+    rnd = random.Random(0)
+    seeded = []
+    for n in range(docs):
+        tag = uuid.uuid4().hex[:8]
+        if n % 2:
+            upload = (f"pagina_{n}.png", make_png(tag))
+        else:
+            upload = (f"contrato_{n}.txt", make_text(300, tag).encode('utf-8'))
+        doc_id = requests.post(f"{url}/upload", files={'file': upload}).json()['doc_id']
+        while requests.get(f"{url}/document/{doc_id}/status").json().get('state') not in ('ready', 'failed'):
+            time.sleep(0.1)
+        anns = make_annotations(rnd, strokes_per_doc)
+        requests.post(f"{url}/save_annotations", json={'doc_id': doc_id, 'annotations': anns}).raise_for_status()
+        seeded.append({'id': doc_id, 'annotations': anns})
+    return seeded
+
+
+# ==========================================
+# CARGA
+# ==========================================
+
+class Actions:
+    """Una petición de cada tipo, como las haría el visor"""
+
+    def __init__(self, url, docs, questions, upload_kb):
+        self.url = url
+        self.docs = docs
+        self.questions = questions
+        self.upload_text = make_text(max(1, upload_kb * 1024 // 150))
+
+    def get_document(self, session, rnd):
+        return session.get(f"{self.url}/get_document/{rnd.choice(self.docs)['id']}")
+
+    def list_documents(self, session, rnd):
+        return session.get(f"{self.url}/list_documents")
+
+    def save_annotations(self, session, rnd):
+        doc = rnd.choice(self.docs)
+        return session.post(f"{self.url}/save_annotations", json={'doc_id': doc['id'], 'annotations': doc['annotations']})
+
+    def upload(self, session, rnd):
+        # Contenido único: un duplicado no se procesa y no mediría nada
+        data = f"{uuid.uuid4().hex}\n{self.upload_text}".encode('utf-8')
+        return session.post(f"{self.url}/upload", files={'file': ('carga.txt', data)})
+
+    def download(self, session, rnd):
+        doc = rnd.choice(self.docs)
+        return session.post(f"{self.url}/export_pdf", json={'doc_id': doc['id'], 'annotations': doc['annotations']})
+
+    def ask_chatbot(self, session, rnd):
+        # Preguntas de un conjunto acotado: algunas salen de la caché, como en la realidad
+        question = f"¿Qué vence en el apartado {rnd.randrange(self.questions)}?"
+        return session.post(f"{self.url}/ask_chatbot", json={'doc_id': rnd.choice(self.docs)['id'], 'question': question})
+
+
+def run_load(actions, mix, concurrency, duration):
+    """`concurrency` usuarios durante `duration` s. Devuelve ({endpoint: [(segundos, estado), ...]},
+    segundos reales: las peticiones en curso al acabar el plazo se esperan y cuentan)"""
+    names, weights = zip(*mix)
+    samples = {name: [] for name in names}
+    lock = threading.Lock()
+    started = time.monotonic()
+    stop = started + duration
+
+    def user(n):
+        rnd = random.Random(n)
+        session = requests.Session()
+        while time.monotonic() < stop:
+            name = rnd.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                response = getattr(actions, name)(session, rnd)
+                response.content  # las descargas llegan en streaming: medir hasta el final
+                status = response.status_code
+            except requests.RequestException:
+                status = 0
+            with lock:
+                samples[name].append((time.perf_counter() - start, status))
+
+    threads = [threading.Thread(target=user, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples, time.monotonic() - started
+
+
+def summarize(samples, duration):
+    rows = {}
+    for name, values in samples.items():
+        if not values:
+            continue
+        times = [t for t, _ in values]
+        rows[name] = {
+            'requests': len(values),
+            'rps': len(values) / duration,
+            'p50_ms': percentile(times, 0.50) * 1000,
+            'p95_ms': percentile(times, 0.95) * 1000,
+            'p99_ms': percentile(times, 0.99) * 1000,
+            'errors': sum(1 for _, s in values if s == 0 or s >= 500),
+            'rate_limited': sum(1 for _, s in values if s == 429),
+        }
+    every = [t for values in samples.values() for t, _ in values]
+    if every:
+        rows['TOTAL'] = {
+            'requests': len(every), 'rps': len(every) / duration,
+            'p50_ms': percentile(every, 0.50) * 1000, 'p95_ms': percentile(every, 0.95) * 1000,
+            'p99_ms': percentile(every, 0.99) * 1000,
+            'errors': sum(r['errors'] for r in rows.values()),
+            'rate_limited': sum(r['rate_limited'] for r in rows.values()),
+        }
+    return rows
+
+
+def print_rows(rows):
+    print(f"  {'endpoint':<18}{'peticiones':>11}{'pet/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errores':>9}{'429':>6}")
+    for name, r in rows.items():
+        print(f"  {name:<18}{r['requests']:>11}{r['rps']:>8.1f}{r['p50_ms']:>9.0f}{r['p95_ms']:>9.0f}"
+              f"{r['p99_ms']:>9.0f}{r['errors']:>9}{r['rate_limited']:>6}")
+
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if not hasattr(Actions, name.strip()):
+            raise SystemExit(f"Endpoint desconocido en --mix: {name}")
+        mix.append((name.strip(), float(weight or 1)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=['gunicorn', 'flask'], default='gunicorn',
+                        help='flask: servidor de desarrollo con hilos (un solo proceso, ignora --workers)')
+    parser.add_argument('--url', help='usar un servidor ya arrancado en lugar de arrancar uno')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=8, help='hilos por worker (gthread)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[4, 16, 32])
+    parser.add_argument('--duration', type=float, default=20, help='segundos de carga por combinación')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='pesos por endpoint')
+    parser.add_argument('--docs', type=int, default=6, help='documentos de partida')
+    parser.add_argument('--strokes', type=int, default=50, help='trazos por documento (guardados y exportados)')
+    parser.add_argument('--upload-kb', type=int, default=20, help='tamaño de cada TXT subido')
+    parser.add_argument('--questions', type=int, default=50, help='preguntas distintas (el resto, caché)')
+    parser.add_argument('--latency', type=float, default=0.5, help='segundos que tarda el modelo falso')
+    parser.add_argument('--token-delay', type=float, default=0.0, help='segundos entre palabras del modelo falso')
+    parser.add_argument('--rate-429', type=float, default=0.05, help='fracción de llamadas al modelo con 429')
+    parser.add_argument('--llm-rate', type=float, default=6000, help='LLM_RATE_PER_MIN del servidor')
+    parser.add_argument('--json', metavar='FICHERO', help='guardar los resultados en JSON')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    worker_counts = [None] if args.url else (args.workers if args.server == 'gunicorn' else [1])
+    results = []
+    for workers in worker_counts:
+        folder = tempfile.mkdtemp(prefix='bench_load_')
+        proc = None
+        try:
+            if args.url:
+                url = args.url.rstrip('/')
+            else:
+                proc, url = start_server(args, workers, folder)
+            label = f"{workers} workers x {args.threads} hilos" if args.server == 'gunicorn' and workers else url
+            docs = seed(url, args.docs, args.strokes)
+            actions = Actions(url, docs, args.questions, args.upload_kb)
+            for concurrency in args.concurrency:
+                rows = summarize(*run_load(actions, mix, concurrency, args.duration))
+                print(f"\n{label}, {concurrency} usuarios, {args.duration:.0f} s "
+                      f"(modelo: {args.latency} s, {args.rate_429:.0%} de 429)")
+                print_rows(rows)
+                results.append({'workers': workers, 'concurrency': concurrency, 'endpoints': rows})
+        finally:
+            if proc:
+                proc.terminate()
+                proc.wait(timeout=30)
+            shutil.rmtree(folder, ignore_errors=True)
+
+    print(f"\n{'workers':<9}{'usuarios':>9}{'pet/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errores':>9}")
+    for r in results:
+        total = r['endpoints'].get('TOTAL')
+        if total:
+            print(f"{str(r['workers'] or '-'):<9}{r['concurrency']:>9}{total['rps']:>9.1f}{total['p50_ms']:>9.0f}"
+                  f"{total['p95_ms']:>9.0f}{total['p99_ms']:>9.0f}{total['errors']:>9}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark: coste de las métricas de Prometheus
+
+Uso:
+    python benchmarks/bench_metrics.py --requests 5000
+
+Compara la misma ruta mínima de Flask con y sin metrics.init_app (lo que añade
+cada petición: ganchos, histograma y contadores), mide observe() y stage()
+sueltos, que es lo que pagan las etapas del procesamiento, y cuánto tarda en
+generarse /metrics con muchas series.
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, jsonify
+
+import metrics
+
+
+def make_app(instrumented):
+    app = Flask(__name__)
+
+    @app.route('/ping/<doc_id>')
+    def ping(doc_id):
+        return jsonify({'success': True, 'doc_id': doc_id})
+
+    if instrumented:
+        metrics.init_app(app)
+    return app
+
+
+def per_request(app, count):
+    client = app.test_client()
+    start = time.perf_counter()
+    for i in range(count):
+        client.get(f'/ping/{i % 50}')
+    return (time.perf_counter() - start) / count
+
+
+def per_call(fn, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if not metrics.METRICS_ENABLED:
+        sys.exit("METRICS_ENABLED=0: no hay nada que medir")
+
+    plain, instrumented = make_app(False), make_app(True)
+    per_request(plain, 200)
+    per_request(instrumented, 200)
+    # Alternadas, para que el ruido de la máquina caiga igual en las dos
+    runs = {plain: [], instrumented: []}
+    for _ in range(args.repeat):
+        for app in runs:
+            runs[app].append(per_request(app, args.requests))
+    base, measured = statistics.median(runs[plain]), statistics.median(runs[instrumented])
+    print(f"{'petición':<28}{'µs':>10}")
+    print(f"{'sin métricas':<28}{base * 1e6:>10.1f}")
+    print(f"{'con métricas':<28}{measured * 1e6:>10.1f}   (+{(measured - base) * 1e6:.1f} µs, "
+          f"{(measured - base) / base * 100:+.1f}%)")
+
+    def staged():
+        with metrics.stage('bench'):
+            pass
+
+    observe = per_call(lambda: metrics.observe_stage('bench', 0.01), args.requests * 10)
+    stage = per_call(staged, args.requests * 10)
+    print(f"{'observe_stage()':<28}{observe * 1e6:>10.2f}")
+    print(f"{'with stage()':<28}{stage * 1e6:>10.2f}")
+
+    # Muchas series: un endpoint por ruta y método, como en la aplicación real
+    for i in range(60):
+        metrics.REQUEST_SECONDS.observe(0.01, endpoint=f"ruta_{i}", method='GET')
+        metrics.REQUESTS.inc(endpoint=f"ruta_{i}", method='GET', status=200)
+    text = metrics.render()
+    scrape = per_call(metrics.render, 50)
+    print(f"Generar /metrics: {scrape * 1000:.2f} ms ({len(text.splitlines())} líneas, {len(text) // 1024} KB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Benchmark: escalado del OCR y del rasterizado con el número de workers
+
+Uso:
+    python benchmarks/bench_ocr.py --pages 32 --workers 1 2 4 8 16
+
+Genera páginas sintéticas "escaneadas" (imágenes con texto) y un PDF sin capa
+de texto, y mide páginas/segundo con 1..N procesos de OCR y 1..N hilos de
+pdftoppm. Necesita tesseract y poppler instalados.
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFont
+import ocr
+
+LOREM = ("El arrendatario se obliga a pagar la renta pactada dentro de los cinco "
+         "primeros días de cada mes. The tenant shall pay the agreed rent within "
+         "the first five days of each month. ")
+
+
+def make_page(n, size=(1240, 1754)):
+    img = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(img)
+    try: font = ImageFont.truetype("arial.ttf", 24)
+    except: font = ImageFont.load_default()
+    y = 60
+    text = f"Página {n + 1}. " + LOREM * 40
+    while text and y < size[1] - 60:
+        draw.text((60, y), text[:80], fill='black', font=font)
+        text = text[80:]
+        y += 35
+    return img
+
+
+def bench_ocr(paths, workers):
+    # Calentar el pool para no medir el arranque de los procesos
+    ocr.get_pool(workers).submit(sum, [0]).result()
+    start = time.perf_counter()
+    batch = ocr.OcrBatch(workers=workers)
+    for i, p in enumerate(paths):
+        batch.submit(i, p)
+    texts = batch.results()
+    elapsed = time.perf_counter() - start
+    assert all(t is not None for t in texts.values()), "OCR fallido (¿tesseract instalado?)"
+    return elapsed
+
+
+def bench_raster(pdf_path, num_pages, threads):
+    start = time.perf_counter()
+    n = sum(1 for _ in ocr.rasterize_pdf(pdf_path, num_pages, dpi=150, thread_count=threads))
+    assert n == num_pages
+    return time.perf_counter() - start
+
+
+def report(title, pages, timings):
+    print(f"\n{title}")
+    print(f"{'workers':>8} {'segundos':>10} {'pág/s':>8} {'speedup':>8}")
+    base = timings[0][1]
+    for workers, t in timings:
+        print(f"{workers:>8} {t:>10.2f} {pages / t:>8.2f} {base / t:>8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=32)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument('--skip-raster', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = [make_page(i) for i in range(args.pages)]
+        paths = []
+        for i, img in enumerate(images):
+            paths.append(os.path.join(tmp, f"page_{i}.png"))
+            img.save(paths[-1])
+
+        report(f"OCR de {args.pages} páginas", args.pages,
+               [(w, bench_ocr(paths, w)) for w in args.workers])
+
+        if not args.skip_raster:
+            pdf_path = os.path.join(tmp, 'scan.pdf')
+            images[0].save(pdf_path, 'PDF', resolution=150.0, save_all=True, append_images=images[1:])
+            report(f"Rasterizado de {args.pages} páginas (thread_count)", args.pages,
+                   [(w, bench_raster(pdf_path, args.pages, w)) for w in args.workers])
+
+
+if __name__ == '__main__':
+    main()
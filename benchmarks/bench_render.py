@@ -0,0 +1,133 @@
+"""
+Benchmark: pintado de anotaciones en páginas densas, anterior frente a render.py
+
+Uso:
+    python benchmarks/bench_render.py --highlights 200 --pen 100 --texts 20 --pages 5
+
+El pintado anterior compone una capa de página entera por cada trazo de
+resaltador y carga la fuente en cada nota de texto; render.py acumula cada
+tramo consecutivo de resaltados o de lápiz en una capa y la compone una vez
+(en orden mezclado hay más tramos y más composiciones). Mide el
+tiempo por página y compara los píxeles de ambas salidas: diferencia máxima,
+error medio y porcentaje de píxeles que difieren más de --tolerance.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageStat
+import render
+
+LOREM = "El arrendatario se obliga a pagar la renta pactada dentro de los cinco primeros días de cada mes."
+
+
+def legacy_process_annotations_on_image(img, annotations, page_index):
+    """utils.process_annotations_on_image tal como estaba"""
+    img = img.convert('RGBA')
+    draw = ImageDraw.Draw(img, 'RGBA')
+    width, height = img.size
+    page_anns = [a for a in annotations if a.get('page', 0) == page_index]
+    for ann in page_anns:
+        color_hex = ann.get('color', '#000000')
+        try: color_rgb = tuple(int(color_hex.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
+        except: color_rgb = (0,0,0)
+        size = int(ann.get('size', 3)) * 2
+        if ann['type'] == 'text':
+            x, y = int(ann['x'] * width), int(ann['y'] * height)
+            try: font_ann = ImageFont.truetype("arial.ttf", size * 10)
+            except: font_ann = ImageFont.load_default()
+            draw.text((x, y), ann['text'], fill=color_rgb + (255,), font=font_ann)
+        elif 'points' in ann:
+            points = ann['points']
+            if len(points) > 1:
+                abs_points = [(p['x'] * width, p['y'] * height) for p in points]
+                if ann['type'] == 'highlighter':
+                    overlay = Image.new('RGBA', img.size, (0,0,0,0))
+                    d_over = ImageDraw.Draw(overlay)
+                    d_over.line(abs_points, fill=color_rgb + (40,), width=size * 3)
+                    img = Image.alpha_composite(img, overlay)
+                    draw = ImageDraw.Draw(img, 'RGBA')
+                else:
+                    op = 255 if ann['type'] == 'pen' else 200
+                    draw.line(abs_points, fill=color_rgb + (op,), width=size, joint='curve')
+    return img.convert('RGB')
+
+
+def make_page(size=(1654, 2339)):
+    img = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(img)
+    for y in range(80, size[1] - 80, 40):
+        draw.text((80, y), LOREM, fill='black')
+    return img
+
+
+def make_annotations(rnd, pages, highlights, pen, texts, ordered):
+    """Anotaciones densas por página. Con `ordered`, los resaltados van antes que el lápiz"""
+    anns = []
+    colors = ['#ffeb3b', '#e91e63', '#4caf50', '#2196f3', '#000000']
+    for page in range(pages):
+        page_anns = []
+        for _ in range(highlights):
+            y = rnd.random()
+            x = rnd.random() * 0.7
+            page_anns.append({'type': 'highlighter', 'page': page, 'color': rnd.choice(colors), 'size': rnd.randint(2, 5),
+                              'points': [{'x': x + i * 0.02, 'y': y + rnd.uniform(-0.001, 0.001)} for i in range(12)]})
+        for _ in range(pen):
+            x, y = rnd.random(), rnd.random()
+            page_anns.append({'type': 'pen', 'page': page, 'color': rnd.choice(colors), 'size': rnd.randint(1, 4),
+                              'points': [{'x': x + rnd.uniform(-0.05, 0.05), 'y': y + rnd.uniform(-0.05, 0.05)} for _ in range(20)]})
+        for _ in range(texts):
+            page_anns.append({'type': 'text', 'page': page, 'color': rnd.choice(colors), 'size': rnd.randint(1, 3),
+                              'x': rnd.random() * 0.8, 'y': rnd.random() * 0.95, 'text': 'Revisar esta cláusula'})
+        if not ordered:
+            rnd.shuffle(page_anns)
+        anns.extend(page_anns)
+    return anns
+
+
+def compare(a, b, tolerance):
+    diff = ImageChops.difference(a, b)
+    gray = diff.convert('L')
+    over = sum(gray.histogram()[tolerance + 1:])
+    return max(hi for _, hi in diff.getextrema()), sum(ImageStat.Stat(diff).mean) / 3, over / (a.width * a.height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--highlights', type=int, default=200, help='trazos de resaltador por página')
+    parser.add_argument('--pen', type=int, default=100, help='trazos de lápiz por página')
+    parser.add_argument('--texts', type=int, default=20, help='notas de texto por página')
+    parser.add_argument('--tolerance', type=int, default=8, help='diferencia por píxel (0-255) aceptada')
+    args = parser.parse_args()
+
+    base = make_page()
+    print(f"{args.pages} páginas {base.width}x{base.height}: {args.highlights} resaltados, "
+          f"{args.pen} trazos de lápiz y {args.texts} notas por página")
+    print(f"{'orden':<12}{'anterior s/pág':>16}{'nuevo s/pág':>13}{'máx dif':>9}{'dif media':>11}{'píxeles > tol':>15}")
+    for ordered in (True, False):
+        anns = make_annotations(random.Random(0), args.pages, args.highlights, args.pen, args.texts, ordered)
+        old_s = new_s = 0.0
+        worst = (0, 0.0, 0.0)
+        for page in range(args.pages):
+            start = time.perf_counter()
+            old = legacy_process_annotations_on_image(base, anns, page)
+            old_s += time.perf_counter() - start
+            start = time.perf_counter()
+            by_page = render.annotations_by_page(anns)
+            new = render.render_annotations(base, by_page.get(page, []))
+            new_s += time.perf_counter() - start
+            result = compare(old, new, args.tolerance)
+            worst = tuple(max(a, b) for a, b in zip(worst, result))
+        label = 'resaltado 1º' if ordered else 'mezclado'
+        print(f"{label:<12}{old_s / args.pages:>16.3f}{new_s / args.pages:>13.3f}{worst[0]:>9}"
+              f"{worst[1]:>11.3f}{worst[2]:>15.3%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark: índice de búsqueda con muchas páginas
+
+Uso:
+    python benchmarks/bench_search.py --pages 100000 --words 250
+
+Indexa documentos sintéticos de 50 páginas (vocabulario con distribución tipo
+Zipf, como el texto real) en un SQLite temporal y mide el ritmo de indexado y
+la latencia (p50/p95) de consultas con términos raros, frecuentes y mixtos.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import itertools
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import search
+
+COMMON = ("contrato arrendatario arrendador renta pago mes plazo cláusula partes obligación "
+          "tenant landlord rent payment agreement clause party notice term").split()
+RARE = ["rescisión", "indemnización", "subarriendo", "fianza", "arbitraje", "termination", "escrow"]
+QUERIES = ["rescisión", "cláusula de rescisión", "renta", "contrato renta pago", "termination clause",
+           "fianza arbitraje", "palabra123"]
+
+
+def make_vocabulary(size, rnd):
+    letters = 'abcdefghijklmnopqrstuvwxyzáéíóñ'
+    words = COMMON + [''.join(rnd.choice(letters) for _ in range(rnd.randint(4, 10))) for _ in range(size)]
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(words))))
+    return words, cum_weights
+
+
+def make_page(rnd, words, cum_weights, n):
+    page = rnd.choices(words, cum_weights=cum_weights, k=n)
+    if rnd.random() < 0.01:
+        page[rnd.randrange(n)] = rnd.choice(RARE)
+    return ' '.join(page)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=20000)
+    parser.add_argument('--words', type=int, default=250, help='palabras por página')
+    parser.add_argument('--vocabulary', type=int, default=30000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    words, cum_weights = make_vocabulary(args.vocabulary, rnd)
+    with tempfile.TemporaryDirectory() as tmp:
+        index = search.SearchIndex(os.path.join(tmp, 'search.db'))
+        elapsed = 0
+        for doc in range(0, args.pages, 50):
+            pages = [make_page(rnd, words, cum_weights, args.words) for _ in range(min(50, args.pages - doc))]
+            start = time.perf_counter()
+            index.index_pages(f"doc{doc}", pages)
+            elapsed += time.perf_counter() - start
+        size_mb = os.path.getsize(os.path.join(tmp, 'search.db')) / 1024 / 1024
+        print(f"Indexadas {args.pages} páginas en {elapsed:.1f} s ({args.pages / elapsed:.0f} pág/s), "
+              f"índice de {size_mb:.0f} MB")
+
+        print(f"{'consulta':<24}{'resultados':>11}{'p50 ms':>9}{'p95 ms':>9}")
+        for query in QUERIES:
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                results, total = index.search(query, limit=20)
+                times.append((time.perf_counter() - start) * 1000)
+            print(f"{query:<24}{total:>11}{percentile(times, 0.5):>9.1f}{percentile(times, 0.95):>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
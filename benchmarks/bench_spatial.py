@@ -0,0 +1,87 @@
+"""
+Benchmark: índice espacial de las anotaciones
+
+Uso:
+    python benchmarks/bench_spatial.py --pages 200 --strokes 20000
+
+Reparte N trazos compactos entre las páginas de un documento y compara el
+recorrido de la lista entera (lo que se hacía para cada página o zona) con las
+consultas a spatial.AnnotationIndex: una página completa, la zona visible de
+una página con zoom x4 y un toque del borrador. Mide también construir el
+índice y mantenerlo con un guardado incremental frente a rehacerlo.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import spatial
+import strokes
+
+
+def make_annotations(rnd, pages, count):
+    anns = []
+    for i in range(count):
+        x, y = rnd.random(), rnd.random()
+        points = []
+        for _ in range(40):
+            x = min(1.0, max(0.0, x + rnd.gauss(0, 0.004)))
+            y = min(1.0, max(0.0, y + rnd.gauss(0, 0.004)))
+            points.append({'x': x, 'y': y})
+        anns.append(strokes.compact({'id': f"a{i}", 'type': rnd.choice(['pen', 'highlighter']),
+                                     'page': rnd.randrange(pages), 'color': '#e91e63', 'size': 3, 'points': points}))
+    return anns
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--strokes', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    anns = make_annotations(rnd, args.pages, args.strokes)
+    page = args.pages // 2
+    viewport = (0.4, 0.4, 0.65, 0.65)
+    touch = (0.5 - 0.05, 0.5 - 0.05, 0.5 + 0.05, 0.5 + 0.05)
+
+    build, index = timed(lambda: spatial.AnnotationIndex(anns), 3)
+    print(f"{args.strokes} trazos en {args.pages} páginas; construir el índice: {build * 1000:.0f} ms")
+
+    # Sin índice: filtrar por página y, para una zona, calcular la caja de cada trazo de la página
+    def scan(rect):
+        return [a for a in anns if a['page'] == page
+                and (rect is None or (spatial.bbox(a) and spatial.intersects(spatial.bbox(a), rect)))]
+
+    print(f"{'consulta':<22}{'recorrido (ms)':>16}{'índice (ms)':>14}{'resultado':>11}")
+    for label, rect in (('página entera', None), ('zona visible x4', viewport), ('borrador', touch)):
+        linear, expected = timed(lambda: scan(rect), args.repeat)
+        indexed, found = timed(lambda: index.query((page, page), rect), args.repeat)
+        assert [a['id'] for a in found] == [a['id'] for a in expected]
+        print(f"{label:<22}{linear * 1000:>16.2f}{indexed * 1000:>14.3f}{len(found):>11}")
+
+    add = make_annotations(random.Random(1), args.pages, 5)
+    for i, ann in enumerate(add):
+        ann['id'] = f"nuevo{i}"
+    remove = [a['id'] for a in rnd.sample(anns, 5)]
+    patch, _ = timed(lambda: index.apply(add, remove), 1)
+    print(f"Guardado incremental (+5 / -5): {patch * 1000:.2f} ms frente a {build * 1000:.0f} ms rehaciendo el índice")
+
+
+if __name__ == '__main__':
+    main()
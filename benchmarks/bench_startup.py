@@ -0,0 +1,117 @@
+"""
+Benchmark: arranque de un worker (importación y primera petición)
+
+Uso:
+    python benchmarks/bench_startup.py --runs 5
+    python benchmarks/bench_startup.py --compare HEAD~1 --gemini
+
+Cada medida es un proceso nuevo, como un worker de gunicorn al (re)arrancar:
+importar el módulo (utils, routes con register_routes, o app) y servir la
+primera petición (GET /list_documents) con el cliente de pruebas de Flask, en
+una carpeta temporal propia. Con --compare se mide también el código de otra
+revisión de git (extraído con git archive) para ver la diferencia. Con --gemini
+se define una GEMINI_API_KEY falsa: la búsqueda de modelos se lanza como en
+producción (sin red, la versión que la hacía al arrancar espera a que falle).
+"""
+
+import io
+import os
+import sys
+import json
+import shutil
+import tarfile
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r'''
+import os, sys, time, json
+start = time.perf_counter()
+root, target = sys.argv[1], sys.argv[2]
+sys.path.insert(0, root)
+if target == 'utils':
+    import utils
+    imported = time.perf_counter()
+    print(json.dumps({'import': imported - start}))
+    os._exit(0)
+if target == 'app':
+    import app as module
+    flask_app = module.app
+else:
+    from flask import Flask
+    import routes
+    flask_app = Flask('bench', root_path=root)
+    flask_app.config['UPLOAD_FOLDER'] = 'uploads'
+    os.makedirs('uploads', exist_ok=True)
+    routes.register_routes(flask_app)
+imported = time.perf_counter()
+status = flask_app.test_client().get('/list_documents').status_code
+done = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_request': done - start, 'status': status}))
+os._exit(0)
+'''
+
+
+def measure(root, target, env, timeout):
+    """Segundos de importación y hasta la primera respuesta en un proceso nuevo"""
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    try:
+        out = subprocess.run([sys.executable, '-c', CHILD, root, target], cwd=workdir, env=env,
+                             capture_output=True, text=True, timeout=timeout)
+        lines = [l for l in out.stdout.splitlines() if l.startswith('{')]
+        if not lines:
+            raise RuntimeError(f"{target} no arrancó:\n{out.stderr[-2000:]}")
+        return json.loads(lines[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def extract(ref, into):
+    """Código de la revisión `ref` en `into` (git archive)"""
+    archive = subprocess.run(['git', '-C', ROOT, 'archive', '--format=tar', ref], capture_output=True, check=True)
+    with tarfile.open(fileobj=io.BytesIO(archive.stdout)) as tar:
+        tar.extractall(into)
+    return into
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--targets', nargs='+', default=['utils', 'routes', 'app'], choices=['utils', 'routes', 'app'])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--compare', metavar='REF', help='revisión de git con la que comparar (p. ej. HEAD~1)')
+    parser.add_argument('--gemini', action='store_true', help='GEMINI_API_KEY falsa: incluye la búsqueda de modelos')
+    parser.add_argument('--timeout', type=float, default=180)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.pop('CHAT_MODEL', None)
+    if args.gemini:
+        env['GEMINI_API_KEY'] = 'clave-falsa-del-benchmark'
+    else:
+        env.pop('GEMINI_API_KEY', None)
+
+    trees = [('actual', ROOT)]
+    scratch = tempfile.mkdtemp(prefix='bench_startup_ref_')
+    try:
+        if args.compare:
+            trees.insert(0, (args.compare, extract(args.compare, scratch)))
+        print(f"{'código':<12}{'módulo':<10}{'importar (ms)':>15}{'1ª petición (ms)':>19}")
+        for label, root in trees:
+            # Una pasada sin medir: los .pyc y la caché del sistema de ficheros quedan igual para todos
+            for target in args.targets:
+                measure(root, target, env, args.timeout)
+            for target in args.targets:
+                runs = [measure(root, target, env, args.timeout) for _ in range(args.runs)]
+                imported = statistics.median(r['import'] for r in runs) * 1000
+                first = [r['first_request'] for r in runs if 'first_request' in r]
+                first = f"{statistics.median(first) * 1000:>19.0f}" if first else f"{'-':>19}"
+                print(f"{label:<12}{target:<10}{imported:>15.0f}{first}")
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark: formato compacto de los trazos
+
+Uso:
+    python benchmarks/bench_strokes.py --strokes 500 --points 300
+
+Genera trazos como los que captura el visor (una muestra del puntero cada
+~16 ms sobre curvas con algo de temblor) en el formato antiguo con
+`points` y compara con el formato compacto que se guarda ahora: bytes del JSON
+de las anotaciones, puntos tras la simplificación y tiempo de pintado en
+render.render_annotations (imagen) y export.draw_annotations (PDF vectorial).
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+import render
+import export
+import strokes
+
+
+def make_stroke(rnd, n, i):
+    """Curva suave recorrida a velocidad variable con ruido de ~0,5 px en una página de 1240 px"""
+    x, y = rnd.uniform(0.1, 0.9), rnd.uniform(0.1, 0.9)
+    angle = rnd.uniform(0, 2 * math.pi)
+    turn = rnd.uniform(-0.05, 0.05)
+    points = []
+    for _ in range(n):
+        angle += turn + rnd.gauss(0, 0.02)
+        step = 0.0015 * (1 + 0.5 * math.sin(len(points) / 15))
+        x = min(1.0, max(0.0, x + math.cos(angle) * step))
+        y = min(1.0, max(0.0, y + math.sin(angle) * step))
+        points.append({'x': x + rnd.gauss(0, 0.0004), 'y': y + rnd.gauss(0, 0.0004)})
+    return {'id': f"a{i}", 'type': rnd.choice(['pen', 'highlighter']), 'page': 0,
+            'color': '#e91e63', 'size': 3, 'points': points}
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def draw_pdf(annotations):
+    from reportlab.pdfgen import canvas
+    c = canvas.Canvas(BytesIO(), pagesize=(595, 842))
+    export.draw_annotations(c, annotations, 595, 842)
+    c.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--strokes', type=int, default=500)
+    parser.add_argument('--points', type=int, default=300, help='muestras del puntero por trazo')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    old = [make_stroke(rnd, args.points, i) for i in range(args.strokes)]
+    start = time.perf_counter()
+    new = strokes.compact_all(old)
+    compact_time = time.perf_counter() - start
+    raw = strokes.compact_all(old, tolerance=0)
+
+    old_json, raw_json, new_json = (len(json.dumps(a, separators=(',', ':'))) for a in (old, raw, new))
+    kept = sum(len(strokes.quantized(a)) // 2 for a in new)
+    total = args.strokes * args.points
+    print(f"{args.strokes} trazos x {args.points} puntos, tolerancia {strokes.STROKE_TOLERANCE}")
+    print(f"JSON antiguo:               {old_json / 1024:>9.0f} KB")
+    print(f"Compacto sin simplificar:   {raw_json / 1024:>9.0f} KB ({raw_json / old_json:.1%})")
+    print(f"Compacto simplificado:      {new_json / 1024:>9.0f} KB ({new_json / old_json:.1%})")
+    print(f"Puntos: {kept} de {total} ({kept / total:.1%}); compactar: {compact_time * 1000:.0f} ms")
+
+    page = Image.new('RGB', (1240, 1754), 'white')
+    print(f"{'':<28}{'antiguo':>10}{'compacto':>10}")
+    img_old = timed(lambda: render.render_annotations(page, old), args.repeat)
+    img_new = timed(lambda: render.render_annotations(page, new), args.repeat)
+    print(f"{'render_annotations (s)':<28}{img_old:>10.3f}{img_new:>10.3f}")
+    pdf_old = timed(lambda: draw_pdf(old), args.repeat)
+    pdf_new = timed(lambda: draw_pdf(new), args.repeat)
+    print(f"{'draw_annotations (s)':<28}{pdf_old:>10.3f}{pdf_new:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
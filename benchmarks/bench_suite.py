@@ -0,0 +1,435 @@
+"""
+Benchmark: batería de los caminos críticos (ingesta, maquetación, pintado, guardado y exportación)
+
+Uso:
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --save-baseline baseline.json
+    python benchmarks/bench_suite.py --baseline baseline.json --only ingest_txt export_image
+
+Genera los ficheros de prueba en una carpeta temporal (PDF de N páginas con y
+sin capa de texto, TXT y DOCX grandes, páginas con muchas anotaciones) y mide
+cada etapa en un proceso aparte, a través del cliente de pruebas de Flask
+(app.py sobre un SQLite temporal) o llamando directamente a las funciones.
+Por etapa: mediana del tiempo real y del tiempo de CPU del proceso (sin los
+procesos de OCR) y pico de memoria (RSS) durante la etapa. La caché de páginas
+pintadas se desactiva: se mide el trabajo, no la caché.
+
+Con --baseline compara con unos resultados guardados antes con --save-baseline
+(mismas opciones y misma máquina) y termina con código 1 si alguna etapa empeora
+más que los umbrales: --max-slowdown en tiempo real y CPU, --max-rss-growth en
+memoria, ignorando las diferencias menores que --min-delta-ms / --min-delta-mb.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import statistics
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+
+WORDS = ("el arrendatario se obliga a pagar la renta pactada dentro de los cinco primeros días "
+         "de cada mes the tenant shall pay agreed rent within first five days of each month "
+         "contrato cláusula vigencia prórroga fianza inmueble suministros").split()
+# Palabras por página con la maquetación de layout.py (para dar con N páginas de texto)
+WORDS_PER_PAGE = 1300
+STATUS_POLL_SECONDS = 0.02
+
+
+# ==========================================
+# FICHEROS DE PRUEBA
+# ==========================================
+
+def make_text(rnd, words, tag=''):
+    paragraphs = [tag] if tag else []
+    while words > 0:
+        n = min(words, rnd.randint(20, 200))
+        paragraphs.append(' '.join(rnd.choice(WORDS) for _ in range(n)) + '.')
+        words -= n
+    return '\n'.join(paragraphs)
+
+
+def make_page_image(n, size=(1240, 1754)):
+    """Página escaneada: solo imagen, sin capa de texto"""
+    img = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(img)
+    for y in range(80, size[1] - 80, 35):
+        draw.text((60, y), f"{n + 1} " + ' '.join(WORDS[:14]), fill='black')
+    return img
+
+
+def make_pdf(path, pages, text_layer, tag):
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
+
+    c = canvas.Canvas(path, pagesize=A4)
+    # El título cambia el contenido: cada repetición es un fichero nuevo, no un duplicado
+    c.setTitle(tag)
+    scan = None if text_layer else ImageReader(make_page_image(0))
+    for n in range(pages):
+        if text_layer:
+            y = 800
+            c.drawString(50, y, f"Página {n + 1}")
+            while y > 60:
+                y -= 14
+                c.drawString(50, y, ' '.join(WORDS[:16]))
+        else:
+            c.drawImage(scan, 0, 0, *A4)
+        c.showPage()
+    c.save()
+
+
+def make_docx(path, text):
+    import docx
+    doc = docx.Document()
+    for paragraph in text.split('\n'):
+        doc.add_paragraph(paragraph)
+    doc.save(path)
+
+
+def make_annotations(rnd, pages, per_page, points=60):
+    """Trazos densos (como los captura el visor) y alguna nota, ya en formato compacto"""
+    import strokes
+    anns = []
+    for page in range(pages):
+        for s in range(per_page):
+            x, y = rnd.random(), rnd.random()
+            pts = []
+            for _ in range(points):
+                x = min(1.0, max(0.0, x + rnd.gauss(0, 0.004)))
+                y = min(1.0, max(0.0, y + rnd.gauss(0, 0.004)))
+                pts.append({'x': x, 'y': y})
+            anns.append({'id': f"{page}-{s}", 'type': rnd.choice(['pen', 'highlighter']), 'page': page,
+                         'color': '#e53935', 'size': 3, 'points': pts})
+        anns.append({'id': f"{page}-t", 'type': 'text', 'page': page, 'color': '#1e88e5', 'size': 2,
+                     'x': 0.1, 'y': 0.1, 'text': 'Revisar esta cláusula'})
+    return strokes.compact_all(anns)
+
+
+def make_fixtures(folder, options):
+    """Todos los ficheros, generados una vez; las etapas de subida usan uno distinto por repetición"""
+    rnd = random.Random(0)
+    pages, repeat = options['pages'], options['repeat']
+    fixtures = {'pdf_text': [], 'pdf_scan': [], 'txt': [], 'docx': [], 'png': []}
+    big_words = int(options['text_mb'] * 1024 * 1024 / 7)
+    big_text = make_text(rnd, big_words)
+    for i in range(repeat + 1):
+        tag = f"bench-suite-{i}"
+        for kind, text_layer in (('pdf_text', True), ('pdf_scan', False)):
+            path = os.path.join(folder, f"{kind}_{i}.pdf")
+            make_pdf(path, pages, text_layer, tag)
+            fixtures[kind].append(path)
+        path = os.path.join(folder, f"big_{i}.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(tag + '\n' + big_text)
+        fixtures['txt'].append(path)
+        path = os.path.join(folder, f"big_{i}.docx")
+        make_docx(path, tag + '\n' + big_text)
+        fixtures['docx'].append(path)
+        path = os.path.join(folder, f"page_{i}.png")
+        img = make_page_image(i)
+        img.putpixel((0, 0), (i % 256, 0, 0))
+        img.save(path)
+        fixtures['png'].append(path)
+
+    fixtures['page_text'] = os.path.join(folder, 'pages.txt')
+    with open(fixtures['page_text'], 'w', encoding='utf-8') as f:
+        f.write(make_text(rnd, pages * WORDS_PER_PAGE))
+    fixtures['annotations'] = os.path.join(folder, 'annotations.json')
+    with open(fixtures['annotations'], 'w') as f:
+        json.dump(make_annotations(rnd, pages, options['strokes']), f)
+    return fixtures
+
+
+# ==========================================
+# ETAPAS
+# ==========================================
+
+class Context:
+    """Lo que necesita una etapa: opciones, ficheros y el cliente de Flask (se importa app.py al pedirlo)"""
+
+    def __init__(self, options, fixtures):
+        self.options = options
+        self.fixtures = fixtures
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import app
+            self._client = app.app.test_client()
+        return self._client
+
+    def annotations(self):
+        with open(self.fixtures['annotations']) as f:
+            return json.load(f)
+
+    def text(self, key):
+        with open(self.fixtures[key], encoding='utf-8') as f:
+            return f.read()
+
+    def upload(self, path):
+        """Subir y esperar a que termine el procesamiento en segundo plano"""
+        with open(path, 'rb') as f:
+            data = self.client.post('/upload', data={'file': (f, os.path.basename(path))}).get_json()
+        if not data.get('success'):
+            raise RuntimeError(f"Subida fallida: {data.get('error')}")
+        while True:
+            status = self.client.get(f"/document/{data['doc_id']}/status").get_json()
+            if status.get('state') == 'ready':
+                return data['doc_id']
+            if status.get('state') == 'failed':
+                raise RuntimeError(f"Procesamiento fallido: {status.get('error')}")
+            time.sleep(STATUS_POLL_SECONDS)
+
+    def post(self, url, payload):
+        response = self.client.post(url, json=payload)
+        # Las exportaciones salen en streaming: leer el cuerpo entero es parte de la medida
+        body = response.get_data()
+        if response.status_code != 200 or response.mimetype == 'application/json' and not json.loads(body).get('success'):
+            raise RuntimeError(f"{url}: {response.status_code} {body[:200]!r}")
+        return body
+
+
+STAGES = {}
+
+
+def stage(name, mode, description):
+    def register(setup):
+        STAGES[name] = (mode, description, setup)
+        return setup
+    return register
+
+
+# Cada etapa prepara lo que no se mide y devuelve la función que se cronometra (recibe la repetición)
+
+@stage('ingest_pdf_text', 'cliente', 'subir un PDF de N páginas con capa de texto hasta que está listo')
+def ingest_pdf_text(ctx):
+    ctx.upload(ctx.fixtures['pdf_text'][-1])  # calentar: importaciones, pools, fuentes
+    return lambda i: ctx.upload(ctx.fixtures['pdf_text'][i])
+
+
+@stage('ingest_pdf_scan', 'cliente', 'subir un PDF de N páginas escaneadas (sin capa de texto)')
+def ingest_pdf_scan(ctx):
+    ctx.upload(ctx.fixtures['pdf_scan'][-1])
+    return lambda i: ctx.upload(ctx.fixtures['pdf_scan'][i])
+
+
+@stage('ingest_txt', 'cliente', 'subir un TXT grande')
+def ingest_txt(ctx):
+    ctx.upload(ctx.fixtures['txt'][-1])
+    return lambda i: ctx.upload(ctx.fixtures['txt'][i])
+
+
+@stage('ingest_docx', 'cliente', 'subir un DOCX grande')
+def ingest_docx(ctx):
+    ctx.upload(ctx.fixtures['docx'][-1])
+    return lambda i: ctx.upload(ctx.fixtures['docx'][i])
+
+
+@stage('layout_text', 'directo', 'utils.create_pages_from_text con N páginas de texto')
+def layout_text(ctx):
+    import utils
+    text = ctx.text('page_text')
+    return lambda i: utils.create_pages_from_text(text)
+
+
+@stage('render_page', 'directo', 'utils.process_annotations_on_image en una página con anotaciones densas')
+def render_page(ctx):
+    import utils
+    img = Image.open(ctx.fixtures['png'][0])
+    img.load()
+    anns = ctx.annotations()
+    return lambda i: utils.process_annotations_on_image(img, anns, 0)
+
+
+@stage('save_annotations', 'cliente', 'POST /save_annotations con las anotaciones densas de N páginas')
+def save_annotations(ctx):
+    doc_id = ctx.upload(ctx.fixtures['pdf_text'][0])
+    anns = ctx.annotations()
+    return lambda i: ctx.post('/save_annotations', {'doc_id': doc_id, 'annotations': anns})
+
+
+@stage('patch_annotations', 'cliente', 'guardado incremental (+5 / -5 trazos) sobre las anotaciones densas')
+def patch_annotations(ctx):
+    doc_id = ctx.upload(ctx.fixtures['pdf_text'][0])
+    anns = ctx.annotations()
+    ctx.post('/save_annotations', {'doc_id': doc_id, 'annotations': anns})
+    version = [ctx.client.get(f"/annotations/{doc_id}").get_json()['version']]
+
+    def run(i):
+        add = [dict(a, id=f"r{i}-{a['id']}") for a in anns[:5]]
+        remove = [a['id'] for a in anns[5 * (i + 1):5 * (i + 2)]]
+        body = ctx.post(f"/annotations/{doc_id}/patch", {'base_version': version[0], 'add': add, 'remove': remove})
+        version[0] = json.loads(body)['version']
+    return run
+
+
+@stage('export_pdf', 'cliente', 'POST /export_pdf de un PDF con anotaciones densas (capa vectorial)')
+def export_pdf(ctx):
+    doc_id = ctx.upload(ctx.fixtures['pdf_text'][0])
+    anns = ctx.annotations()
+    return lambda i: ctx.post('/export_pdf', {'doc_id': doc_id, 'annotations': anns})
+
+
+@stage('export_image', 'cliente', 'POST /export_pdf de una imagen con anotaciones densas (páginas pintadas)')
+def export_image(ctx):
+    doc_id = ctx.upload(ctx.fixtures['png'][0])
+    anns = ctx.annotations()
+    return lambda i: ctx.post('/export_pdf', {'doc_id': doc_id, 'annotations': anns})
+
+
+@stage('export_text', 'directo', 'PDF anotado de N páginas de texto (lo que hace /download_annotated con TXT/DOCX)')
+def export_text(ctx):
+    import export
+    text = ctx.text('page_text')
+    anns = ctx.annotations()
+
+    def run(i):
+        for _ in export.stream_jpeg_pdf(export.cached_pages(export.text_sources(text), anns)):
+            pass
+    return run
+
+
+# ==========================================
+# MEDIDA
+# ==========================================
+
+def _reset_peak_rss():
+    """Reiniciar el pico de RSS del proceso (Linux); si no se puede, se mide el de todo el proceso"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_mb(reset):
+    if reset:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def _run_stage(name, options, fixtures, result):
+    """Preparar y medir una etapa en un proceso limpio, con uploads/ y la base de datos en una carpeta temporal"""
+    work = tempfile.mkdtemp(prefix='bench_suite_')
+    try:
+        os.environ['RENDER_CACHE_MB'] = '0'
+        os.chdir(work)
+        # Los mensajes de progreso de la aplicación no dejarían leer la tabla
+        sys.stdout = open(os.devnull, 'w')
+        ctx = Context(options, fixtures)
+        run = STAGES[name][2](ctx)
+        reset = _reset_peak_rss()
+        walls, cpus = [], []
+        for i in range(options['repeat']):
+            start, cpu = time.perf_counter(), time.process_time()
+            run(i)
+            walls.append(time.perf_counter() - start)
+            cpus.append(time.process_time() - cpu)
+        result.put({'wall_ms': statistics.median(walls) * 1000, 'cpu_ms': statistics.median(cpus) * 1000,
+                    'peak_rss_mb': _peak_rss_mb(reset)})
+    except Exception as e:
+        result.put({'error': f"{type(e).__name__}: {e}"})
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def run_stage(name, options, fixtures):
+    ctx = multiprocessing.get_context('spawn')
+    result = ctx.Queue()
+    proc = ctx.Process(target=_run_stage, args=(name, options, fixtures, result))
+    proc.start()
+    # El proceso deja hilos en segundo plano (miniaturas, cola): basta con el resultado
+    measured = result.get()
+    proc.terminate()
+    proc.join()
+    return measured
+
+
+def compare(results, baseline, args):
+    """Regresiones frente a la línea base: [(etapa, métrica, antes, ahora)]"""
+    regressions = []
+    for name, now in results.items():
+        before = baseline.get('results', {}).get(name)
+        if not before or 'error' in now or 'error' in before:
+            continue
+        for metric, limit, floor in (('wall_ms', args.max_slowdown, args.min_delta_ms),
+                                     ('cpu_ms', args.max_slowdown, args.min_delta_ms),
+                                     ('peak_rss_mb', args.max_rss_growth, args.min_delta_mb)):
+            if now[metric] > before[metric] * (1 + limit) and now[metric] - before[metric] > floor:
+                regressions.append((name, metric, before[metric], now[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=20, help='páginas de los PDF y del texto maquetado')
+    parser.add_argument('--text-mb', type=float, default=1.0, help='tamaño del TXT/DOCX grande')
+    parser.add_argument('--strokes', type=int, default=150, help='trazos por página anotada')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', choices=sorted(STAGES), help='medir solo estas etapas')
+    parser.add_argument('--save-baseline', metavar='JSON', help='guardar los resultados como línea base')
+    parser.add_argument('--baseline', metavar='JSON', help='comparar con esta línea base')
+    parser.add_argument('--max-slowdown', type=float, default=0.15, help='empeoramiento tolerado en tiempo (0.15 = 15%%)')
+    parser.add_argument('--max-rss-growth', type=float, default=0.10, help='crecimiento tolerado del pico de memoria')
+    parser.add_argument('--min-delta-ms', type=float, default=5.0, help='diferencias de tiempo por debajo de esto son ruido')
+    parser.add_argument('--min-delta-mb', type=float, default=5.0, help='diferencias de memoria por debajo de esto son ruido')
+    args = parser.parse_args()
+
+    options = {'pages': args.pages, 'text_mb': args.text_mb, 'strokes': args.strokes, 'repeat': args.repeat}
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('options') != options:
+            print(f"⚠️ La línea base se midió con otras opciones: {baseline.get('options')}")
+
+    names = args.only or list(STAGES)
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        start = time.perf_counter()
+        fixtures = make_fixtures(folder, options)
+        print(f"Ficheros de prueba generados en {time.perf_counter() - start:.1f} s "
+              f"({args.pages} páginas, texto de {args.text_mb} MB, {args.strokes} trazos por página)")
+        print(f"{'etapa':<20}{'modo':<9}{'real ms':>10}{'CPU ms':>10}{'pico MB':>10}{'vs base':>10}")
+        for name in names:
+            results[name] = now = run_stage(name, options, fixtures)
+            if 'error' in now:
+                print(f"{name:<20}{STAGES[name][0]:<9}  ❌ {now['error']}")
+                continue
+            before = (baseline or {}).get('results', {}).get(name)
+            delta = f"{now['wall_ms'] / before['wall_ms'] - 1:+.0%}" if before and before.get('wall_ms') else ''
+            print(f"{name:<20}{STAGES[name][0]:<9}{now['wall_ms']:>10.0f}{now['cpu_ms']:>10.0f}"
+                  f"{now['peak_rss_mb']:>10.0f}{delta:>10}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'options': options, 'results': results}, f, indent=2)
+        print(f"💾 Línea base guardada en {args.save_baseline}")
+
+    if baseline:
+        regressions = compare(results, baseline, args)
+        for name, metric, before, now in regressions:
+            print(f"❌ {name}: {metric} {before:.0f} -> {now:.0f} ({now / before - 1:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print("✅ Sin regresiones frente a la línea base")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark: miniaturas de la lista de documentos
+
+Uso:
+    python benchmarks/bench_thumbnails.py --docs 300
+
+Crea N documentos con una página anotada en un SQLite temporal y mide:
+generar la miniatura de cada uno, listarlos (con la clave de la miniatura en la
+misma consulta) y los bytes que descarga el panel de documentos con miniaturas
+frente a abrir la primera página de cada documento a tamaño completo.
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw
+import storage
+import thumbnails
+import variants
+
+
+def make_page(path, n):
+    img = Image.new('RGB', (1240, 1754), 'white')
+    draw = ImageDraw.Draw(img)
+    for y in range(80, 1680, 35):
+        draw.text((60, y), f"Documento {n}: el arrendatario se obliga a pagar la renta pactada", fill='black')
+    img.save(path, 'PNG')
+    return {'path': path, 'width': img.width, 'height': img.height, **variants.generate(img, path)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=300)
+    parser.add_argument('--strokes', type=int, default=20, help='trazos en la primera página de cada documento')
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as folder:
+        store = storage.SQLiteStore(os.path.join(folder, 'documents.db'))
+        # Pocas páginas base distintas: lo que cuesta es pintar y reducir, no generarlas
+        pages = [make_page(os.path.join(folder, f"base_{i}.png"), i) for i in range(5)]
+        for n in range(args.docs):
+            artifact, _ = store.acquire_artifact(storage.new_artifact(f"hash{n}", folder, 'png'))
+            store.add_artifact_page(artifact['id'], 0, pages[n % len(pages)])
+            store.create_document({'id': f"doc{n}", 'original_name': f"doc{n}.png", 'file_type': 'png',
+                                   'artifact_id': artifact['id'], 'upload_date': f"2024-01-01T00:{n // 60:02d}:{n % 60:02d}"})
+            store.set_annotations(f"doc{n}", [
+                {'id': f"a{i}", 'type': rnd.choice(['pen', 'highlighter']), 'page': 0, 'color': '#e91e63', 'size': 3,
+                 'points': [{'x': rnd.random(), 'y': rnd.random()} for _ in range(10)]} for i in range(args.strokes)])
+
+        thumbs = thumbnails.Thumbnails(store, os.path.join(folder, 'thumbnails'))
+        times = []
+        for n in range(args.docs):
+            start = time.perf_counter()
+            thumbs.refresh(f"doc{n}")
+            times.append(time.perf_counter() - start)
+        print(f"Miniatura: p50 {statistics.median(times) * 1000:.1f} ms, "
+              f"máx {max(times) * 1000:.1f} ms ({args.docs} documentos)")
+
+        start = time.perf_counter()
+        for _ in range(20):
+            docs, total = store.list_documents(limit=500)
+        print(f"list_documents ({total} documentos): {(time.perf_counter() - start) / 20 * 1000:.1f} ms, "
+              f"con miniatura: {sum(1 for d in docs if d.get('thumbnail'))}")
+
+        thumb_bytes = sum(len(thumbs.cache.get(d['thumbnail'], variants.extension())) for d in docs)
+        page_bytes = sum(os.path.getsize(pages[int(d['id'][3:]) % len(pages)]['path']) for d in docs)
+        print(f"Panel: miniaturas {thumb_bytes / 1024:.0f} KB frente a {page_bytes / 1024 / 1024:.1f} MB "
+              f"abriendo la primera página de cada documento")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Benchmark: variantes de visualización y teselas de una foto grande
+
+Uso:
+    python benchmarks/bench_variants.py --megapixels 40
+    python benchmarks/bench_variants.py --file foto.jpg --canvas 800
+
+Genera (o abre) una imagen, mide cuánto tarda variants.generate en crear las
+variantes y la pirámide de teselas y compara los bytes que descarga el visor
+para un canvas de --canvas píxeles CSS a densidad 1, 2 y 3 con los del original,
+además de lo que cuesta un zoom x4 con teselas frente a descargar el original.
+"""
+
+import os
+import sys
+import time
+import math
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFilter
+import variants
+
+
+def make_photo(megapixels, rnd):
+    width = int(math.sqrt(megapixels * 1e6 * 4 / 3))
+    height = int(width * 3 / 4)
+    # Ruido suavizado con formas encima: se comprime como una foto, no como un dibujo plano
+    img = Image.effect_noise((width // 8, height // 8), 60).convert('RGB').resize((width, height))
+    draw = ImageDraw.Draw(img)
+    for _ in range(300):
+        x, y = rnd.randrange(width), rnd.randrange(height)
+        r = rnd.randrange(20, width // 10)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rnd.randrange(256) for _ in range(3)))
+    return img.filter(ImageFilter.GaussianBlur(2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megapixels', type=float, default=40)
+    parser.add_argument('--file', help='usar esta imagen en lugar de la sintética')
+    parser.add_argument('--canvas', type=int, default=800, help='ancho del canvas del visor en píxeles CSS')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        if args.file:
+            img = Image.open(args.file)
+            img.load()
+        else:
+            img = make_photo(args.megapixels, random.Random(0))
+        path = os.path.join(folder, 'page.jpg')
+        img.save(path, 'JPEG', quality=92)
+        original = os.path.getsize(path)
+        print(f"Original {img.width}x{img.height} ({img.width * img.height / 1e6:.1f} MP): {original / 1024:.0f} KB")
+
+        start = time.perf_counter()
+        page = {'path': path, 'width': img.width, 'height': img.height, **variants.generate(img, path)}
+        print(f"Variantes y teselas ({variants.VARIANT_FORMAT}): {time.perf_counter() - start:.2f} s")
+
+        print(f"{'densidad':<10}{'variante':>10}{'KB':>10}{'vs original':>13}")
+        for dpr in (1, 2, 3):
+            chosen = variants.pick(page, args.canvas * dpr)
+            size = os.path.getsize(chosen)
+            label = next((str(v['width']) for v in page['variants'] if v['path'] == chosen), 'original')
+            print(f"x{dpr:<9}{label:>10}{size / 1024:>10.0f}{size / original:>13.1%}")
+
+        tiles = page.get('tiles')
+        if tiles:
+            # Zoom x4 a densidad 1: el visor ve una cuarta parte del ancho y del alto
+            need = args.canvas * 4
+            level = next((i for i, (w, _) in enumerate(tiles['levels']) if w >= need), len(tiles['levels']) - 1)
+            lw, lh = tiles['levels'][level]
+            cols = math.ceil(lw / 4 / tiles['size']) + 1
+            rows = math.ceil(lh / 4 / tiles['size']) + 1
+            folder_level = os.path.join(tiles['path'], str(level))
+            sizes = sorted(os.path.getsize(os.path.join(folder_level, f)) for f in os.listdir(folder_level))
+            visible = sum(sizes[-cols * rows:])  # peor caso: las teselas más pesadas
+            print(f"Zoom x4: nivel {level} ({lw}x{lh}), {cols * rows} teselas visibles ~{visible / 1024:.0f} KB "
+                  f"({visible / original:.1%} del original)")
+
+
+if __name__ == '__main__':
+    main()
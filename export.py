@@ -0,0 +1,358 @@
+"""
+Exportación de PDFs anotados
+- PDF original: las anotaciones se dibujan en una capa PDF (trazos como paths,
+  notas como texto) que se fusiona sobre las páginas originales. Las páginas
+  sin anotaciones se copian tal cual, sin rasterizar ni perder la capa de texto
+- Resto (imágenes de página, texto): se pinta y se escribe una página cada vez
+  y el PDF sale en streaming, así la memoria no crece con el número de páginas.
+  Las páginas ya pintadas se reutilizan de la caché (ver pagecache.py)
+"""
+
+import os
+import math
+from io import BytesIO
+from urllib.parse import quote
+
+import metrics
+
+# Resolución de referencia cuando no se conoce el tamaño de la imagen de la página
+DEFAULT_RASTER_DPI = 150
+# Memoria de trabajo por página al exportar; las páginas más grandes se reducen
+EXPORT_MEMORY_BUDGET_MB = int(os.getenv('EXPORT_MEMORY_BUDGET_MB', 256))
+# Resolución y calidad de las páginas rasterizadas en el PDF
+EXPORT_DPI = float(os.getenv('EXPORT_DPI', 100))
+EXPORT_JPEG_QUALITY = int(os.getenv('EXPORT_JPEG_QUALITY', 85))
+# Bytes por píxel al anotar: RGB original + RGBA de trabajo + capa del resaltador + RGB final
+_BYTES_PER_PIXEL = 3 + 4 + 4 + 4 + 3
+
+
+def hex_to_rgb(hex_color):
+    """Convertir color hexadecimal a tupla RGB (0-1)"""
+    hex_color = (hex_color or '#000000').lstrip('#')
+    if len(hex_color) == 3:
+        hex_color = ''.join(c * 2 for c in hex_color)
+    try:
+        return tuple(int(hex_color[i:i + 2], 16) / 255.0 for i in (0, 2, 4))
+    except ValueError:
+        return (0, 0, 0)
+
+
+def draw_annotations(c, annotations, width, height, px=1.0):
+    """Dibujar anotaciones en un canvas de ReportLab de `width` x `height` puntos
+
+    Las coordenadas de las anotaciones están normalizadas (0-1, origen arriba a la
+    izquierda); `px` es lo que mide en puntos un píxel de la imagen de la página,
+    para que grosores y tamaños de letra coincidan con el visor
+    """
+    import strokes
+
+    for ann in annotations:
+        r, g, b = hex_to_rgb(ann.get('color'))
+        size = (ann.get('size') or 3)
+
+        if ann.get('type') == 'text':
+            if not ann.get('text'):
+                continue
+            c.setFillColorRGB(r, g, b)
+            c.setFont("Helvetica", size * 10 * px)
+            # Igual que fillText en el visor: `y` es la línea base
+            c.drawString(ann.get('x', 0) * width, height - ann.get('y', 0) * height, ann['text'])
+
+        elif 'pts' in ann or 'points' in ann:
+            xy = strokes.coords(ann)
+            if len(xy) < 4:
+                continue
+            c.setStrokeColorRGB(r, g, b)
+            if ann.get('type') == 'highlighter':
+                c.setStrokeAlpha(0.15)
+                c.setLineWidth(size * 6 * px)
+            else:
+                c.setStrokeAlpha(1)
+                c.setLineWidth(size * 2 * px)
+
+            p = c.beginPath()
+            p.moveTo(xy[0] * width, height - xy[1] * height)
+            for i in range(2, len(xy), 2):
+                p.lineTo(xy[i] * width, height - xy[i + 1] * height)
+            c.drawPath(p, stroke=1, fill=0)
+            c.setStrokeAlpha(1)
+
+
+def _page_geometry(page):
+    """Tamaño visible (ya rotado) de la página y matriz para llevar la capa a su espacio"""
+    box = page.cropbox
+    left, bottom = float(box.left), float(box.bottom)
+    w, h = float(box.width), float(box.height)
+    rotation = (page.rotation or 0) % 360
+    if rotation == 90:
+        return (h, w), (0, 1, -1, 0, left + w, bottom)
+    if rotation == 180:
+        return (w, h), (-1, 0, 0, -1, left + w, bottom + h)
+    if rotation == 270:
+        return (h, w), (0, -1, 1, 0, left, bottom + h)
+    return (w, h), (1, 0, 0, 1, left, bottom)
+
+
+def _overlay_form(annotations, width, height, px, ctm):
+    """Capa de anotaciones como Form XObject (contenido y recursos propios)"""
+    from reportlab.pdfgen import canvas
+    import PyPDF2
+    from PyPDF2.generic import NameObject, ArrayObject, FloatObject
+
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=(width, height))
+    c.setLineCap(1)
+    c.setLineJoin(1)
+    draw_annotations(c, annotations, width, height, px)
+    c.showPage()
+    c.save()
+    buffer.seek(0)
+    page = PyPDF2.PdfReader(buffer).pages[0]
+
+    # ReportLab deja un único stream por página: se reutiliza tal cual (ya comprimido)
+    form = page['/Contents'].get_object()
+    form[NameObject('/Type')] = NameObject('/XObject')
+    form[NameObject('/Subtype')] = NameObject('/Form')
+    form[NameObject('/BBox')] = ArrayObject([FloatObject(0), FloatObject(0), FloatObject(width), FloatObject(height)])
+    form[NameObject('/Matrix')] = ArrayObject([FloatObject(v) for v in ctm])
+    form[NameObject('/Resources')] = page['/Resources']
+    return form
+
+
+def _stamp(writer, page, form):
+    """Dibujar `form` encima de la página sin volver a parsear su contenido"""
+    from PyPDF2.generic import NameObject, DictionaryObject, ArrayObject, DecodedStreamObject
+
+    def raw_stream(data):
+        stream = DecodedStreamObject()
+        stream.set_data(data)
+        return writer._add_object(stream)
+
+    resources = DictionaryObject(page.get('/Resources', DictionaryObject()).get_object())
+    xobjects = DictionaryObject(resources.get('/XObject', DictionaryObject()).get_object())
+    name = '/AnnotationLayer'
+    while name in xobjects:
+        name += 'X'
+    # clone: copia al writer el stream y los objetos que referencia (fuentes, ExtGState)
+    xobjects[NameObject(name)] = form.clone(writer).indirect_reference
+    resources[NameObject('/XObject')] = xobjects
+    page[NameObject('/Resources')] = resources
+
+    # El contenido original va entre q/Q para que su estado gráfico no afecte a la capa
+    contents = page.raw_get('/Contents') if '/Contents' in page else ArrayObject()
+    if not isinstance(contents.get_object(), ArrayObject):
+        contents = ArrayObject([contents])
+    page[NameObject('/Contents')] = ArrayObject(
+        [raw_stream(b'q\n')] + list(contents.get_object()) + [raw_stream(f'\nQ q {name} Do Q\n'.encode())])
+
+
+def annotate_pdf(src_path, annotations, out, image_widths=None):
+    """Escribir en `out` (ruta o fichero) el PDF original con las anotaciones encima
+
+    `image_widths[i]` es el ancho en píxeles de la imagen de la página i que vio
+    el usuario; sirve para pasar grosores de píxeles a puntos
+    """
+    import PyPDF2
+
+    by_page = {}
+    for ann in annotations or []:
+        by_page.setdefault(ann.get('page', 0), []).append(ann)
+
+    reader = PyPDF2.PdfReader(src_path)
+    writer = PyPDF2.PdfWriter()
+    for i, page in enumerate(reader.pages):
+        page_anns = by_page.get(i)
+        if page_anns:
+            (width, height), ctm = _page_geometry(page)
+            if image_widths and i < len(image_widths) and image_widths[i]:
+                px = width / image_widths[i]
+            else:
+                px = 72.0 / DEFAULT_RASTER_DPI
+            page = writer.add_page(page)
+            _stamp(writer, page, _overlay_form(page_anns, width, height, px, ctm))
+        else:
+            # Las páginas sin anotaciones pasan sin tocar
+            writer.add_page(page)
+
+    if reader.metadata:
+        writer.add_metadata({k: v for k, v in reader.metadata.items() if isinstance(v, str)})
+    writer.write(out)
+    return len(reader.pages)
+
+
+def attachment_headers(filename):
+    """Cabeceras de descarga para respuestas en streaming (sin send_file)"""
+    return {'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}"}
+
+
+def load_page_image(path, budget_mb=None):
+    """Abrir la imagen de una página reducida si no cabe en el presupuesto de memoria"""
+    from PIL import Image
+
+    budget = (budget_mb or EXPORT_MEMORY_BUDGET_MB) * 1024 * 1024
+    img = Image.open(path)
+    w, h = img.size
+    scale = math.sqrt(budget / (w * h * _BYTES_PER_PIXEL))
+    if scale < 1:
+        target = (max(1, int(w * scale)), max(1, int(h * scale)))
+        # Con JPEG se decodifica ya reducida; el resto se reduce tras cargar
+        img.draft('RGB', target)
+        img = img.convert('RGB').resize(target)
+        print(f"⚠️ Página {os.path.basename(path)} reducida a {target[0]}x{target[1]} por memoria")
+        return img
+    return img.convert('RGB')
+
+
+def encode_jpeg(img, quality=None):
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    buffer = BytesIO()
+    img.save(buffer, 'JPEG', quality=quality or EXPORT_JPEG_QUALITY)
+    return buffer.getvalue()
+
+
+def image_sources(paths, budget_mb=None):
+    """Páginas imagen para cached_pages: (identidad en disco, cargar la imagen)"""
+    import pagecache
+
+    return [(pagecache.file_signature(path), lambda path=path: load_page_image(path, budget_mb)) for path in paths]
+
+
+def text_sources(text):
+    """Páginas generadas desde texto para cached_pages; se maquetan sin pintar"""
+    import layout
+    import pagecache
+
+    font = layout.get_font()
+    for lines in layout.iter_layout(text, font):
+        base = pagecache.text_signature(lines, layout.PAGE_WIDTH, layout.PAGE_HEIGHT, getattr(font, 'size', None))
+        yield base, lambda lines=lines: layout.render_page(lines, font)
+
+
+def cached_pages(sources, annotations, cache=None, quality=None):
+    """JPEG de cada página anotada, reutilizando los que ya están en `cache`
+
+    `sources` da, por página, la identidad de la página base y cómo cargarla: solo
+    se abre y se pinta la página si su base o sus anotaciones han cambiado
+    """
+    import pagecache
+    import render
+
+    quality = quality or EXPORT_JPEG_QUALITY
+    by_page = render.annotations_by_page(annotations)
+    for i, (base, load) in enumerate(sources):
+        page_annotations = by_page.get(i, [])
+        key = pagecache.page_key(base, page_annotations, quality, EXPORT_MEMORY_BUDGET_MB)
+        jpeg = cache.get(key) if cache else None
+        if jpeg is None:
+            with metrics.stage('export_render'):
+                img = render.render_annotations(load(), page_annotations)
+                jpeg = encode_jpeg(img, quality)
+                img.close()
+            if cache:
+                cache.put(key, jpeg)
+        yield jpeg
+
+
+def annotated_pages(images, annotations):
+    """Pintar las anotaciones sobre cada página según se van pidiendo
+
+    `images` puede ser un generador: solo hay una página en memoria a la vez
+    """
+    import render
+
+    by_page = render.annotations_by_page(annotations)
+    for i, img in enumerate(images):
+        yield render.render_annotations(img, by_page.get(i, []))
+
+
+class StreamingPdf:
+    """Escritor de PDF incremental: cada página se serializa en cuanto se añade
+
+    Solo se guardan los offsets de los objetos; el árbol de páginas y la tabla
+    xref se escriben al final
+    """
+
+    CATALOG, PAGES = 1, 2
+
+    def __init__(self, dpi=None, quality=None):
+        self.dpi = dpi or EXPORT_DPI
+        self.quality = quality or EXPORT_JPEG_QUALITY
+        self._offsets = {}
+        self._kids = []
+        self._next = 3
+        self._pos = 0
+
+    def _emit(self, data):
+        self._pos += len(data)
+        return data
+
+    def _object(self, num, body, stream=None):
+        self._offsets[num] = self._pos
+        data = f"{num} 0 obj\n".encode() + body
+        if stream is not None:
+            data += b"\nstream\n" + stream + b"\nendstream"
+        return self._emit(data + b"\nendobj\n")
+
+    def header(self):
+        return self._emit(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def page(self, img):
+        """Bytes de una página con `img` (PIL) a página completa, como JPEG"""
+        return self.page_jpeg(encode_jpeg(img, self.quality))
+
+    def page_jpeg(self, jpeg):
+        """Bytes de una página con una imagen ya codificada en JPEG (p. ej. de la caché)"""
+        from PIL import Image
+
+        # Solo se leen la cabecera (tamaño y modo), sin decodificar
+        with Image.open(BytesIO(jpeg)) as img:
+            (w_px, h_px), mode = img.size, img.mode
+        w, h = w_px * 72.0 / self.dpi, h_px * 72.0 / self.dpi
+
+        image_num, content_num, page_num = self._next, self._next + 1, self._next + 2
+        self._next += 3
+        self._kids.append(page_num)
+        color = '/DeviceRGB' if mode == 'RGB' else '/DeviceGray'
+        content = f"q {w:.2f} 0 0 {h:.2f} 0 0 cm /Im0 Do Q".encode()
+        return b"".join([
+            self._object(image_num, (
+                f"<< /Type /XObject /Subtype /Image /Width {w_px} /Height {h_px} /ColorSpace {color} "
+                f"/BitsPerComponent 8 /Filter /DCTDecode /Length {len(jpeg)} >>").encode(), jpeg),
+            self._object(content_num, f"<< /Length {len(content)} >>".encode(), content),
+            self._object(page_num, (
+                f"<< /Type /Page /Parent {self.PAGES} 0 R /MediaBox [0 0 {w:.2f} {h:.2f}] "
+                f"/Resources << /XObject << /Im0 {image_num} 0 R >> /ProcSet [/PDF /ImageC /ImageB] >> "
+                f"/Contents {content_num} 0 R >>").encode())
+        ])
+
+    def close(self):
+        """Árbol de páginas, catálogo, xref y trailer"""
+        kids = ' '.join(f"{k} 0 R" for k in self._kids)
+        data = self._object(self.PAGES, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._kids)} >>".encode())
+        data += self._object(self.CATALOG, f"<< /Type /Catalog /Pages {self.PAGES} 0 R >>".encode())
+        xref_at = self._pos
+        size = self._next
+        lines = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        lines += [f"{self._offsets[n]:010d} 00000 n \n" for n in range(1, size)]
+        lines.append(f"trailer\n<< /Size {size} /Root {self.CATALOG} 0 R >>\nstartxref\n{xref_at}\n%%EOF\n")
+        return data + self._emit(''.join(lines).encode())
+
+
+def stream_image_pdf(images, dpi=None, quality=None):
+    """Generar el PDF por trozos: cabecera, una página cada vez y el cierre"""
+    pdf = StreamingPdf(dpi, quality)
+    yield pdf.header()
+    for img in images:
+        yield pdf.page(img)
+        img.close()
+    yield pdf.close()
+
+
+def stream_jpeg_pdf(jpegs, dpi=None):
+    """Como stream_image_pdf, con las páginas ya codificadas (ver cached_pages)"""
+    pdf = StreamingPdf(dpi)
+    yield pdf.header()
+    for jpeg in jpegs:
+        yield pdf.page_jpeg(jpeg)
+    yield pdf.close()
@@ -0,0 +1,168 @@
+"""
+Cola de procesamiento de documentos en segundo plano
+El rasterizado y el OCR se hacen fuera del hilo de la petición
+"""
+
+import os
+import time
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Estados por los que pasa un documento
+QUEUED = 'queued'
+RASTERIZING = 'rasterizing'
+OCR = 'ocr'
+READY = 'ready'
+FAILED = 'failed'
+
+# Documentos procesándose a la vez (cada uno puede usar varios núcleos)
+PROCESSING_WORKERS = int(os.getenv('PROCESSING_WORKERS', 2))
+# Un procesamiento sin avanzar durante este tiempo (s) se da por perdido aunque su proceso siga vivo
+JOB_STALE_SECONDS = int(os.getenv('JOB_STALE_SECONDS', 900))
+
+_HOST = socket.gethostname()
+
+
+class Job:
+    """Progreso del procesamiento de un contenido subido (su artefacto compartido).
+    Cada cambio se guarda con `persist(job)`"""
+
+    def __init__(self, artifact_id, persist):
+        self.artifact_id = artifact_id
+        self.state = QUEUED
+        self.pages_total = 0
+        self.pages_done = 0
+        self.error = None
+        self._persist = persist
+        self._lock = threading.Lock()
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'pages_total': self.pages_total,
+            'pages_done': self.pages_done,
+            'error': self.error,
+            # Quién lo procesa y cuándo avanzó por última vez: sin esto, un worker
+            # reiniciado a medias dejaría el artefacto en `queued`/`ocr` para siempre
+            'owner': {'host': _HOST, 'pid': os.getpid()},
+            'updated_at': time.time()
+        }
+
+    def set_state(self, state, pages_total=None):
+        """Pasar a una nueva etapa; el contador de páginas vuelve a cero"""
+        with self._lock:
+            self.state = state
+            self.pages_done = 0
+            if pages_total is not None:
+                self.pages_total = pages_total
+        self._persist(self)
+
+    def page_done(self):
+        """Marcar una página más como terminada en la etapa actual"""
+        with self._lock:
+            self.pages_done += 1
+        self._persist(self)
+
+    def finish(self):
+        with self._lock:
+            self.state = READY
+            self.pages_done = self.pages_total
+        self._persist(self)
+
+    def fail(self, error):
+        with self._lock:
+            self.state = FAILED
+            self.error = error
+        self._persist(self)
+
+
+class ProcessingQueue:
+    """Pool local con concurrencia limitada para procesar documentos"""
+
+    def __init__(self, max_workers=PROCESSING_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='procesado')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._owned = set()
+
+    @property
+    def pending(self):
+        """Documentos en cola o procesándose"""
+        return self._pending
+
+    def owns(self, artifact_id):
+        """Si este proceso tiene en cola o procesando el artefacto"""
+        with self._lock:
+            return artifact_id in self._owned
+
+    def submit(self, job, fn, *args):
+        """Encolar `fn(job, *args)`. Al terminar el job queda en `ready` o `failed`"""
+        def run():
+            try:
+                fn(job, *args)
+                job.finish()
+            except Exception as e:
+                print(f"❌ Error procesando {job.artifact_id}: {e}")
+                print(traceback.format_exc())
+                job.fail(str(e))
+            finally:
+                with self._lock:
+                    self._pending -= 1
+                    self._owned.discard(job.artifact_id)
+
+        with self._lock:
+            self._pending += 1
+            self._owned.add(job.artifact_id)
+        job.set_state(QUEUED)
+        return self._executor.submit(run)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def is_orphaned(artifact_id, processing, queue=None):
+    """El procesamiento quedó a medias y nadie lo va a terminar: su proceso ya no
+    existe (worker reiniciado o caído) o lleva JOB_STALE_SECONDS sin avanzar.
+    Con `queue`, lo que esa cola tiene entre manos nunca está huérfano"""
+    if not processing or processing.get('state') in (READY, FAILED):
+        return False
+    if queue is not None and queue.owns(artifact_id):
+        return False
+    owner = processing.get('owner') or {}
+    if owner.get('host') == _HOST and owner.get('pid'):
+        if owner['pid'] == os.getpid():
+            # Este proceso, pero no en su cola (sin cola no se puede saber: se mira el tiempo)
+            if queue is not None:
+                return True
+        elif not _alive(owner['pid']):
+            return True
+    updated = processing.get('updated_at')
+    return updated is None or time.time() - updated > JOB_STALE_SECONDS
+
+
+def fail_orphaned(store, artifact_id, processing):
+    """Marcar como fallido un procesamiento huérfano (se reintenta con la siguiente subida)"""
+    processing = dict(processing, state=FAILED, error='Procesamiento interrumpido', updated_at=time.time())
+    store.update_artifact(artifact_id, processing=processing)
+    return processing
+
+
+def recover(store):
+    """Al abrir el almacenamiento: los procesamientos huérfanos pasan a `failed`"""
+    recovered = 0
+    for artifact_id, processing in store.list_artifact_processing().items():
+        if is_orphaned(artifact_id, processing):
+            fail_orphaned(store, artifact_id, processing)
+            recovered += 1
+    if recovered:
+        print(f"♻️ {recovered} procesamientos interrumpidos marcados como fallidos")
+    return recovered
@@ -0,0 +1,171 @@
+"""
+Maquetación de texto plano en páginas (TXT/DOCX)
+Calcula en una sola pasada las líneas de cada página y su posición sin pintar
+nada: así se sabe cuántas páginas salen, y qué texto va en cada una, sin
+rasterizarlas. El ancho de cada palabra se mide una vez por fuente y se reutiliza
+(caché de palabras y de glifos); una línea se mide sumando anchos, no volviendo
+a medir la línea entera con cada palabra nueva
+"""
+
+from functools import lru_cache
+from typing import NamedTuple
+from PIL import Image, ImageDraw, ImageFont
+
+# Página A4 a 150 dpi, como las páginas generadas hasta ahora
+PAGE_WIDTH, PAGE_HEIGHT = 1240, 1754
+MARGIN = 60
+LINE_HEIGHT = 35
+FONT_SIZE = 24
+
+# Palabras distintas recordadas por fuente
+WORD_CACHE_SIZE = 100000
+
+
+class Line(NamedTuple):
+    """Una línea maquetada: texto, posición en la página y rango [start, end) en el texto normalizado"""
+    text: str
+    x: int
+    y: int
+    start: int
+    end: int
+
+
+@lru_cache(maxsize=8)
+def get_font(size=FONT_SIZE):
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+class TextMeasurer:
+    """Anchos de texto en una fuente, con caché de glifos y de palabras"""
+
+    def __init__(self, font):
+        self.font = font
+        self._glyphs = {}
+        self._words = {}
+        self.space = self.glyph(' ')
+
+    def glyph(self, char):
+        width = self._glyphs.get(char)
+        if width is None:
+            width = self._glyphs[char] = self.font.getlength(char)
+        return width
+
+    def word(self, word):
+        width = self._words.get(word)
+        if width is None:
+            # Palabra entera (respeta el kerning dentro de ella); la caché no crece sin límite
+            width = self.font.getlength(word) if word else 0.0
+            if len(self._words) < WORD_CACHE_SIZE:
+                self._words[word] = width
+        return width
+
+    def split_word(self, word, max_width):
+        """Trozos de una palabra más ancha que la línea, cortando por glifos"""
+        pieces, start, width = [], 0, 0.0
+        for i, char in enumerate(word):
+            w = self.glyph(char)
+            if width + w > max_width and i > start:
+                pieces.append((start, i))
+                start, width = i, 0.0
+            width += w
+        pieces.append((start, len(word)))
+        return pieces
+
+
+@lru_cache(maxsize=8)
+def _measurer(font):
+    return TextMeasurer(font)
+
+
+def normalize(text):
+    return (text or '').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def wrap_lines(text, font=None, max_width=PAGE_WIDTH - 2 * MARGIN):
+    """Líneas de `text` (normalizado) que caben en `max_width`: [(texto, inicio, fin)]
+
+    Cada párrafo se parte por espacios como antes; el ancho de la línea se acumula
+    palabra a palabra. Una palabra más ancha que la línea se corta por glifos
+    """
+    measure = _measurer(font or get_font())
+    text = normalize(text)
+    pos = 0
+    for paragraph in text.split('\n'):
+        if not paragraph:
+            yield ('', pos, pos)
+            pos += 1
+            continue
+        line_start, line_end, width = pos, pos, None
+        offset = pos
+        for word in paragraph.split(' '):
+            w = measure.word(word)
+            if width is not None and width + measure.space + w <= max_width:
+                width += measure.space + w
+                line_end = offset + len(word)
+            else:
+                if width is not None:
+                    yield (text[line_start:line_end], line_start, line_end)
+                if w > max_width and len(word) > 1:
+                    pieces = measure.split_word(word, max_width)
+                    for a, b in pieces[:-1]:
+                        yield (word[a:b], offset + a, offset + b)
+                    a, b = pieces[-1]
+                    line_start, line_end, width = offset + a, offset + b, measure.word(word[a:b])
+                else:
+                    line_start, line_end, width = offset, offset + len(word), w
+            offset += len(word) + 1
+        yield (text[line_start:line_end], line_start, line_end)
+        pos += len(paragraph) + 1
+
+
+def paginate(text, font=None, width=PAGE_WIDTH, height=PAGE_HEIGHT, margin=MARGIN, line_height=LINE_HEIGHT):
+    """Páginas de `text` sin pintarlas: cada página es una lista de Line con su posición
+
+    Mismo criterio que las páginas generadas hasta ahora: una línea va a la página
+    actual y, si con ella se pasa del margen inferior, se empieza otra. Un texto vacío
+    da una página vacía
+    """
+    return list(iter_layout(text, font, width, height, margin, line_height))
+
+
+def iter_layout(text, font=None, width=PAGE_WIDTH, height=PAGE_HEIGHT, margin=MARGIN, line_height=LINE_HEIGHT):
+    """Como paginate, pero entregando cada página en cuanto está completa"""
+    font = font or get_font()
+    # La línea que rebasa el margen inferior todavía entra en la página
+    per_page = (height - 2 * margin) // line_height + 1
+
+    current, emitted = [], False
+    for line_text, start, end in wrap_lines(text, font, width - 2 * margin):
+        current.append(Line(line_text, margin, margin + len(current) * line_height, start, end))
+        if len(current) == per_page:
+            yield current
+            current, emitted = [], True
+    if current or not emitted:
+        yield current
+
+
+def page_texts(text, **kwargs):
+    """Texto que cae en cada página (para indexarlo o citarlo por página)"""
+    text = normalize(text)
+    return [text[page[0].start:page[-1].end] if page else '' for page in paginate(text, **kwargs)]
+
+
+def render_page(lines, font=None, width=PAGE_WIDTH, height=PAGE_HEIGHT):
+    """Pintar una página ya maquetada"""
+    font = font or get_font()
+    img = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(img)
+    for line in lines:
+        if line.text:
+            draw.text((line.x, line.y), line.text, font=font, fill="black")
+    return img
+
+
+def iter_rendered_pages(text, font=None):
+    """Imágenes de las páginas de `text`, pintadas de una en una"""
+    font = font or get_font()
+    for lines in iter_layout(text, font):
+        yield render_page(lines, font)
@@ -0,0 +1,431 @@
+"""
+Cliente del modelo de IA para el chatbot
+Las llamadas no se hacen en el hilo de la petición con reintentos y sleep: van a
+una cola acotada que atienden unos pocos hilos, con un límite de peticiones por
+minuto (token bucket) común a todo el proceso. Si la cola está llena o el
+proveedor devuelve 429, la petición se rechaza al momento con un `retry_after`
+en vez de dejar al worker dormido. Las respuestas se guardan en una caché
+LRU con caducidad, por versión del documento, pregunta e historial reciente.
+
+El backend es intercambiable: cualquier modelo con generate_content(prompt).text
+(Gemini, retrieval.StubModel) o FakeBackend para pruebas de carga
+"""
+
+import os
+import re
+import json
+import time
+import queue
+import random
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import metrics
+import retrieval
+
+# Peticiones por minuto al proveedor y ráfaga máxima (común a todo el proceso)
+LLM_RATE_PER_MIN = float(os.getenv('LLM_RATE_PER_MIN', 15))
+LLM_BURST = int(os.getenv('LLM_BURST', 5))
+# Llamadas simultáneas al modelo y preguntas que pueden esperar turno
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', 4))
+LLM_QUEUE_SIZE = int(os.getenv('LLM_QUEUE_SIZE', 16))
+# Segundos máximos que una pregunta espera turno (cola + límite de ritmo); si se
+# prevé más, se rechaza en el acto con Busy en vez de ocupar el hilo de la petición
+LLM_MAX_WAIT = float(os.getenv('LLM_MAX_WAIT', 5))
+# Segundos máximos de la llamada al modelo, una vez le llega el turno
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 60))
+# Espera sugerida tras un 429 si el proveedor no indica otra
+LLM_RETRY_AFTER = float(os.getenv('LLM_RETRY_AFTER', 10))
+# Caché de respuestas
+LLM_CACHE_SIZE = int(os.getenv('LLM_CACHE_SIZE', 256))
+LLM_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', 3600))
+# Turnos del historial que forman parte de la clave de caché
+CACHE_HISTORY_TURNS = 3
+
+
+class Busy(Exception):
+    """El modelo no puede atender ahora (cola llena, 429 o tiempo agotado): reintentar tras `retry_after` s"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, int(round(retry_after)))
+
+
+class RateLimited(Exception):
+    """El proveedor ha rechazado la llamada por cuota (429/503)"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after or LLM_RETRY_AFTER
+
+
+# ==========================================
+# BACKENDS
+# ==========================================
+
+_RETRY_HINT = re.compile(r'retry(?:_delay)?[^0-9]{0,20}(\d+(?:\.\d+)?)', re.IGNORECASE)
+
+
+class ModelBackend:
+    """Cualquier modelo con generate_content(prompt).text (Gemini, retrieval.StubModel)"""
+
+    def __init__(self, model):
+        self.model = model
+        self.name = getattr(model, 'model_name', None) or type(model).__name__
+
+    def generate(self, prompt):
+        try:
+            return self.model.generate_content(prompt).text
+        except Exception as e:
+            raise _translate(e)
+
+    def stream(self, prompt):
+        """Trozos de la respuesta según los va generando el modelo"""
+        try:
+            for chunk in self.model.generate_content(prompt, stream=True):
+                text = chunk.text
+                if text:
+                    yield text
+        except Exception as e:
+            raise _translate(e)
+
+
+def _translate(e):
+    """Los errores de cuota del proveedor pasan a RateLimited (con su espera sugerida, si la da)"""
+    error = str(e)
+    if '429' in error or 'quota' in error.lower() or '503' in error:
+        hint = _RETRY_HINT.search(error)
+        limited = RateLimited(error, float(hint.group(1)) if hint else None)
+        limited.__cause__ = e
+        return limited
+    return e
+
+
+class FakeBackend:
+    """Modelo falso para pruebas: responde como retrieval.StubModel tras `latency` s (una
+    palabra cada `token_delay` s en streaming) y devuelve 429 en una fracción `rate_limit_ratio`"""
+
+    name = 'fake'
+
+    def __init__(self, latency=0.0, rate_limit_ratio=0.0, retry_after=None, token_delay=0.0):
+        self.stub = retrieval.StubModel()
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.token_delay = token_delay
+        self.calls = 0
+
+    def _start(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.rate_limit_ratio and random.random() < self.rate_limit_ratio:
+            raise RateLimited('429 Resource exhausted (fake)', self.retry_after)
+
+    def generate(self, prompt):
+        # Lo mismo que tardaría en streaming, pero todo de una vez
+        return ''.join(self.stream(prompt))
+
+    def stream(self, prompt):
+        self._start()
+        for n, chunk in enumerate(self.stub.generate_content(prompt, stream=True)):
+            if n and self.token_delay:
+                time.sleep(self.token_delay)
+            yield chunk.text
+
+
+def backend_from_env(model):
+    """Backend según CHAT_MODEL: `fake` (latencia y 429 configurables) o el modelo dado"""
+    if os.getenv('CHAT_MODEL') == 'fake':
+        return FakeBackend(latency=float(os.getenv('FAKE_LLM_LATENCY', 0.5)),
+                           rate_limit_ratio=float(os.getenv('FAKE_LLM_429_RATE', 0)),
+                           token_delay=float(os.getenv('FAKE_LLM_TOKEN_DELAY', 0.02)))
+    return ModelBackend(model) if model else None
+
+
+# ==========================================
+# LÍMITE DE PETICIONES
+# ==========================================
+
+class TokenBucket:
+    """`rate` peticiones por segundo con ráfagas de hasta `burst`; `pause` lo vacía hasta que pase un 429"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self):
+        """Segundos hasta que haya un token (0 si lo hay ya), sin consumirlo"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._paused_until:
+                return self._paused_until - now
+            return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def acquire(self, deadline):
+        """Consumir un token esperando como mucho hasta `deadline` (monotonic); False si no llega a tiempo"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            if now + wait > deadline:
+                return False
+            time.sleep(min(wait, 1.0))
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+# Un único límite para todo el proceso, lo usen uno o varios clientes
+LIMITER = TokenBucket(LLM_RATE_PER_MIN / 60.0, LLM_BURST)
+
+
+# ==========================================
+# CACHÉ DE RESPUESTAS
+# ==========================================
+
+class AnswerCache:
+    """LRU con caducidad por entrada"""
+
+    def __init__(self, size=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def cache_key(version, question, history=None):
+    """Clave de caché: versión del documento (su contenido), pregunta normalizada e historial reciente"""
+    recent = [(h.get('question', ''), h.get('answer', '')) for h in (history or [])[-CACHE_HISTORY_TURNS:]]
+    raw = json.dumps([version, ' '.join((question or '').lower().split()), recent], ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+# ==========================================
+# CLIENTE
+# ==========================================
+
+# Fin de la respuesta en streaming
+_END = object()
+
+
+class LLMClient:
+    """Cola acotada + hilos propios para llamar al backend sin bloquear con reintentos"""
+
+    def __init__(self, backend, limiter=None, concurrency=LLM_CONCURRENCY, queue_size=LLM_QUEUE_SIZE,
+                 cache=None, timeout=LLM_TIMEOUT, max_wait=LLM_MAX_WAIT):
+        self.backend = backend
+        self.limiter = limiter or LIMITER
+        self.cache = cache if cache is not None else AnswerCache()
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.concurrency = concurrency
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.counters = {'requests': 0, 'cache_hits': 0, 'rejected': 0, 'rate_limited': 0, 'errors': 0}
+        for n in range(concurrency):
+            threading.Thread(target=self._worker, name=f'llm-{n}', daemon=True).start()
+
+    @property
+    def available(self):
+        return self.backend is not None
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, queued=self._queue.qsize(), in_flight=self._in_flight,
+                        cached=len(self.cache))
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def submit(self, work):
+        """Encolar `work()` (una llamada al backend) y devolver su Future; Busy si no le llegaría turno en `max_wait` s"""
+        self._count('requests')
+        # Estimación: token del límite (o fin de la pausa tras un 429) más lo que tarda
+        # en vaciarse la cola al ritmo permitido
+        wait = self.limiter.wait_time() + self._queue.qsize() / self.limiter.rate
+        if wait > self.max_wait:
+            self._count('rejected')
+            raise Busy('La IA está limitada en este momento', wait)
+        future = Future()
+        deadline = time.monotonic() + self.max_wait
+        try:
+            self._queue.put_nowait((work, deadline, future))
+        except queue.Full:
+            self._count('rejected')
+            raise Busy('Demasiadas preguntas en cola', wait)
+        return future
+
+    def _limit(self, timeout):
+        """Segundos que la petición espera como mucho: turno más llamada al modelo"""
+        return self.max_wait + (timeout or self.timeout) + 1
+
+    def ask(self, prompt, key=None, timeout=None):
+        """Respuesta para `prompt` (de la caché si `key` ya se preguntó). Lanza Busy en vez de esperar reintentos"""
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self._count('cache_hits')
+                return cached
+        future = self.submit(lambda: self.backend.generate(prompt))
+        try:
+            answer = future.result(timeout=self._limit(timeout))
+        except FutureTimeout:
+            future.cancel()
+            raise Busy('La IA ha tardado demasiado', LLM_RETRY_AFTER)
+        if key is not None:
+            self.cache.put(key, answer)
+        return answer
+
+    def stream(self, prompt, key=None, timeout=None):
+        """Iterador con los trozos de la respuesta según llegan (uno solo si estaba en caché)
+
+        Busy se lanza al llamar, antes del primer trozo, si no hay sitio en la cola; un error
+        a mitad de respuesta se lanza al iterar
+        """
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self._count('cache_hits')
+                return iter([cached])
+        pieces = queue.Queue()
+
+        def work():
+            parts = []
+            for piece in self.backend.stream(prompt):
+                parts.append(piece)
+                pieces.put(piece)
+            # Se cachea aquí: aunque el cliente se desconecte, la respuesta ya está pagada
+            answer = ''.join(parts)
+            if key is not None:
+                self.cache.put(key, answer)
+            return answer
+
+        future = self.submit(work)
+        future.add_done_callback(lambda f: pieces.put(_END))
+        return self._drain(pieces, future, timeout)
+
+    def _drain(self, pieces, future, timeout):
+        deadline = time.monotonic() + self._limit(timeout)
+        while True:
+            try:
+                piece = pieces.get(timeout=max(0.1, deadline - time.monotonic()))
+            except queue.Empty:
+                future.cancel()
+                raise Busy('La IA ha tardado demasiado', LLM_RETRY_AFTER)
+            if piece is _END:
+                break
+            yield piece
+        future.result()
+
+    def _worker(self):
+        while True:
+            work, deadline, future = self._queue.get()
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if not self.limiter.acquire(deadline):
+                    self._count('rejected')
+                    future.set_exception(Busy('La IA está limitada en este momento', self.limiter.wait_time()))
+                    continue
+                with self._lock:
+                    self._in_flight += 1
+                try:
+                    with metrics.stage('llm_call'):
+                        result = work()
+                    future.set_result(result)
+                except RateLimited as e:
+                    # Un 429 pausa a todos los hilos; la pregunta se rechaza sin dormir en la petición
+                    self._count('rate_limited')
+                    self.limiter.pause(e.retry_after)
+                    future.set_exception(Busy('La IA está ocupada', e.retry_after))
+                except Exception as e:
+                    self._count('errors')
+                    future.set_exception(e)
+                finally:
+                    with self._lock:
+                        self._in_flight -= 1
+            finally:
+                self._queue.task_done()
+
+
+# ==========================================
+# STREAMING (SERVER-SENT EVENTS)
+# ==========================================
+
+def sse(data, event=None):
+    """Un evento SSE con `data` en JSON"""
+    head = f"event: {event}\n" if event else ''
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def answer_events(pieces, sources, started):
+    """Eventos de una respuesta en streaming: `sources`, un `data` por trozo y `done` con los tiempos
+
+    `started` es el perf_counter del inicio de la petición: el tiempo hasta el primer
+    trozo (ttft_ms) se mide aparte del total. Un error a mitad se envía como evento `error`
+    """
+    yield sse(sources, 'sources')
+    ttft = None
+    try:
+        for piece in pieces:
+            if ttft is None:
+                ttft = time.perf_counter() - started
+            yield sse({'text': piece})
+    except Busy as e:
+        yield sse({'error': str(e), 'retry_after': e.retry_after}, 'error')
+        return
+    except Exception as e:
+        yield sse({'error': f"Error IA: {e}"}, 'error')
+        return
+    total = time.perf_counter() - started
+    ttft = total if ttft is None else ttft
+    # Hasta el primer trozo: lo que nota el usuario (el total ya lo mide la petición)
+    metrics.observe_stage('llm_ttft', ttft)
+    yield sse({'ttft_ms': round(ttft * 1000, 1), 'total_ms': round(total * 1000, 1)}, 'done')
+
+
+# Cabeceras para que ningún proxy acumule la respuesta
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
@@ -0,0 +1,245 @@
+"""
+Métricas en formato de texto de Prometheus (GET /metrics)
+Contadores e histogramas en memoria, sin dependencias: cada medida es sumar en
+un diccionario bajo un candado, así que pueden quedarse siempre activas
+(METRICS_ENABLED=0 las apaga). Se mide cada endpoint (duración, estado, bytes
+recibidos y enviados) y cada etapa del procesamiento; aciertos de caché, cola
+de procesamiento y llamadas al modelo se leen al servir /metrics de los
+contadores que ya llevan esos objetos.
+
+Con varios workers de gunicorn cada proceso cuenta lo suyo: cada raspado de
+/metrics lo atiende un worker, con sus propios valores
+"""
+
+import os
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') != '0'
+# Límites (segundos) de los histogramas de duración
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contador con etiquetas: `inc(n, endpoint='upload')`"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(n, '') for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def lines(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_labels(self.labels, key)} {_number(value)}"
+
+
+class Histogram:
+    """Histograma de duraciones: `observe(segundos, stage='ocr')` o `with h.time(stage='ocr'):`"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # etiquetas -> [cuentas por cubo..., +Inf, suma]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(n, '') for n in self.labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def lines(self):
+        with self._lock:
+            items = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                le = 'le="+Inf"' if bound == '+Inf' else f'le="{bound}"'
+                yield f"{self.name}_bucket{_labels(self.labels, key, le)} {total}"
+            yield f"{self.name}_sum{_labels(self.labels, key)} {_number(counts[-1])}"
+            yield f"{self.name}_count{_labels(self.labels, key)} {total}"
+
+
+class Collected:
+    """Valores que llevan otros objetos (cachés, colas) y se leen al servir /metrics"""
+
+    def __init__(self, name, help, kind, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = tuple(labels)
+        self._sources = []
+        _registry.append(self)
+
+    def add(self, read, **labels):
+        """`read()` devuelve el valor actual"""
+        self._sources.append((tuple(labels.get(n, '') for n in self.labels), read))
+
+    def lines(self):
+        for key, read in list(self._sources):
+            try:
+                value = read()
+            except Exception:
+                continue
+            yield f"{self.name}{_labels(self.labels, key)} {_number(value)}"
+
+
+def render():
+    """Todas las métricas en el formato de texto de Prometheus"""
+    out = []
+    for metric in _registry:
+        lines = list(metric.lines())
+        if not lines:
+            continue
+        out.append(f"# HELP {metric.name} {metric.help}")
+        out.append(f"# TYPE {metric.name} {metric.kind}")
+        out.extend(lines)
+    return '\n'.join(out) + '\n'
+
+
+# ==========================================
+# MÉTRICAS DE LA APLICACIÓN
+# ==========================================
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Duración de las peticiones (hasta el último byte)',
+                            ('endpoint', 'method'))
+REQUESTS = Counter('http_requests_total', 'Peticiones atendidas', ('endpoint', 'method', 'status'))
+BYTES_IN = Counter('http_request_bytes_total', 'Bytes recibidos en el cuerpo de las peticiones', ('endpoint',))
+BYTES_OUT = Counter('http_response_bytes_total', 'Bytes enviados en el cuerpo de las respuestas', ('endpoint',))
+STAGE_SECONDS = Histogram('pipeline_stage_duration_seconds',
+                          'Duración de cada etapa (por página en rasterize, ocr, page_encode y variants)', ('stage',))
+PAGES = Counter('pages_processed_total', 'Páginas publicadas por el procesamiento')
+CACHE_HITS = Collected('cache_hits_total', 'Aciertos de cada caché', 'counter', ('cache',))
+CACHE_MISSES = Collected('cache_misses_total', 'Fallos de cada caché', 'counter', ('cache',))
+QUEUE_DEPTH = Collected('queue_depth', 'Trabajos en cola o en curso', 'gauge', ('queue',))
+LLM_CALLS = Collected('llm_events_total', 'Llamadas al modelo por resultado (los 429 se reintentan '
+                      'desde el cliente pasado retry_after)', 'counter', ('event',))
+
+
+def stage(name):
+    """Cronometrar una etapa: `with metrics.stage('index_text'):`"""
+    return STAGE_SECONDS.time(stage=name)
+
+
+def observe_stage(name, seconds):
+    STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def watch_cache(name, stats):
+    """Caché con `stats()` -> {'hits': n, 'misses': n} (PageCache.stats)"""
+    CACHE_HITS.add(lambda: stats()['hits'], cache=name)
+    CACHE_MISSES.add(lambda: stats()['misses'], cache=name)
+
+
+def watch_llm(client):
+    """Cola, caché y resultados del LLMClient"""
+    watch_cache('llm_answers', lambda: {'hits': client.stats()['cache_hits'], 'misses': client.stats()['requests']})
+    QUEUE_DEPTH.add(lambda: client.stats()['queued'], queue='llm')
+    QUEUE_DEPTH.add(lambda: client.stats()['in_flight'], queue='llm_in_flight')
+    for event in ('requests', 'rate_limited', 'rejected', 'errors'):
+        LLM_CALLS.add(lambda event=event: client.stats()[event], event=event)
+
+
+def watch_queue(name, pending):
+    QUEUE_DEPTH.add(pending, queue=name)
+
+
+def _counting(chunks, endpoint):
+    for chunk in chunks:
+        BYTES_OUT.inc(len(chunk.encode('utf-8') if isinstance(chunk, str) else chunk), endpoint=endpoint)
+        yield chunk
+
+
+def init_app(app):
+    """Medir todas las peticiones de `app` y servir GET /metrics"""
+    from flask import g, request, Response
+
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        # Directo del entorno WSGI: las propiedades de request cuestan más que la medida
+        environ = request.environ
+        endpoint, method, status = request.endpoint or 'sin_ruta', environ['REQUEST_METHOD'], response.status_code
+        length = environ.get('CONTENT_LENGTH')
+        if length and length.isdigit():
+            BYTES_IN.inc(int(length), endpoint=endpoint)
+
+        def done():
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, method=method)
+            REQUESTS.inc(endpoint=endpoint, method=method, status=status)
+
+        if response.is_streamed and response.content_length is None:
+            # Streaming (SSE, exportaciones): bytes por trozo y duración hasta el último
+            response.response = _counting(response.response, endpoint)
+            response.call_on_close(done)
+        else:
+            if response.content_length:
+                BYTES_OUT.inc(response.content_length, endpoint=endpoint)
+            done()
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(render(), mimetype='text/plain; version=0.0.4')
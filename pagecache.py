@@ -0,0 +1,132 @@
+"""
+Caché en disco de las páginas anotadas ya pintadas (exportaciones y descargas)
+Cada página se guarda ya codificada (el JPEG que va dentro del PDF) bajo un hash
+de la página base y de sus anotaciones: al volver a exportar solo se pintan las
+páginas cuyas anotaciones han cambiado. El tamaño total está acotado y se
+expulsa lo usado hace más tiempo (la fecha de modificación de cada fichero hace
+de último uso, así la comparten todos los procesos del servidor)
+"""
+
+import os
+import json
+import uuid
+import hashlib
+import threading
+
+# Tamaño máximo de la caché en disco (0 la desactiva)
+RENDER_CACHE_MB = int(os.getenv('RENDER_CACHE_MB', 512))
+# Al pasarse del máximo se expulsa hasta quedar en esta fracción
+_EVICT_TO = 0.9
+# Forma parte de cada clave: subirlo al cambiar cómo se pintan las anotaciones
+# descarta las páginas ya guardadas (2: se respeta el orden resaltado/lápiz)
+RENDER_VERSION = 2
+
+
+def file_signature(path):
+    """Identidad barata de una página en disco: ruta, tamaño y fecha de modificación"""
+    st = os.stat(path)
+    return f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def text_signature(lines, *params):
+    """Identidad de una página generada desde texto: sus líneas y cómo se pintan"""
+    h = hashlib.sha256(json.dumps(params).encode())
+    for line in lines:
+        h.update(f"\n{line.x},{line.y}:{line.text}".encode('utf-8'))
+    return 'text:' + h.hexdigest()
+
+
+def page_key(base, annotations, *params):
+    """Hash de la página base, sus anotaciones (sin importar el orden de las claves) y el formato de salida"""
+    data = json.dumps([RENDER_VERSION, base, annotations, params], sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class PageCache:
+    """Ficheros `<hash>.<ext>` en `folder`, con expulsión LRU por tamaño total"""
+
+    def __init__(self, folder, max_mb=None):
+        self.folder = folder
+        self.max_bytes = (RENDER_CACHE_MB if max_mb is None else max_mb) * 1024 * 1024
+        self._lock = threading.Lock()
+        self._size = None
+        self.hits = self.misses = self.evicted = 0
+        if self.enabled:
+            os.makedirs(folder, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, key, ext):
+        return os.path.join(self.folder, f"{key}.{ext}")
+
+    def get(self, key, ext='jpg'):
+        """Bytes guardados bajo `key` o None; un acierto cuenta como uso reciente"""
+        if not self.enabled:
+            return None
+        path = self._path(key, ext)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data, ext='jpg'):
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        path = self._path(key, ext)
+        # Escritura atómica: otro proceso nunca lee un fichero a medias
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"⚠️ No se pudo guardar la página en caché: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _scan(self):
+        entries, total = [], 0
+        for entry in os.scandir(self.folder):
+            if not entry.is_file() or entry.name.endswith('.tmp'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        return entries, total
+
+    def _evict(self):
+        """Borrar lo usado hace más tiempo hasta bajar del límite (se recuenta el disco)"""
+        entries, total = self._scan()
+        target = self.max_bytes * _EVICT_TO
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                self.evicted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evicted': self.evicted,
+                'bytes': self._size, 'max_bytes': self.max_bytes}
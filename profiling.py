@@ -0,0 +1,304 @@
+"""
+Perfilado bajo demanda de peticiones reales
+Una petición se perfila (cProfile, incluido el cuerpo en streaming) si trae la
+cabecera `X-Profile: <PROFILE_TOKEN>` o si cae en el muestreo activado desde
+POST /admin/profiling. El resultado se guarda en formato de pilas colapsadas
+(`marco;marco;marco microsegundos`, lo que leen flamegraph.pl y speedscope) en
+un búfer circular en disco: solo se conservan los PROFILE_KEEP últimos.
+
+Sin PROFILE_TOKEN no hay cabecera ni endpoints de administración; el muestreo
+se guarda en disco para que lo vean todos los workers de gunicorn
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import hmac
+import pstats
+import random
+import cProfile
+import threading
+
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+# Perfiles conservados y proporción de peticiones muestreadas al arrancar (0 a 1)
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 100))
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+# Cada cuánto (s) mira cada worker si el muestreo ha cambiado
+_SETTINGS_CHECK_SECONDS = 1.0
+# Caminos que aportan menos de esto (µs) no se escriben
+_MIN_MICROSECONDS = 1
+
+
+def _frame(func):
+    filename, line, name = func
+    if filename == '~':
+        # Funciones de C: "<built-in method time.sleep>"
+        label = name.strip('<>')
+    else:
+        label = f"{os.path.basename(filename)}:{name}:{line}"
+    return label.replace(';', ',').replace(' ', '_')
+
+
+def collapse(stats):
+    """Pilas colapsadas {pila: µs} a partir de un pstats.Stats
+
+    cProfile solo guarda pares llamante -> llamado, no pilas completas: el tiempo
+    propio de cada función se reparte entre sus caminos en proporción al tiempo
+    que le llega por cada uno
+    """
+    entries = stats.stats  # función -> (llamadas primitivas, llamadas, propio, acumulado, llamantes)
+    callees = {}
+    roots = []
+    for func, (_, _, _, total, callers) in entries.items():
+        known = 0.0
+        for caller, edge in callers.items():
+            if caller in entries:
+                callees.setdefault(caller, []).append((func, edge[3]))
+                known += edge[3]
+        # Lo que no llega desde funciones perfiladas empieza una pila: el marco que
+        # activó el perfilador, o el cuerpo en streaming reanudado con next()
+        if total > 0 and known < total:
+            roots.append((func, 1.0 - known / total))
+    stacks = {}
+
+    def walk(func, path, share):
+        _, _, own, total, _ = entries[func]
+        path = path + (func,)
+        micros = own * share * 1e6
+        if micros >= _MIN_MICROSECONDS:
+            key = ';'.join(_frame(f) for f in path)
+            stacks[key] = stacks.get(key, 0) + micros
+        for callee, edge_total in callees.get(func, ()):
+            callee_total = entries[callee][3]
+            if callee in path or not callee_total:
+                continue
+            callee_share = share * min(1.0, edge_total / callee_total)
+            if callee_total * callee_share * 1e6 >= _MIN_MICROSECONDS:
+                walk(callee, path, callee_share)
+
+    for root, share in roots:
+        walk(root, (), share)
+    return {stack: round(micros) for stack, micros in stacks.items() if round(micros) > 0}
+
+
+class Profiles:
+    """Búfer circular de perfiles en disco y ajustes del muestreo"""
+
+    def __init__(self, folder, keep=None):
+        self.folder = os.path.abspath(folder)
+        self.keep = PROFILE_KEEP if keep is None else keep
+        self._settings_path = os.path.join(self.folder, 'settings.json')
+        self._settings = {'sample_rate': PROFILE_SAMPLE_RATE, 'paths': []}
+        self._settings_mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def settings(self):
+        """Muestreo actual (releído de disco como mucho una vez por segundo)"""
+        now = time.monotonic()
+        if now - self._checked >= _SETTINGS_CHECK_SECONDS:
+            self._checked = now
+            try:
+                mtime = os.path.getmtime(self._settings_path)
+                if mtime != self._settings_mtime:
+                    with open(self._settings_path) as f:
+                        self._settings = json.load(f)
+                    self._settings_mtime = mtime
+            except (OSError, ValueError):
+                pass
+        return self._settings
+
+    def update_settings(self, sample_rate=None, paths=None):
+        """Cambiar el muestreo para todos los workers (ValueError si no es válido)"""
+        settings = dict(self.settings())
+        if sample_rate is not None:
+            sample_rate = float(sample_rate)
+            if not 0 <= sample_rate <= 1:
+                raise ValueError('sample_rate debe estar entre 0 y 1')
+            settings['sample_rate'] = sample_rate
+        if paths is not None:
+            if not isinstance(paths, list) or not all(isinstance(p, str) for p in paths):
+                raise ValueError('paths debe ser una lista de prefijos de ruta')
+            settings['paths'] = paths
+        tmp = f"{self._settings_path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(settings, f)
+        os.replace(tmp, self._settings_path)
+        with self._lock:
+            self._settings, self._settings_mtime, self._checked = settings, None, 0.0
+        return settings
+
+    def sampled(self, path):
+        settings = self.settings()
+        rate = settings.get('sample_rate') or 0
+        if rate <= 0 or random.random() >= rate:
+            return False
+        prefixes = settings.get('paths')
+        return not prefixes or any(path.startswith(p) for p in prefixes)
+
+    def save(self, profiler, info):
+        """Escribir un perfil (pilas colapsadas + metadata) y descartar los más antiguos"""
+        stacks = collapse(pstats.Stats(profiler))
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', info['path']).strip('_')[:60] or 'root'
+        # El nombre empieza por la hora con microsegundos: el orden alfabético es el cronológico
+        now = time.time()
+        stamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}.{int(now * 1e6) % 1000000:06d}"
+        name = f"{stamp}_{info['method']}_{slug}_{uuid.uuid4().hex[:6]}"
+        path = os.path.join(self.folder, f"{name}.folded")
+        with open(path, 'w') as f:
+            for stack, micros in sorted(stacks.items()):
+                f.write(f"{stack} {micros}\n")
+        with open(os.path.join(self.folder, f"{name}.json"), 'w') as f:
+            json.dump(dict(info, name=name, stacks=len(stacks)), f)
+        self._prune()
+        print(f"🔬 Perfil guardado: {name} ({info['duration_ms']} ms)")
+        return name
+
+    def _prune(self):
+        names = sorted(f[:-len('.folded')] for f in os.listdir(self.folder) if f.endswith('.folded'))
+        for name in names[:max(0, len(names) - self.keep)]:
+            for ext in ('.folded', '.json'):
+                try:
+                    os.remove(os.path.join(self.folder, name + ext))
+                except FileNotFoundError:
+                    pass  # Otro worker ya lo borró
+
+    def list(self):
+        """Metadata de los perfiles guardados, del más reciente al más antiguo"""
+        items = []
+        for filename in sorted(os.listdir(self.folder), reverse=True):
+            if not filename.endswith('.json') or filename == 'settings.json':
+                continue
+            try:
+                with open(os.path.join(self.folder, filename)) as f:
+                    items.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return items
+
+    def path(self, name):
+        """Fichero de pilas colapsadas de un perfil, o None si no existe"""
+        if not re.fullmatch(r'[A-Za-z0-9_.-]+', name or ''):
+            return None
+        path = os.path.join(self.folder, f"{name}.folded")
+        return path if os.path.exists(path) else None
+
+
+class _ProfiledBody:
+    """Cuerpo de la respuesta que sigue perfilando mientras se envía (streaming)"""
+
+    def __init__(self, body, profiler, finish):
+        self._body = body
+        self._iter = iter(body)
+        self._profiler = profiler
+        self._finish = finish
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._profiler.enable()
+        try:
+            return next(self._iter)
+        finally:
+            self._profiler.disable()
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._finish()
+
+
+class ProfilerMiddleware:
+    """Middleware WSGI: perfila las peticiones marcadas o muestreadas"""
+
+    def __init__(self, wsgi_app, profiles, token=None):
+        self.wsgi_app = wsgi_app
+        self.profiles = profiles
+        self.token = PROFILE_TOKEN if token is None else token
+
+    def _selected(self, environ):
+        header = environ.get('HTTP_X_PROFILE')
+        if header:
+            return 'header' if self.token and hmac.compare_digest(header, self.token) else None
+        return 'sample' if self.profiles.sampled(environ.get('PATH_INFO', '')) else None
+
+    def __call__(self, environ, start_response):
+        trigger = self._selected(environ)
+        if not trigger:
+            return self.wsgi_app(environ, start_response)
+
+        profiler = cProfile.Profile()
+        status = []
+        start = time.perf_counter()
+
+        def capture(code, headers, *args):
+            status.append(int(code.split(' ', 1)[0]))
+            return start_response(code, headers, *args)
+
+        def finish():
+            try:
+                self.profiles.save(profiler, {
+                    'path': environ.get('PATH_INFO', ''), 'method': environ.get('REQUEST_METHOD', ''),
+                    'status': status[0] if status else None, 'trigger': trigger,
+                    'duration_ms': round((time.perf_counter() - start) * 1000, 1),
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
+            except Exception as e:
+                print(f"⚠️ No se pudo guardar el perfil: {e}")
+
+        try:
+            profiler.enable()
+        except ValueError:
+            # Otro perfilador activo en este hilo: la petición sigue sin perfilar
+            return self.wsgi_app(environ, start_response)
+        try:
+            body = self.wsgi_app(environ, capture)
+        except BaseException:
+            profiler.disable()
+            finish()
+            raise
+        profiler.disable()
+        return _ProfiledBody(body, profiler, finish)
+
+
+def init_app(app, folder):
+    """Perfilado de `app` y endpoints /admin/profiling y /admin/profiles/<nombre>"""
+    from flask import request, jsonify, send_file
+
+    profiles = Profiles(folder)
+    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, profiles)
+    if not PROFILE_TOKEN:
+        return profiles
+
+    def authorized():
+        return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), PROFILE_TOKEN)
+
+    @app.route('/admin/profiling', methods=['GET', 'POST'])
+    def profiling_admin():
+        """GET: muestreo y perfiles guardados. POST {sample_rate, paths}: cambiar el muestreo"""
+        if not authorized():
+            return jsonify({'success': False, 'error': 'Forbidden'}), 403
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            try:
+                profiles.update_settings(data.get('sample_rate'), data.get('paths'))
+            except (TypeError, ValueError) as e:
+                return jsonify({'success': False, 'error': f"Invalid settings: {e}"}), 400
+        return jsonify({'success': True, 'settings': profiles.settings(), 'profiles': profiles.list()})
+
+    @app.route('/admin/profiles/<name>')
+    def get_profile(name):
+        """Pilas colapsadas de un perfil (para flamegraph.pl o speedscope)"""
+        if not authorized():
+            return jsonify({'success': False, 'error': 'Forbidden'}), 403
+        path = profiles.path(name)
+        if not path:
+            return jsonify({'success': False, 'error': 'Profile not found'}), 404
+        return send_file(path, mimetype='text/plain', as_attachment=True, download_name=f"{name}.folded")
+
+    return profiles
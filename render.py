@@ -0,0 +1,148 @@
+"""
+Pintado de anotaciones sobre las páginas imagen (exportación y descargas)
+Una sola pasada por página: cada tramo de trazos consecutivos del mismo tipo
+(resaltador, o lápiz y texto) se acumula en una capa que se compone sobre la
+página una única vez (solo en la zona que ocupan sus trazos), en lugar de una
+composición de página entera por cada trazo. Se respeta el orden de las
+anotaciones: la capa se cierra cuando cambia el tipo, así que lo dibujado
+después queda encima. Las notas de texto van con el lápiz, con la fuente
+cacheada por tamaño
+"""
+
+from PIL import Image, ImageDraw
+import layout
+import strokes
+
+# Opacidad de cada tipo de trazo (0-255)
+HIGHLIGHT_ALPHA = 40
+PEN_ALPHA = 255
+OTHER_ALPHA = 200
+
+
+def hex_to_rgb(color_hex):
+    try:
+        return tuple(int(color_hex.lstrip('#')[i:i + 2], 16) for i in (0, 2, 4))
+    except Exception:
+        return (0, 0, 0)
+
+
+def annotations_by_page(annotations):
+    """Anotaciones agrupadas por página en una sola pasada: {página: [anotaciones]}"""
+    by_page = {}
+    for ann in annotations or []:
+        by_page.setdefault(ann.get('page', 0), []).append(ann)
+    return by_page
+
+
+def _stroke(ann, width, height):
+    """Coordenadas absolutas intercaladas, grosor y caja [x0, y0, x1, y1) de un trazo"""
+    size = int(ann.get('size', 3)) * 2
+    stroke_width = size * 3 if ann['type'] == 'highlighter' else size
+    points = strokes.scaled(ann, width, height)
+    if len(points) < 4:
+        return points, stroke_width, (0, 0, 0, 0)
+    xs, ys = points[0::2], points[1::2]
+    pad = stroke_width // 2 + 2
+    box = (max(0, int(min(xs)) - pad), max(0, int(min(ys)) - pad),
+           min(width, int(max(xs)) + pad + 1), min(height, int(max(ys)) + pad + 1))
+    return points, stroke_width, box
+
+
+def _shift(points, dx, dy):
+    out = points[:]
+    out[0::2] = [x - dx for x in points[0::2]]
+    out[1::2] = [y - dy for y in points[1::2]]
+    return out
+
+
+def _union(a, b):
+    if a is None:
+        return b
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _text(ann, width, height):
+    """Máscara (cobertura 0-255) de una nota de texto y su caja en la página"""
+    size = int(ann.get('size', 3)) * 2
+    font = layout.get_font(size * 10)
+    x, y = int(ann['x'] * width), int(ann['y'] * height)
+    measure = ImageDraw.Draw(Image.new('L', (1, 1)))
+    left, top, right, bottom = measure.textbbox((0, 0), ann['text'], font=font)
+    mask = Image.new('L', (max(1, right - left), max(1, bottom - top)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), ann['text'], fill=255, font=font)
+    return mask, (x + left, y + top, x + left + mask.width, y + top + mask.height)
+
+
+def render_annotations(img, page_annotations):
+    """Pintar las anotaciones de una página (ya filtradas) y devolver la imagen en RGB"""
+    img = img.convert('RGBA')
+    width, height = img.size
+
+    # Tramos consecutivos del mismo tipo: cada uno se acumula en una capa y se compone
+    # al cambiar de tipo, así un resaltado posterior queda encima del lápiz anterior
+    runs = []  # [tipo, elementos, caja]
+
+    def add(kind, item, box):
+        if not runs or runs[-1][0] != kind:
+            runs.append([kind, [], None])
+        runs[-1][1].append(item)
+        runs[-1][2] = _union(runs[-1][2], box)
+
+    for ann in page_annotations:
+        if ann['type'] == 'text':
+            if not ann.get('text'):
+                continue
+            mask, box = _text(ann, width, height)
+            clipped = (max(0, box[0]), max(0, box[1]), min(width, box[2]), min(height, box[3]))
+            if clipped[2] <= clipped[0] or clipped[3] <= clipped[1]:
+                continue
+            add('ink', (ann, mask, None, box), clipped)
+        elif 'pts' in ann or 'points' in ann:
+            points, stroke_width, box = _stroke(ann, width, height)
+            if len(points) < 4 or box[2] <= box[0] or box[3] <= box[1]:
+                continue
+            add('highlight' if ann['type'] == 'highlighter' else 'ink', (ann, points, stroke_width, box), box)
+
+    for kind, items, box in runs:
+        if kind == 'highlight':
+            _composite_highlights(img, items, box)
+        else:
+            _composite_ink(img, items, box)
+
+    return img.convert('RGB')
+
+
+def _composite_highlights(img, highlights, layer_box):
+    """Capa del tamaño de la zona resaltada; cada trazo se acumula sobre ella en su propia caja"""
+    x0, y0, x1, y1 = layer_box
+    layer = Image.new('RGBA', (x1 - x0, y1 - y0), (0, 0, 0, 0))
+    for ann, points, stroke_width, (bx0, by0, bx1, by1) in highlights:
+        stroke = Image.new('RGBA', (bx1 - bx0, by1 - by0), (0, 0, 0, 0))
+        ImageDraw.Draw(stroke).line(_shift(points, bx0, by0),
+                                    fill=hex_to_rgb(ann.get('color', '#000000')) + (HIGHLIGHT_ALPHA,),
+                                    width=stroke_width)
+        layer.alpha_composite(stroke, dest=(bx0 - x0, by0 - y0))
+    img.alpha_composite(layer, dest=(x0, y0))
+
+
+def _composite_ink(img, ink, layer_box):
+    """Lápiz y texto en su orden: las líneas (sin antialias) se pintan tal cual y
+    el texto, con bordes suavizados, se compone con su máscara"""
+    x0, y0, x1, y1 = layer_box
+    layer = Image.new('RGBA', (x1 - x0, y1 - y0), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+    for ann, shape, stroke_width, box in ink:
+        color = hex_to_rgb(ann.get('color', '#000000'))
+        if ann['type'] == 'text':
+            glyphs = Image.new('RGBA', shape.size, color + (0,))
+            glyphs.putalpha(shape)
+            # La caja puede salirse de la página por arriba o por la izquierda
+            dx, dy = box[0] - x0, box[1] - y0
+            if dx < 0 or dy < 0:
+                glyphs = glyphs.crop((max(0, -dx), max(0, -dy), glyphs.width, glyphs.height))
+                dx, dy = max(0, dx), max(0, dy)
+            layer.alpha_composite(glyphs, dest=(dx, dy))
+        else:
+            alpha = PEN_ALPHA if ann['type'] == 'pen' else OTHER_ALPHA
+            draw.line(_shift(shape, x0, y0), fill=color + (alpha,), width=stroke_width, joint='curve')
+    img.alpha_composite(layer, dest=(x0, y0))
@@ -0,0 +1,242 @@
+"""
+Contexto del chatbot por recuperación
+En lugar de mandar al modelo los primeros miles de caracteres del documento, el
+texto se trocea al procesarlo en fragmentos que no cruzan páginas y se indexa
+una vez (BM25 dentro de cada documento). Cada pregunta envía solo los
+CHAT_TOP_K fragmentos más relevantes, marcados con su página para que el
+modelo la cite: el prompt es pequeño y la respuesta puede salir de cualquier
+parte del documento
+"""
+
+import os
+import re
+import math
+import search
+
+# Tamaño de fragmento y solape con el anterior (caracteres)
+CHAT_CHUNK_CHARS = int(os.getenv('CHAT_CHUNK_CHARS', 1200))
+CHAT_CHUNK_OVERLAP = int(os.getenv('CHAT_CHUNK_OVERLAP', 200))
+# Fragmentos que se envían al modelo por pregunta
+CHAT_TOP_K = int(os.getenv('CHAT_TOP_K', 6))
+
+# Cortes preferidos al final de un fragmento: párrafo, frase, espacio
+_BREAKS = ('\n\n', '. ', '\n', ' ')
+
+
+def chunk_pages(page_texts, size=None, overlap=None):
+    """Trocear el texto de cada página: [(página, texto)] con fragmentos de ~size caracteres"""
+    size = size or CHAT_CHUNK_CHARS
+    overlap = CHAT_CHUNK_OVERLAP if overlap is None else overlap
+    chunks = []
+    for page, text in enumerate(page_texts):
+        text = (text or '').strip()
+        start = 0
+        while start < len(text):
+            end = len(text)
+            if end - start > size:
+                end = start + size
+                for sep in _BREAKS:
+                    cut = text.rfind(sep, start + size // 2, start + size)
+                    if cut != -1:
+                        end = cut + len(sep)
+                        break
+            chunk = text[start:end].strip()
+            if chunk:
+                chunks.append((page, chunk))
+            if end >= len(text):
+                break
+            # Solape con el fragmento anterior, empezando en una palabra entera
+            next_start = max(end - overlap, start + 1)
+            space = text.find(' ', next_start, end)
+            start = space + 1 if space != -1 else end
+    return chunks
+
+
+CHUNK_SCHEMA = """
+-- Fragmentos del texto de cada contenido, con la página de la que salen
+CREATE TABLE IF NOT EXISTS chat_chunks (
+    key TEXT NOT NULL,
+    chunk INTEGER NOT NULL,
+    page INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (key, chunk)
+) WITHOUT ROWID;
+
+-- Postings por contenido: solo se consulta dentro de un documento
+CREATE TABLE IF NOT EXISTS chat_postings (
+    key TEXT NOT NULL,
+    term TEXT NOT NULL,
+    chunk INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (key, term, chunk)
+) WITHOUT ROWID;
+"""
+
+
+class ChunkIndex(search.SqliteIndex):
+    """Fragmentos indexados por contenido (artefacto o documento antiguo) para el chatbot"""
+
+    SCHEMA = CHUNK_SCHEMA
+
+    def has(self, key):
+        with self._lock:
+            return self._conn().execute("SELECT 1 FROM chat_chunks WHERE key = ? LIMIT 1", (key,)).fetchone() is not None
+
+    def index_pages(self, key, page_texts):
+        """(Re)trocear e indexar el texto de `key`: `page_texts` es la lista de textos por página"""
+        chunk_rows, postings = [], []
+        for n, (page, text) in enumerate(chunk_pages(page_texts)):
+            terms = {}
+            tokens = search.tokenize(text)
+            for term, _, _ in tokens:
+                terms[term] = terms.get(term, 0) + 1
+            chunk_rows.append((key, n, page, len(tokens), text))
+            postings.extend((key, term, n, tf) for term, tf in terms.items())
+
+        with self._lock:
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._remove(conn, key)
+                conn.executemany("INSERT INTO chat_chunks (key, chunk, page, length, content) VALUES (?, ?, ?, ?, ?)", chunk_rows)
+                conn.executemany("INSERT INTO chat_postings (key, term, chunk, tf) VALUES (?, ?, ?, ?)", postings)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return len(chunk_rows)
+
+    def remove(self, key):
+        with self._lock:
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._remove(conn, key)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def _remove(self, conn, key):
+        conn.execute("DELETE FROM chat_postings WHERE key = ?", (key,))
+        conn.execute("DELETE FROM chat_chunks WHERE key = ?", (key,))
+
+    def retrieve(self, key, question, k=None):
+        """Los `k` fragmentos de `key` más relevantes para `question`, en orden de documento
+
+        Devuelve [{'chunk', 'page', 'score', 'content'}]. Si ningún término de la pregunta
+        aparece (p. ej. "resume el documento"), fragmentos repartidos por todo el texto
+        """
+        k = k or CHAT_TOP_K
+        terms = list(dict.fromkeys(t for t, _, _ in search.tokenize(question or '')))
+        with self._lock:
+            conn = self._conn()
+            stats = conn.execute("SELECT COUNT(*) AS chunks, AVG(length) AS avg_length FROM chat_chunks WHERE key = ?",
+                                 (key,)).fetchone()
+            if not stats['chunks']:
+                return []
+            n, avg_length = stats['chunks'], stats['avg_length'] or 1
+
+            scores = {}
+            if terms:
+                marks = ', '.join('?' * len(terms))
+                rows = conn.execute(
+                    f"SELECT p.term, p.chunk, p.tf, c.length FROM chat_postings p "
+                    f"JOIN chat_chunks c ON c.key = p.key AND c.chunk = p.chunk "
+                    f"WHERE p.key = ? AND p.term IN ({marks})", [key] + terms
+                ).fetchall()
+                df = {}
+                for row in rows:
+                    df[row['term']] = df.get(row['term'], 0) + 1
+                for row in rows:
+                    idf = math.log(1 + (n - df[row['term']] + 0.5) / (df[row['term']] + 0.5))
+                    scores[row['chunk']] = scores.get(row['chunk'], 0) + idf * search.bm25(row['tf'], row['length'], avg_length)
+
+            if scores:
+                best = sorted(scores, key=scores.get, reverse=True)[:k]
+            else:
+                best = sorted({round(i * (n - 1) / max(k - 1, 1)) for i in range(min(k, n))})
+
+            marks = ', '.join('?' * len(best))
+            rows = conn.execute(f"SELECT chunk, page, content FROM chat_chunks WHERE key = ? AND chunk IN ({marks}) "
+                                f"ORDER BY chunk", [key] + best).fetchall()
+        return [{'chunk': r['chunk'], 'page': r['page'], 'score': round(scores.get(r['chunk'], 0), 4),
+                 'content': r['content']} for r in rows]
+
+
+def open_index(store):
+    """Índice de fragmentos junto al almacenamiento: en el mismo fichero SQLite, o en memoria"""
+    path = getattr(store, 'path', None) or ':memory:'
+    return ChunkIndex(path)
+
+
+def cite(chunk, paged):
+    """Etiqueta con la que el modelo cita un fragmento"""
+    return f"pág. {chunk['page'] + 1}" if paged else f"frag. {chunk['chunk'] + 1}"
+
+
+def build_context(chunks, paged=True):
+    """Texto de los fragmentos para el prompt, cada uno con su etiqueta"""
+    return '\n\n'.join(f"[{cite(c, paged)}]\n{c['content']}" for c in chunks)
+
+
+def build_prompt(context, question, history=None):
+    """Prompt del chatbot: fragmentos etiquetados, historial reciente y pregunta"""
+    prompt = (f"Fragmentos del documento:\n{context}\n\n"
+              "Responde usando solo estos fragmentos y cita entre paréntesis la etiqueta de cada "
+              "fragmento que uses, p. ej. (pág. 3). Si la respuesta no está en ellos, dilo.\n\n"
+              f"Pregunta: {question}\nResponde en español.")
+    if history:
+        h_str = "\n".join(f"U: {h['question']} A: {h['answer']}" for h in history[-5:])
+        prompt = f"Historial:\n{h_str}\n\n{prompt}"
+    return prompt
+
+
+def sources(chunks, paged=True):
+    """Fuentes para la respuesta JSON: páginas (o fragmentos) usados, sin repetir"""
+    seen = {}
+    for c in chunks:
+        label = cite(c, paged)
+        if label not in seen or c['score'] > seen[label]['score']:
+            seen[label] = {'label': label, 'page': c['page'] + 1 if paged else None, 'score': c['score']}
+    return list(seen.values())
+
+
+class StubModel:
+    """Modelo local para desarrollo y pruebas (CHAT_MODEL=stub): no llama a ninguna API
+
+    Responde con la frase de los fragmentos que más términos comparte con la pregunta
+    y cita su etiqueta; guarda solo el último prompt, para poder medir su tamaño
+    """
+
+    _SECTION = re.compile(r'^\[((?:pág|frag)\. \d+)\]\n(.*?)(?=\n\n\[(?:pág|frag)\. \d+\]\n|\n\nResponde usando)',
+                          re.MULTILINE | re.DOTALL)
+
+    class _Response:
+        def __init__(self, text):
+            self.text = text
+
+    def __init__(self):
+        self.last_prompt = None
+
+    def generate_content(self, prompt, stream=False):
+        """Como Gemini: con stream=True, una respuesta por palabra"""
+        answer = self._answer(prompt)
+        if stream:
+            return [self._Response(piece) for piece in re.findall(r'\S+\s*', answer.text)]
+        return answer
+
+    def _answer(self, prompt):
+        self.last_prompt = prompt
+        question = prompt.rsplit('Pregunta:', 1)[-1]
+        wanted = {t for t, _, _ in search.tokenize(question)}
+        best, best_hits, label = None, 0, None
+        for section_label, body in self._SECTION.findall(prompt):
+            for sentence in re.split(r'(?<=[.!?])\s+', body):
+                hits = len(wanted & {t for t, _, _ in search.tokenize(sentence)})
+                if hits > best_hits:
+                    best, best_hits, label = sentence, hits, section_label
+        if not best:
+            return self._Response("No encuentro esa información en el documento.")
+        return self._Response(f"{' '.join(best.split())} ({label})")
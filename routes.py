@@ -1,15 +1,117 @@
 import os
+import time
 import uuid
-import json
+import threading
+import tempfile
 import traceback
 from datetime import datetime # ESTA FALTABA
-from flask import render_template, request, jsonify, send_file, send_from_directory
+from io import BytesIO
+from flask import render_template, request, jsonify, send_file, send_from_directory, url_for, Response, stream_with_context
 from werkzeug.utils import secure_filename
 from PIL import Image
 import utils
+import export
+import jobs
+import llm
+import metrics
+import ocr
+import pagecache
+import profiling
+import retrieval
+import search
+import spatial
+import storage
+import strokes
+import thumbnails
+import variants
 
 def register_routes(app):
-    gemini_model = utils.configure_gemini()
+    # Llamadas al modelo en cola, con límite de peticiones y caché de respuestas; el modelo
+    # de Gemini se elige en segundo plano (o sale de la caché en disco) sin retrasar el arranque
+    chat_client = llm.LLMClient(llm.backend_from_env(
+        utils.configure_gemini(os.path.join(app.config['UPLOAD_FOLDER'], 'cache', 'gemini_model.json'))))
+    processing_queue = jobs.ProcessingQueue()
+    # Metadata, texto y anotaciones en SQLite (los <id>.json antiguos se migran solos)
+    store = storage.open_store(upload_folder=app.config['UPLOAD_FOLDER'])
+    # Índice de búsqueda junto a los documentos; lo anterior al índice se indexa al arrancar
+    search_index = search.open_index(store)
+    threading.Thread(target=search.backfill, args=(search_index, store), daemon=True).start()
+    # Fragmentos por página para el contexto del chatbot
+    chat_index = retrieval.open_index(store)
+    # Páginas anotadas ya pintadas, reutilizadas entre exportaciones
+    page_cache = pagecache.PageCache(os.path.join(app.config['UPLOAD_FOLDER'], 'render_cache'))
+    # Miniaturas de la primera página para la lista, generadas en segundo plano
+    thumbs = thumbnails.Thumbnails(store, os.path.join(app.config['UPLOAD_FOLDER'], 'thumbnails'))
+    # Rejilla por página de las anotaciones para las consultas por zona
+    annotation_index = spatial.AnnotationIndexes(store)
+    # Métricas de Prometheus en /metrics: peticiones, etapas, cachés y colas
+    metrics.init_app(app)
+    metrics.watch_cache('render', page_cache.stats)
+    metrics.watch_cache('thumbnails', thumbs.cache.stats)
+    metrics.watch_llm(chat_client)
+    metrics.watch_queue('processing', lambda: processing_queue.pending)
+    # Perfiles de peticiones concretas en pilas colapsadas (X-Profile o muestreo; requiere PROFILE_TOKEN)
+    profiling.init_app(app, os.path.join(app.config['UPLOAD_FOLDER'], 'profiles'))
+
+    def index_pages(artifact_id, texts):
+        with metrics.stage('index_text'):
+            search_index.index_pages(artifact_id, texts)
+            chat_index.index_pages(artifact_id, texts)
+
+    def persist_job(job): store.update_artifact(job.artifact_id, processing=job.to_dict())
+
+    def page_urls(doc):
+        # Además del original: variantes reducidas (?w=) y, en las páginas grandes, la pirámide de teselas
+        pages = []
+        for i, p in enumerate(doc['pages']):
+            url = url_for('get_page_image', doc_id=doc['id'], page_num=i)
+            page = {'url': url, 'width': p['width'], 'height': p['height'],
+                    'variants': [{'width': v['width'], 'url': f"{url}?w={v['width']}"} for v in p.get('variants', [])]}
+            if p.get('tiles'):
+                page['tiles'] = {'url': f"{url}/tiles", **{k: p['tiles'][k] for k in ('size', 'levels', 'format')}}
+            pages.append(page)
+        return pages
+
+    def process_upload(job, filepath, ext):
+        # Páginas, texto e informes van al artefacto: los comparten todos los documentos con este contenido
+        artifact_id = job.artifact_id
+        text = ""
+
+        def add_page(i, path, img):
+            store.add_artifact_page(artifact_id, i, {'path': path, 'width': img.width, 'height': img.height,
+                                                     **variants.generate(img, path)})
+            metrics.PAGES.inc()
+            job.page_done()
+
+        try:
+            if ext == 'pdf':
+                # Capa de texto por página; el OCR solo para las páginas que no la tienen
+                pdf_text = ocr.PdfText(filepath)
+                job.set_state(jobs.RASTERIZING, utils.pdf_page_count(filepath))
+                for i, img in enumerate(utils.iter_pdf_images(filepath)):
+                    page_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{artifact_id}_page_{i}.png")
+                    with metrics.stage('page_encode'): img.save(page_path, 'PNG')
+                    add_page(i, page_path, img)
+                    pdf_text.page_rendered(i, page_path)
+                job.set_state(jobs.OCR, pdf_text.ocr_pages)
+                texts = pdf_text.results(on_page=lambda i: job.page_done())
+                text = "\n\n".join(t or "" for t in texts)
+                index_pages(artifact_id, [t or "" for t in texts])
+                store.update_artifact(artifact_id, text_extraction=pdf_text.report())
+            elif ext == 'docx':
+                text = utils.extract_text_from_docx(filepath)
+                index_pages(artifact_id, [text])
+            elif ext == 'txt':
+                text = utils.extract_text_from_txt(filepath)
+                index_pages(artifact_id, [text])
+            else:
+                job.set_state(jobs.RASTERIZING, 1)
+                with Image.open(filepath) as img: add_page(0, filepath, img)
+                text = "Imagen."
+        except Exception as e:
+            print(f"Error procesando: {e}")
+            text = f"Error: {e}"
+        store.set_artifact_text(artifact_id, text)
 
     @app.route('/')
     def index(): return render_template('index.html')
@@ -27,128 +129,209 @@ def register_routes(app):
             
             filename = secure_filename(file.filename)
             unique_id = f"{uuid.uuid4().hex}_{filename}"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_id)
-            file.save(filepath)
-            
             ext = filename.rsplit('.', 1)[1].lower()
-            text = ""
-            paths = []
-            
-            try:
-                if ext == 'pdf':
-                    text = utils.extract_text_from_pdf(filepath)
-                    imgs = utils.pdf_to_images(filepath)
-                    for i, img in enumerate(imgs):
-                        name = f"{unique_id}_page_{i}.png"
-                        img.save(os.path.join(app.config['UPLOAD_FOLDER'], name), 'PNG')
-                        paths.append(name)
-                elif ext == 'docx': text = utils.extract_text_from_docx(filepath)
-                elif ext == 'txt': text = utils.extract_text_from_txt(filepath)
-                else: paths = [unique_id]; text = "Imagen."
-            except Exception as e: 
-                print(f"Error procesando: {e}")
-                text = f"Error: {e}"
-
-            doc = {
-                'id': unique_id, 'original_name': filename, 'file_type': ext,
-                'text_content': text, 'image_paths': paths, 'annotations': [],
-                'upload_time': datetime.now().isoformat(), 'status': 'temp'
-            }
-            
-            with open(os.path.join(app.config['UPLOAD_FOLDER'], f"{unique_id}.json"), 'w', encoding='utf-8') as f:
-                json.dump(doc, f, ensure_ascii=False, indent=2)
+
+            # Un mismo contenido se guarda y se procesa una sola vez
+            content_hash, tmp_path = storage.save_upload(file, app.config['UPLOAD_FOLDER'])
+            artifact, created = store.acquire_artifact(storage.new_artifact(content_hash, app.config['UPLOAD_FOLDER'], ext))
+            if created: os.replace(tmp_path, artifact['file_path'])
+            else: os.remove(tmp_path)
+
+            # Páginas y texto se rellenan en segundo plano (o ya están, si es un duplicado)
+            store.create_document({
+                'id': unique_id, 'original_name': filename, 'file_type': ext, 'file_path': artifact['file_path'],
+                'artifact_id': artifact['id'], 'upload_date': datetime.now().isoformat(), 'status': 'temp'
+            })
+
+            # Se reprocesa si falló o si quedó a medias (worker reiniciado o caído)
+            processing = artifact.get('processing') or {}
+            state = processing.get('state', jobs.QUEUED)
+            if created or state == jobs.FAILED or jobs.is_orphaned(artifact['id'], processing, processing_queue):
+                job = jobs.Job(artifact['id'], persist_job)
+                future = processing_queue.submit(job, process_upload, artifact['file_path'], artifact['file_type'])
+                future.add_done_callback(lambda _: thumbs.schedule(unique_id))
+                state = job.state
+            elif state == jobs.READY: thumbs.schedule(unique_id)
             
-            return jsonify({'success': True, 'doc_id': unique_id, 'filename': filename, 'text_preview': text[:200]})
+            return jsonify({'success': True, 'doc_id': unique_id, 'filename': filename, 'state': state, 'duplicate': not created})
         except Exception as e:
             print(traceback.format_exc())
             return jsonify({'success': False, 'error': str(e)}), 500
 
     @app.route('/get_document/<doc_id>')
     def get_document(doc_id):
-        path = os.path.join(app.config['UPLOAD_FOLDER'], f"{doc_id}.json")
-        if not os.path.exists(path): return jsonify({'error': 'No encontrado'}), 404
-        with open(path, 'r', encoding='utf-8') as f: doc = json.load(f)
+        doc = store.get_document(doc_id)
+        if not doc: return jsonify({'error': 'No encontrado'}), 404
         
-        import base64
-        imgs_b64 = []
-        for p in doc.get('image_paths', []):
-            fp = os.path.join(app.config['UPLOAD_FOLDER'], p)
-            if os.path.exists(fp):
-                with open(fp, 'rb') as i:
-                    b64 = base64.b64encode(i.read()).decode('utf-8')
-                    m = 'image/jpeg' if p.endswith(('jpg','jpeg')) else 'image/png'
-                    imgs_b64.append(f"data:{m};base64,{b64}")
-        doc['image_data'] = imgs_b64
+        # Solo metadata: las imágenes se piden página a página
+        doc['pages'] = page_urls(doc)
+        doc['page_count'] = len(doc['pages'])
+        doc['upload_time'] = doc['upload_date']
+        doc['text_content'] = store.get_text(doc_id)
+        doc['annotations'], doc['annotations_version'] = store.get_annotation_state(doc_id)
+        doc.pop('file_path', None)
         return jsonify(doc)
 
+    @app.route('/document/<doc_id>/status')
+    def document_status(doc_id):
+        doc = store.get_document(doc_id)
+        if not doc: return jsonify({'error': 'No encontrado'}), 404
+        pages = page_urls(doc)
+        # Huérfano (su worker ya no existe): pasa a `failed` para que el visor deje de esperar
+        processing = doc.get('processing') or {}
+        if doc.get('artifact_id') and jobs.is_orphaned(doc['artifact_id'], processing, processing_queue):
+            processing = jobs.fail_orphaned(store, doc['artifact_id'], processing)
+        processing = {k: v for k, v in processing.items() if k not in ('owner', 'updated_at')}
+        return jsonify({'success': True, 'doc_id': doc_id, **processing, 'pages': pages, 'page_count': len(pages)})
+
+    @app.route('/document/<doc_id>/page/<int:page_num>')
+    def get_page_image(doc_id, page_num):
+        doc = store.get_document(doc_id)
+        if not doc: return jsonify({'error': 'No encontrado'}), 404
+        pages = doc['pages']
+        if page_num < 0 or page_num >= len(pages) or not os.path.exists(pages[page_num]['path']):
+            return jsonify({'error': 'Página no encontrada'}), 404
+        width = request.args.get('w', type=int)
+        return send_file(variants.pick(pages[page_num], width) if width else pages[page_num]['path'], max_age=86400)
+
+    @app.route('/document/<doc_id>/page/<int:page_num>/tiles/<int:level>/<int:col>_<int:row>.<ext>')
+    def get_page_tile(doc_id, page_num, level, col, row, ext):
+        doc = store.get_document(doc_id)
+        if not doc: return jsonify({'error': 'No encontrado'}), 404
+        pages = doc['pages']
+        tiles = pages[page_num].get('tiles') if 0 <= page_num < len(pages) else None
+        if not tiles or ext != tiles['format']: return jsonify({'error': 'Tesela no encontrada'}), 404
+        return send_from_directory(tiles['path'], f"{level}/{col}_{row}.{ext}", max_age=86400)
+
     @app.route('/save_annotations', methods=['POST'])
     def save_annotations():
         try:
             d = request.json
-            path = os.path.join(app.config['UPLOAD_FOLDER'], f"{d['doc_id']}.json")
-            if not os.path.exists(path): return jsonify({'error': 'No existe'}), 404
-            with open(path, 'r', encoding='utf-8') as f: doc = json.load(f)
-            
-            doc['annotations'] = d.get('annotations', [])
-            doc['last_annotated'] = datetime.now().isoformat()
-            doc['status'] = 'saved'
-            
-            with open(path, 'w', encoding='utf-8') as f: json.dump(doc, f, ensure_ascii=False, indent=2)
-            return jsonify({'success': True})
+            try: anns = strokes.compact_all(d.get('annotations', []))
+            except ValueError as e: return jsonify({'error': str(e)}), 400
+            with metrics.stage('annotations_write'): version = store.set_annotations(d['doc_id'], anns)
+            if version is None: return jsonify({'error': 'No existe'}), 404
+            annotation_index.saved(d['doc_id'], version, anns)
+            store.update_document(d['doc_id'], last_modified=datetime.now().isoformat(), status='saved')
+            thumbs.schedule(d['doc_id'])
+            return jsonify({'success': True, 'version': version})
+        except Exception as e: return jsonify({'error': str(e)}), 500
+
+    @app.route('/annotations/<doc_id>')
+    def get_annotations(doc_id):
+        anns, version = store.get_annotation_state(doc_id)
+        if anns is None: return jsonify({'error': 'No existe'}), 404
+        return jsonify({'success': True, 'annotations': anns, 'version': version})
+
+    @app.route('/annotations/<doc_id>/query')
+    def query_annotations(doc_id):
+        # Solo lo que cae en ?pages=2-5 y ?rect=x0,y0,x1,y1 (normalizado), desde la rejilla en memoria
+        try: pages, rect = spatial.parse_query(request.args)
+        except ValueError as e: return jsonify({'error': str(e)}), 400
+        anns, version = annotation_index.query(doc_id, pages=pages, rect=rect)
+        if anns is None: return jsonify({'error': 'No existe'}), 404
+        return jsonify({'success': True, 'annotations': anns, 'version': version})
+
+    @app.route('/annotations/<doc_id>/patch', methods=['POST'])
+    def patch_annotations(doc_id):
+        # Guardado incremental: solo viaja y se escribe lo que ha cambiado
+        try:
+            d = request.json or {}
+            add, remove = d.get('add', []), d.get('remove', [])
+            if not isinstance(d.get('base_version'), int) or not all(isinstance(a, dict) and a.get('id') for a in add):
+                return jsonify({'error': 'Faltan base_version o ids'}), 400
+            try: add = strokes.compact_all(add)
+            except ValueError as e: return jsonify({'error': str(e)}), 400
+            try:
+                with metrics.stage('annotations_write'):
+                    version = store.patch_annotations(doc_id, d['base_version'], add=add, remove=remove)
+            except storage.VersionConflict as e: return jsonify({'error': 'Versión obsoleta', 'version': e.version}), 409
+            if version is None: return jsonify({'error': 'No existe'}), 404
+            annotation_index.patched(doc_id, d['base_version'], version, add=add, remove=remove)
+            store.update_document(doc_id, last_modified=datetime.now().isoformat(), status='saved')
+            thumbs.schedule(doc_id)
+            return jsonify({'success': True, 'version': version})
         except Exception as e: return jsonify({'error': str(e)}), 500
 
     @app.route('/list_documents')
     def list_documents():
-        files = []
-        folder = app.config['UPLOAD_FOLDER']
-        if not os.path.exists(folder): return jsonify({'success': True, 'documents': []})
-        
-        for fn in os.listdir(folder):
-            if fn.endswith('.json'):
-                try:
-                    with open(os.path.join(folder, fn), 'r', encoding='utf-8') as f:
-                        d = json.load(f)
-                        if d.get('status') == 'saved':
-                            files.append({'id':d['id'], 'filename':d['original_name'], 'date':d['upload_time'], 'file_type':d['file_type']})
-                except: pass
-        files.sort(key=lambda x: x['date'], reverse=True)
-        return jsonify({'success': True, 'documents': files})
+        # Servido desde el índice (status, upload_date): paginado con ?offset=&limit=
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+        docs, total = store.list_documents(offset=offset, limit=limit, status='saved')
+        files = [{'id': d['id'], 'filename': d['original_name'], 'date': d['upload_date'], 'file_type': d['file_type'],
+                  'thumbnail': thumbnail_url(d)} for d in docs]
+        return jsonify({'success': True, 'documents': files, 'total': total, 'offset': offset, 'limit': limit})
+
+    def thumbnail_url(d):
+        # Sin miniatura todavía: se genera en segundo plano y sale en la próxima lista
+        if not d.get('thumbnail'): thumbs.schedule(d['id']); return None
+        return url_for('get_thumbnail', doc_id=d['id'], key=d['thumbnail'], ext=variants.extension())
+
+    @app.route('/document/<doc_id>/thumbnail/<key>.<ext>')
+    def get_thumbnail(doc_id, key, ext):
+        # La clave cambia con la miniatura: caché del navegador sin caducidad
+        data = thumbs.get(doc_id, key) if ext == variants.extension() else None
+        if data is None: return jsonify({'error': 'No existe'}), 404
+        r = send_file(BytesIO(data), mimetype=f"image/{'jpeg' if ext == 'jpg' else ext}")
+        r.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return r
+
+    @app.route('/search')
+    def search_documents():
+        # ?q=&limit=&offset= : documentos guardados ordenados por relevancia, con páginas y fragmentos
+        q = request.args.get('q', '').strip()
+        if not q: return jsonify({'error': 'Falta q'}), 400
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+        start = time.perf_counter()
+        # Paginación y total sobre los documentos guardados, no sobre los contenidos del índice
+        results, total = search_index.search(q, limit=limit, offset=offset,
+                                             documents=lambda keys: store.documents_by_content(keys, status='saved'))
+        found = [{'id': r['document']['id'], 'filename': r['document']['original_name'], 'date': r['document']['upload_date'],
+                  'file_type': r['document']['file_type'], 'score': r['score'], 'matching_pages': r['page_count'],
+                  'pages': r['pages']} for r in results]
+        return jsonify({'success': True, 'query': q, 'documents': found, 'total': total, 'offset': offset, 'limit': limit,
+                        'took_ms': round((time.perf_counter() - start) * 1000, 2)})
 
     @app.route('/download_annotated/<doc_id>')
     def download_annotated(doc_id):
         try:
-            path = os.path.join(app.config['UPLOAD_FOLDER'], f"{doc_id}.json")
-            if not os.path.exists(path): return jsonify({'error': 'No existe'}), 404
-            with open(path, 'r', encoding='utf-8') as f: doc = json.load(f)
-            
-            anns = doc.get('annotations', [])
-            paths = doc.get('image_paths', [])
-            text = doc.get('text_content', '')
-            output_imgs = []
-
-            if paths:
-                for i, p in enumerate(paths):
-                    fp = os.path.join(app.config['UPLOAD_FOLDER'], p)
-                    if os.path.exists(fp):
-                        img = Image.open(fp).convert('RGB')
-                        output_imgs.append(utils.process_annotations_on_image(img, anns, i))
+            doc = store.get_document(doc_id)
+            if not doc: return jsonify({'error': 'No existe'}), 404
             
-            if not output_imgs:
-                print("Generando desde texto...")
-                text_pages = utils.create_pages_from_text(text)
-                for i, page_img in enumerate(text_pages):
-                    output_imgs.append(utils.process_annotations_on_image(page_img, anns, i))
+            anns = store.get_annotations(doc_id)
+
+            # PDF: capa vectorial sobre el original (sin rasterizar, conserva la capa de texto)
+            if doc['file_type'] == 'pdf' and os.path.exists(doc['file_path']):
+                buffer = tempfile.SpooledTemporaryFile(max_size=export.EXPORT_MEMORY_BUDGET_MB * 1024 * 1024)
+                export.annotate_pdf(doc['file_path'], anns, buffer, image_widths=[p['width'] for p in doc['pages']])
+                buffer.seek(0)
+                return send_file(buffer, mimetype='application/pdf', as_attachment=True,
+                                 download_name=f"annotated_{doc['original_name']}")
 
+            paths = [p['path'] for p in doc['pages'] if os.path.exists(p['path'])]
             out_name = f"annotated_{doc['original_name']}"
-            if doc['file_type'] not in ['png','jpg','jpeg']: 
-                if not out_name.endswith('.pdf'): out_name = os.path.splitext(out_name)[0] + '.pdf'
-                save_path = os.path.join(app.config['ANNOTATED_FOLDER'], out_name)
-                output_imgs[0].save(save_path, "PDF", resolution=100.0, save_all=True, append_images=output_imgs[1:])
+
+            if doc['file_type'] in ['png','jpg','jpeg'] and paths:
+                fmt = 'PNG' if doc['file_type'] == 'png' else 'JPEG'
+                key = pagecache.page_key(pagecache.file_signature(paths[0]), anns, fmt)
+                data = page_cache.get(key, doc['file_type'])
+                if data is None:
+                    out = BytesIO()
+                    next(export.annotated_pages([export.load_page_image(paths[0])], anns)).save(out, fmt)
+                    data = out.getvalue()
+                    page_cache.put(key, data, doc['file_type'])
+                return send_file(BytesIO(data), mimetype=f"image/{fmt.lower()}", as_attachment=True, download_name=out_name)
+
+            # Una página en memoria cada vez; las que no han cambiado salen de la caché
+            if paths: sources = export.image_sources(paths)
             else:
-                save_path = os.path.join(app.config['ANNOTATED_FOLDER'], out_name)
-                output_imgs[0].save(save_path)
-            
-            return send_file(save_path, as_attachment=True)
+                print("Generando desde texto...")
+                sources = export.text_sources(store.get_text(doc_id) or '')
+            if not out_name.endswith('.pdf'): out_name = os.path.splitext(out_name)[0] + '.pdf'
+            return Response(stream_with_context(export.stream_jpeg_pdf(export.cached_pages(sources, anns, page_cache))),
+                            mimetype='application/pdf', headers=export.attachment_headers(out_name))
 
         except Exception as e:
             print(traceback.format_exc())
@@ -156,16 +339,54 @@ def register_routes(app):
 
     @app.route('/delete_document/<doc_id>', methods=['DELETE'])
     def delete_document(doc_id):
-        path = os.path.join(app.config['UPLOAD_FOLDER'], f"{doc_id}.json")
-        if os.path.exists(path):
-            os.remove(path)
-            return jsonify({'success': True})
-        return jsonify({'error': 'No encontrado'}), 404
+        doc = store.delete_document(doc_id)
+        if not doc: return jsonify({'error': 'No encontrado'}), 404
+        # Los ficheros y el texto indexado se borran con la última referencia al contenido
+        if not doc.get('shared'):
+            search_index.remove(doc.get('artifact_id') or doc['id'])
+            chat_index.remove(doc.get('artifact_id') or doc['id'])
+            storage.remove_files(storage.artifact_files(doc))
+        return jsonify({'success': True})
+
+    def chat_prompt(doc, d):
+        # Solo los fragmentos relevantes; los documentos anteriores se trocean en la primera pregunta
+        key = doc.get('artifact_id') or doc['id']
+        if not chat_index.has(key):
+            chat_index.index_pages(key, search_index.pages(key) or [store.get_text(doc['id']) or ''])
+        chunks = chat_index.retrieve(key, d.get('question'))
+        paged = bool(doc.get('pages'))  # texto sin páginas: se cita el fragmento
+        prompt = retrieval.build_prompt(retrieval.build_context(chunks, paged), d.get('question'), d.get('chat_history', []))
+        return llm.cache_key(key, d.get('question'), d.get('chat_history', [])), retrieval.sources(chunks, paged), prompt
+
+    def busy(e): return jsonify({'error': str(e), 'retry_after': e.retry_after}), 429, {'Retry-After': str(e.retry_after)}
 
     @app.route('/ask_chatbot', methods=['POST'])
     def ask_chatbot():
         d = request.json
-        path = os.path.join(app.config['UPLOAD_FOLDER'], f"{d['doc_id']}.json")
-        if not os.path.exists(path): return jsonify({'error': 'No existe'}), 404
-        with open(path, 'r', encoding='utf-8') as f: text = json.load(f).get('text_content', '')[:20000]
-        return jsonify({'success': True, 'answer': utils.ask_gemini(gemini_model, text, d.get('question'), d.get('chat_history', []))})
\ No newline at end of file
+        doc = store.get_document(d['doc_id'])
+        if not doc: return jsonify({'error': 'No existe'}), 404
+        if not chat_client.available: return jsonify({'success': True, 'answer': 'IA no configurada.', 'sources': []})
+        key, sources, prompt = chat_prompt(doc, d)
+        try:
+            answer = chat_client.ask(prompt, key)
+        except llm.Busy as e:
+            return busy(e)
+        except Exception as e:
+            answer = f"Error IA: {e}"
+        return jsonify({'success': True, 'answer': answer, 'sources': sources})
+
+    @app.route('/ask_chatbot/stream', methods=['POST'])
+    def ask_chatbot_stream():
+        # Respuesta trozo a trozo por Server-Sent Events; el evento `done` lleva ttft_ms y total_ms
+        started = time.perf_counter()
+        d = request.json
+        doc = store.get_document(d['doc_id'])
+        if not doc: return jsonify({'error': 'No existe'}), 404
+        if not chat_client.available: return jsonify({'error': 'IA no configurada.'}), 503
+        key, sources, prompt = chat_prompt(doc, d)
+        try:
+            pieces = chat_client.stream(prompt, key)
+        except llm.Busy as e:
+            return busy(e)
+        return Response(stream_with_context(llm.answer_events(pieces, sources, started)),
+                        mimetype='text/event-stream', headers=llm.SSE_HEADERS)
\ No newline at end of file
@@ -0,0 +1,360 @@
+"""
+Índice de búsqueda de texto completo
+Índice invertido en SQLite sobre el texto de cada página (capa de texto u OCR):
+por cada término guarda las páginas donde aparece, su frecuencia y las
+posiciones (offset de carácter) para construir los fragmentos. El texto se
+indexa por contenido (artefacto), así los documentos duplicados no se indexan
+dos veces. Ranking BM25 por página; un documento puntúa por su mejor página
+
+Los postings de cada término están ordenados por impacto (su peso BM25 sin
+idf), así una consulta lee solo los SEARCH_MAX_PAGES mejores de cada término y
+su coste no crece con el número de páginas aunque el término sea muy común
+"""
+
+import os
+import re
+import math
+import sqlite3
+import threading
+import contextlib
+import unicodedata
+from html import escape
+from functools import lru_cache
+
+# Parámetros de BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Caracteres de contexto a cada lado de la coincidencia en los fragmentos
+SNIPPET_CHARS = int(os.getenv('SEARCH_SNIPPET_CHARS', 80))
+# Postings leídos por término, de mayor a menor impacto (poda de la consulta)
+SEARCH_MAX_PAGES = int(os.getenv('SEARCH_MAX_PAGES', 1000))
+# Contenidos por consulta al buscar sus documentos (dos parámetros de SQLite por clave)
+_DOCUMENT_BATCH = 400
+
+STOPWORDS = frozenset("""
+a al algo algunas algunos ante antes como con contra cual cuando de del desde donde durante e el ella ellas
+ellos en entre era es esa esas ese eso esos esta estas este esto estos fue ha hay la las le les lo los mas me
+mi mientras muy ni no nos o os otra otro para pero por porque que quien se sea ser si sin sino sobre son su
+sus tambien te tiene tu un una uno unos y ya yo
+an and are as at be been but by for from had has have he her his if in into is it its not of on or our she
+so than that the their them then there these they this to was we were what when which who will with you
+""".split())
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+@lru_cache(maxsize=65536)
+def fold(word):
+    """Minúsculas y sin acentos: `Cláusula` -> `clausula`"""
+    decomposed = unicodedata.normalize('NFKD', word.lower())
+    if decomposed.isascii():
+        return decomposed
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    """Términos indexables de `text` con su posición: [(término, inicio, fin)]"""
+    tokens = []
+    for match in _WORD.finditer(text or ''):
+        term = fold(match.group())
+        if term in STOPWORDS or (len(term) < 2 and not term.isdigit()):
+            continue
+        tokens.append((term, match.start(), match.end()))
+    return tokens
+
+
+def snippet(text, start, end, width=None):
+    """Fragmento de `text` alrededor de [start, end) con la coincidencia marcada (HTML escapado)"""
+    width = SNIPPET_CHARS if width is None else width
+    left = max(0, start - width)
+    right = min(len(text), end + width)
+    # No cortar palabras por la mitad
+    while left > 0 and not text[left - 1].isspace() and start - left < width + 15:
+        left -= 1
+    while right < len(text) and not text[right].isspace() and right - end < width + 15:
+        right += 1
+    before, after = text[left:start], text[end:right]
+    before = escape(' '.join(before.split())) + (' ' if before[-1:].isspace() else '')
+    after = (' ' if after[:1].isspace() else '') + escape(' '.join(after.split()))
+    body = f"{before.lstrip()}<mark>{escape(text[start:end])}</mark>{after.rstrip()}"
+    return ('…' if left > 0 else '') + body + ('…' if right < len(text) else '')
+
+
+def _content_score(pages):
+    """Un contenido puntúa por su mejor página, con un pequeño extra por las demás"""
+    return pages[0][1] + 0.1 * sum(s for _, s in pages[1:])
+
+
+def bm25(tf, length, avg_length):
+    """Peso BM25 de un término en una página o fragmento (sin idf)"""
+    return tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+
+
+SCHEMA = """
+-- Texto de cada página indexada (para los fragmentos) y su longitud en términos
+CREATE TABLE IF NOT EXISTS search_pages (
+    key TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (key, page)
+) WITHOUT ROWID;
+
+-- Postings: término -> (artefacto, página) de mayor a menor impacto, con frecuencia y offsets de carácter
+CREATE TABLE IF NOT EXISTS search_postings (
+    term TEXT NOT NULL,
+    impact REAL NOT NULL,
+    key TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    positions TEXT NOT NULL,
+    PRIMARY KEY (term, impact DESC, key, page)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_search_postings_page ON search_postings (key, page, term);
+
+-- Nº de páginas que contienen cada término (idf)
+CREATE TABLE IF NOT EXISTS search_terms (
+    term TEXT PRIMARY KEY,
+    df INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- Totales para la longitud media de página (una sola fila)
+CREATE TABLE IF NOT EXISTS search_stats (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    pages INTEGER NOT NULL,
+    tokens INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO search_stats (id, pages, tokens) VALUES (0, 0, 0);
+"""
+
+
+class SqliteIndex:
+    """Base de los índices en SQLite: conexión por hilo en WAL, o una compartida en memoria"""
+
+    SCHEMA = ''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._shared = None
+        self._lock = contextlib.nullcontext()
+        if path == ':memory:':
+            # Cada conexión :memory: es otra base de datos: una sola, compartida con un lock
+            self._shared = sqlite3.connect(':memory:', check_same_thread=False, isolation_level=None)
+            self._shared.row_factory = sqlite3.Row
+            self._lock = threading.RLock()
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        if self._shared is not None:
+            return self._shared
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # Los postings se insertan repartidos por todo el árbol: más caché, menos lecturas
+            conn.execute('PRAGMA cache_size=-65536')
+            self._local.conn = conn
+        return conn
+
+
+class SearchIndex(SqliteIndex):
+    """Índice invertido incremental. `key` identifica el contenido (artefacto o documento antiguo)"""
+
+    SCHEMA = SCHEMA
+
+    def has(self, key):
+        with self._lock:
+            return self._conn().execute("SELECT 1 FROM search_pages WHERE key = ? LIMIT 1", (key,)).fetchone() is not None
+
+    def index_pages(self, key, pages):
+        """(Re)indexar el texto de `key`: `pages` es la lista de textos por página"""
+        with self._lock:
+            conn = self._conn()
+            stats = conn.execute("SELECT pages, tokens FROM search_stats").fetchone()
+            avg_length = stats['tokens'] / stats['pages'] if stats['pages'] else None
+
+            postings, page_rows, df, tokens_total = [], [], {}, 0
+            for page_num, text in enumerate(pages):
+                text = text or ''
+                by_term = {}
+                tokens = tokenize(text)
+                for term, start, _ in tokens:
+                    by_term.setdefault(term, []).append(start)
+                if not tokens:
+                    continue
+                page_rows.append((key, page_num, len(tokens), text))
+                tokens_total += len(tokens)
+                length = len(tokens)
+                for term, offsets in by_term.items():
+                    tf = len(offsets)
+                    impact = bm25(tf, length, avg_length or length)
+                    postings.append((term, impact, key, page_num, tf, length, ','.join(map(str, offsets))))
+                    df[term] = df.get(term, 0) + 1
+
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._remove(conn, key)
+                conn.executemany("INSERT INTO search_pages (key, page, length, content) VALUES (?, ?, ?, ?)", page_rows)
+                conn.executemany("INSERT INTO search_postings (term, impact, key, page, tf, length, positions) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?)", postings)
+                conn.executemany("INSERT INTO search_terms (term, df) VALUES (?, ?) "
+                                 "ON CONFLICT (term) DO UPDATE SET df = df + excluded.df", df.items())
+                conn.execute("UPDATE search_stats SET pages = pages + ?, tokens = tokens + ?",
+                             (len(page_rows), tokens_total))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return len(page_rows)
+
+    def remove(self, key):
+        """Quitar `key` del índice"""
+        with self._lock:
+            conn = self._conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._remove(conn, key)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def _remove(self, conn, key):
+        df = conn.execute("SELECT term, COUNT(*) AS pages FROM search_postings WHERE key = ? GROUP BY term", (key,)).fetchall()
+        if not df:
+            return
+        stats = conn.execute("SELECT COUNT(*) AS pages, COALESCE(SUM(length), 0) AS tokens "
+                             "FROM search_pages WHERE key = ?", (key,)).fetchone()
+        conn.executemany("UPDATE search_terms SET df = df - ? WHERE term = ?", ((r['pages'], r['term']) for r in df))
+        conn.execute("DELETE FROM search_terms WHERE df <= 0")
+        conn.execute("DELETE FROM search_postings WHERE key = ?", (key,))
+        conn.execute("DELETE FROM search_pages WHERE key = ?", (key,))
+        conn.execute("UPDATE search_stats SET pages = pages - ?, tokens = tokens - ?", (stats['pages'], stats['tokens']))
+
+    def search(self, query, limit=20, pages_per_doc=3, offset=0, documents=None):
+        """Contenidos más relevantes para `query` con sus mejores páginas y fragmentos
+
+        Devuelve (resultados, total) con resultados = [{'key', 'score', 'pages': [{'page', 'score', 'snippet'}]}]
+
+        Con `documents(claves) -> {clave: [documentos]}` (store.documents_by_content) se
+        pagina y se cuenta por documentos, ya filtrados: un resultado por documento, con
+        su resumen en 'document', en el orden de relevancia de su contenido
+        """
+        ranked, idf = self._rank(query)
+        if documents is None:
+            entries = [(key, pages, None) for key, pages in ranked]
+        else:
+            entries = []
+            for i in range(0, len(ranked), _DOCUMENT_BATCH):
+                batch = ranked[i:i + _DOCUMENT_BATCH]
+                found = documents([key for key, _ in batch])
+                entries.extend((key, pages, doc) for key, pages in batch for doc in found.get(key, []))
+        total = len(entries)
+
+        results = []
+        hits = {}
+        with self._lock:
+            conn = self._conn()
+            for key, pages, doc in entries[offset:offset + limit]:
+                # Los duplicados de un mismo contenido comparten fragmentos
+                if key not in hits:
+                    hits[key] = [{'page': page, 'score': round(score, 4), 'snippet': self._snippet(conn, key, page, idf)}
+                                 for page, score in pages[:pages_per_doc]]
+                result = {'key': key, 'score': round(_content_score(pages), 4), 'pages': hits[key],
+                          'page_count': len(pages)}
+                if doc is not None:
+                    result['document'] = doc
+                results.append(result)
+        return results, total
+
+    def _rank(self, query):
+        """Contenidos con alguna coincidencia, de más a menos relevante: ([(clave, [(página, puntuación)])], idf)"""
+        terms = list(dict.fromkeys(t for t, _, _ in tokenize(query)))
+        if not terms:
+            return [], {}
+
+        with self._lock:
+            conn = self._conn()
+            stats = conn.execute("SELECT pages, tokens FROM search_stats").fetchone()
+            if not stats['pages']:
+                return [], {}
+            avg_length = stats['tokens'] / stats['pages']
+            marks = ', '.join('?' * len(terms))
+            df = {r['term']: r['df'] for r in conn.execute(
+                f"SELECT term, df FROM search_terms WHERE term IN ({marks})", terms)}
+            idf = {t: math.log(1 + (stats['pages'] - df[t] + 0.5) / (df[t] + 0.5)) for t in terms if t in df}
+            if not idf:
+                return [], {}
+
+            # Solo los postings de más impacto de cada término; BM25 exacto sobre ellos
+            scores = {}
+            for term, weight in idf.items():
+                for row in conn.execute("SELECT key, page, tf, length FROM search_postings WHERE term = ? "
+                                        "ORDER BY impact DESC LIMIT ?", (term, SEARCH_MAX_PAGES)):
+                    hit = (row['key'], row['page'])
+                    scores[hit] = scores.get(hit, 0) + weight * bm25(row['tf'], row['length'], avg_length)
+        rows = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+
+        by_key = {}
+        for (key, page), score in rows:
+            by_key.setdefault(key, []).append((page, score))
+        return sorted(by_key.items(), key=lambda kv: _content_score(kv[1]), reverse=True), idf
+
+    def pages(self, key):
+        """Texto indexado de cada página de `key` (las páginas sin texto quedan vacías)"""
+        with self._lock:
+            rows = self._conn().execute("SELECT page, content FROM search_pages WHERE key = ? ORDER BY page", (key,)).fetchall()
+        texts = [''] * (rows[-1]['page'] + 1 if rows else 0)
+        for row in rows:
+            texts[row['page']] = row['content']
+        return texts
+
+    def _snippet(self, conn, key, page, idf):
+        """Fragmento alrededor de la aparición del término más raro de la consulta"""
+        marks = ', '.join('?' * len(idf))
+        found = conn.execute(
+            f"SELECT term, positions FROM search_postings INDEXED BY idx_search_postings_page "
+            f"WHERE key = ? AND page = ? AND term IN ({marks})",
+            [key, page] + list(idf)
+        ).fetchall()
+        text = conn.execute("SELECT content FROM search_pages WHERE key = ? AND page = ?", (key, page)).fetchone()
+        if not found or text is None:
+            return ''
+        best = max(found, key=lambda r: idf[r['term']])
+        start = int(best['positions'].split(',', 1)[0])
+        match = _WORD.match(text['content'], start)
+        return snippet(text['content'], start, match.end() if match else start)
+
+
+def open_index(store):
+    """Índice junto al almacenamiento: en el mismo fichero SQLite, o en memoria"""
+    path = getattr(store, 'path', None) or ':memory:'
+    return SearchIndex(path)
+
+
+def backfill(index, store, batch=200):
+    """Indexar los documentos que aún no están en el índice (anteriores al índice)"""
+    indexed, offset = 0, 0
+    while True:
+        docs, total = store.list_documents(offset=offset, limit=batch)
+        for summary in docs:
+            doc = store.get_document(summary['id'])
+            key = doc and (doc.get('artifact_id') or doc['id'])
+            if not key or index.has(key):
+                continue
+            text = store.get_text(doc['id'])
+            if text:
+                index.index_pages(key, [text])
+                indexed += 1
+        offset += batch
+        if offset >= total:
+            break
+    if indexed:
+        print(f"🔎 Indexados {indexed} documentos para la búsqueda")
+    return indexed
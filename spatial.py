@@ -0,0 +1,202 @@
+"""
+Índice espacial de las anotaciones
+Por cada documento, una rejilla por página (ANNOTATION_GRID x ANNOTATION_GRID
+celdas sobre la página normalizada) con la caja de cada trazo y nota: una
+consulta por rectángulo o por rango de páginas mira solo las celdas que toca en
+lugar de recorrer todas las anotaciones del documento.
+
+Los índices viven en memoria, uno por documento y versión de sus anotaciones.
+Al guardar se actualizan con el propio cambio; si la versión no cuadra (otro
+proceso guardó entre medias, o el documento salió de la caché) se rehacen en la
+siguiente consulta
+"""
+
+import os
+import math
+import threading
+from collections import OrderedDict
+
+import strokes
+
+# Celdas por lado de página y documentos con índice en memoria
+ANNOTATION_GRID = int(os.getenv('ANNOTATION_GRID', 16))
+ANNOTATION_INDEX_DOCS = int(os.getenv('ANNOTATION_INDEX_DOCS', 64))
+# Ancho (px) al que se pasan a fracción de página los grosores y letras del visor,
+# que dependen del canvas. Pequeño a propósito: mejor una caja de más que de menos
+_REFERENCE_WIDTH = 600
+
+
+def bbox(ann):
+    """Caja normalizada (x0, y0, x1, y1) de una anotación, o None si no pinta nada"""
+    size = ann.get('size') or 3
+    if ann.get('type') == 'text':
+        if not ann.get('text'):
+            return None
+        # `y` es la línea base, como en fillText
+        h = size * 10 / _REFERENCE_WIDTH
+        x, y = ann.get('x', 0), ann.get('y', 0)
+        return (x, y - h, x + len(ann['text']) * h * 0.7, y + h * 0.3)
+    if 'pts' not in ann and 'points' not in ann:
+        return None
+    q = strokes.quantized(ann)
+    if len(q) < 4:
+        return None
+    pad = size * (3 if ann.get('type') == 'highlighter' else 1) / _REFERENCE_WIDTH
+    xs, ys = q[0::2], q[1::2]
+    return (min(xs) / strokes.QUANT - pad, min(ys) / strokes.QUANT - pad,
+            max(xs) / strokes.QUANT + pad, max(ys) / strokes.QUANT + pad)
+
+
+def intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class AnnotationIndex:
+    """Rejilla por página de las anotaciones de un documento
+
+    Mantiene el orden de la lista (el de pintado) con las mismas reglas que
+    storage.apply_annotation_patch: reemplazar una anotación conserva su puesto
+    """
+
+    def __init__(self, annotations=(), grid=None):
+        self.grid = grid or ANNOTATION_GRID
+        self._items = {}  # id -> (anotación, página, caja, posición)
+        self._pages = {}  # página -> ids
+        self._cells = {}  # página -> {(col, fila): ids}
+        self._next = 0
+        for ann in annotations:
+            self._add(ann)
+
+    def __len__(self):
+        return len(self._items)
+
+    def _cover(self, box):
+        """Celdas que toca una caja (recortada a la página)"""
+        last = self.grid - 1
+        c0, r0, c1, r1 = (min(last, int(min(1.0, max(0.0, v)) * self.grid)) for v in box)
+        return [(col, row) for col in range(c0, c1 + 1) for row in range(r0, r1 + 1)]
+
+    def _add(self, ann):
+        old = self._items.get(ann['id'])
+        if old:
+            self._remove(ann['id'])
+            position = old[3]
+        else:
+            position = self._next
+            self._next += 1
+        page, box = ann.get('page', 0), bbox(ann)
+        self._items[ann['id']] = (ann, page, box, position)
+        self._pages.setdefault(page, set()).add(ann['id'])
+        if box:
+            cells = self._cells.setdefault(page, {})
+            for cell in self._cover(box):
+                cells.setdefault(cell, set()).add(ann['id'])
+
+    def _remove(self, ann_id):
+        item = self._items.pop(ann_id, None)
+        if item is None:
+            return
+        _, page, box, _ = item
+        self._pages[page].discard(ann_id)
+        if box:
+            cells = self._cells[page]
+            for cell in self._cover(box):
+                cells[cell].discard(ann_id)
+
+    def apply(self, add=(), remove=()):
+        """Aplicar un cambio incremental (mismo formato que patch_annotations)"""
+        for ann_id in remove:
+            self._remove(ann_id)
+        for ann in add:
+            self._add(ann)
+
+    def query(self, pages=None, rect=None):
+        """Anotaciones de las páginas `pages` (primera, última; todas si es None) que
+        tocan el rectángulo normalizado `rect` (x0, y0, x1, y1; la página entera si es None)"""
+        selected = [p for p in self._pages if pages is None or pages[0] <= p <= pages[1]]
+        found = set()
+        for page in selected:
+            if rect is None:
+                found |= self._pages[page]
+                continue
+            cells = self._cells.get(page, {})
+            for cell in self._cover(rect):
+                for ann_id in cells.get(cell, ()):
+                    if ann_id not in found and intersects(self._items[ann_id][2], rect):
+                        found.add(ann_id)
+        return [self._items[i][0] for i in sorted(found, key=lambda i: self._items[i][3])]
+
+
+class AnnotationIndexes:
+    """Índices de los últimos documentos consultados (LRU), al día con la versión guardada"""
+
+    def __init__(self, store, size=ANNOTATION_INDEX_DOCS):
+        self.store = store
+        self.size = size
+        self._items = OrderedDict()  # doc_id -> (versión, índice)
+        self._lock = threading.Lock()
+
+    def query(self, doc_id, pages=None, rect=None):
+        """(anotaciones que cumplen la consulta, versión), o (None, None) si el documento no existe"""
+        version = self.store.get_annotation_version(doc_id)
+        if version is None:
+            return None, None
+        with self._lock:
+            item = self._items.get(doc_id)
+            if item and item[0] == version:
+                self._items.move_to_end(doc_id)
+                return item[1].query(pages, rect), version
+        # Fuera del candado: leer y construir es lo caro
+        annotations, version = self.store.get_annotation_state(doc_id)
+        if annotations is None:
+            return None, None
+        index = AnnotationIndex(annotations)
+        found = index.query(pages, rect)
+        self._put(doc_id, version, index)
+        return found, version
+
+    def _put(self, doc_id, version, index):
+        if self.size <= 0:
+            return
+        with self._lock:
+            item = self._items.get(doc_id)
+            if item and item[0] > version:
+                return
+            self._items[doc_id] = (version, index)
+            self._items.move_to_end(doc_id)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def saved(self, doc_id, version, annotations):
+        """Tras set_annotations: índice nuevo con la lista guardada"""
+        self._put(doc_id, version, AnnotationIndex(annotations))
+
+    def patched(self, doc_id, base_version, version, add=(), remove=()):
+        """Tras patch_annotations: aplicar el cambio al índice si estaba en `base_version`"""
+        with self._lock:
+            item = self._items.get(doc_id)
+            if item is None:
+                return
+            if item[0] == base_version and version == base_version + 1:
+                item[1].apply(add, remove)
+                self._items[doc_id] = (version, item[1])
+            else:
+                del self._items[doc_id]
+
+
+def parse_query(args):
+    """Parámetros de consulta ?pages=2-5 (o ?pages=3) y ?rect=x0,y0,x1,y1 (normalizados)
+
+    Devuelve (pages, rect); ValueError si están mal formados
+    """
+    pages = rect = None
+    if args.get('pages'):
+        first, _, last = args['pages'].partition('-')
+        pages = (int(first), int(last or first))
+        if pages[0] > pages[1]:
+            raise ValueError('Rango de páginas vacío')
+    if args.get('rect'):
+        rect = tuple(float(v) for v in args['rect'].split(','))
+        if len(rect) != 4 or not all(math.isfinite(v) for v in rect) or rect[0] > rect[2] or rect[1] > rect[3]:
+            raise ValueError('rect debe ser x0,y0,x1,y1 con x0 <= x1 e y0 <= y1')
+    return pages, rect
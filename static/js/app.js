@@ -10,13 +10,19 @@ const State = {
     page: 0,
     pages: 0,
     annotations: [],
+    annVersion: 0,           // versión de anotaciones en el servidor sobre la que trabajamos
+    pendingAdd: new Map(),   // id -> anotación nueva sin guardar
+    pendingRemove: new Set(),// ids borrados sin guardar
+    sendingAdd: new Map(),   // lo que va en el parche en vuelo (apartado de pending*)
+    sendingRemove: new Set(),
     tool: 'pen',
     color: '#FFEB3B',
     size: 3,
     drawing: false,
     lastPoint: null,
     currentAnn: null,
-    images: [],
+    images: [],        // [{url, width, height}] - solo metadata, las imágenes se piden bajo demanda
+    pageCache: new Map(), // página -> Image precargada (solo las cercanas a State.page)
     text: '',
     filename: ''
 };
@@ -172,6 +178,11 @@ function init() {
     document.getElementById('deleteBtn')?.addEventListener('click', deleteDoc);
     document.getElementById('clearAllBtn')?.addEventListener('click', clearPage);
     
+    // Zoom (pellizco o ventana): pedir una variante mayor o las teselas visibles
+    window.visualViewport?.addEventListener('resize', scheduleZoomUpdate);
+    window.visualViewport?.addEventListener('scroll', scheduleZoomUpdate);
+    window.addEventListener('resize', scheduleZoomUpdate);
+    
     loadDocs();
     
     console.log('✅ Init completo');
@@ -221,8 +232,14 @@ async function loadDoc(docId) {
         State.docId = docId;
         State.filename = doc.original_name;
         State.text = doc.text_content || '';
-        State.annotations = doc.annotations || [];
-        State.images = doc.image_data || [];
+        State.annotations = (doc.annotations || []).map(decodeStroke);
+        State.annVersion = doc.annotations_version || 0;
+        State.pendingAdd.clear();
+        State.pendingRemove.clear();
+        State.sendingAdd = new Map();
+        State.sendingRemove = new Set();
+        State.images = doc.pages || [];
+        State.pageCache.clear();
         State.pages = State.images.length || 1;
         State.page = 0;
         
@@ -234,11 +251,51 @@ async function loadDoc(docId) {
         updateNav();
         updateActionButtons(true);
         
+        const state = doc.processing?.state;
+        if (state && state !== 'ready' && state !== 'failed') pollStatus(docId);
+        
     } catch (error) {
         console.error('❌', error);
     }
 }
 
+// Seguir el procesamiento en segundo plano: las páginas aparecen según se renderizan
+const STATUS_POLL_MS = 1000;
+
+async function pollStatus(docId) {
+    while (State.docId === docId) {
+        try {
+            const res = await fetch(`/document/${docId}/status`);
+            const st = await res.json();
+            if (!st.success || State.docId !== docId) return;
+            
+            if (st.pages.length !== State.images.length) {
+                const firstPages = State.images.length === 0;
+                State.images = st.pages;
+                State.pages = State.images.length || 1;
+                if (firstPages) render();
+                updateNav();
+            }
+            
+            DOM.documentTitle.textContent = st.state === 'ready' || st.state === 'failed'
+                ? State.filename
+                : `${State.filename} (${st.state} ${st.pages_done}/${st.pages_total})`;
+            
+            if (st.state === 'ready') {
+                const doc = await (await fetch(`/get_document/${docId}`)).json();
+                State.text = doc.text_content || '';
+                if (State.images.length === 0) render();
+                return;
+            }
+            if (st.state === 'failed') return notify('❌ Error procesando');
+        } catch (error) {
+            console.error('❌', error);
+            return;
+        }
+        await new Promise(r => setTimeout(r, STATUS_POLL_MS));
+    }
+}
+
 // ========================================
 // RENDER
 // ========================================
@@ -247,13 +304,17 @@ function render() {
     console.log('🖼️ Renderizando página:', State.page);
     
     if (State.images.length > 0) {
-        const img = State.images[State.page];
-        DOM.textContent.innerHTML = `<img src="${img}" style="max-width:100%; width:100%; height:auto; display:block;">`;
+        const page = State.images[State.page];
+        DOM.textContent.innerHTML = `<div style="position:relative;">
+            <img src="${pageSrc(page)}" width="${page.width}" height="${page.height}" style="max-width:100%; width:100%; height:auto; display:block;">
+            <div class="page-tiles" style="position:absolute; inset:0; pointer-events:none;"></div>
+        </div>`;
         
         DOM.textContent.querySelector('img').onload = () => {
             setupCanvas();
             redraw();
         };
+        prefetchPages();
     } else {
         DOM.textContent.innerHTML = `<div style="padding:20px; white-space:pre-wrap;">${escapeHtml(State.text)}</div>`;
         setupCanvas();
@@ -261,6 +322,100 @@ function render() {
     }
 }
 
+// Precargar solo las páginas vecinas y olvidar las lejanas
+const PREFETCH_RADIUS = 1;
+
+function prefetchPages() {
+    for (const n of State.pageCache.keys()) {
+        if (Math.abs(n - State.page) > PREFETCH_RADIUS) State.pageCache.delete(n);
+    }
+    for (let n = State.page - PREFETCH_RADIUS; n <= State.page + PREFETCH_RADIUS; n++) {
+        if (n < 0 || n >= State.images.length || n === State.page || State.pageCache.has(n)) continue;
+        const img = new Image();
+        img.src = pageSrc(State.images[n]);
+        State.pageCache.set(n, img);
+    }
+}
+
+// Píxeles de imagen que hacen falta para el ancho en pantalla (densidad y zoom incluidos)
+function neededWidth() {
+    const zoom = window.visualViewport?.scale || 1;
+    return DOM.textContent.clientWidth * (window.devicePixelRatio || 1) * zoom;
+}
+
+// Variante más pequeña que cubre el ancho necesario; si ninguna llega, el original
+function pageSrc(page) {
+    const need = neededWidth();
+    const fit = (page.variants || []).find(v => v.width >= need);
+    return fit ? fit.url : page.url;
+}
+
+let zoomTimer = null;
+
+function scheduleZoomUpdate() {
+    clearTimeout(zoomTimer);
+    zoomTimer = setTimeout(updateZoom, 150);
+}
+
+function updateZoom() {
+    const page = State.images[State.page];
+    const img = DOM.textContent?.querySelector('img');
+    if (!page || !img) return;
+    
+    // Las páginas grandes se completan con teselas; el resto sube de variante
+    const largest = page.variants?.length ? page.variants[page.variants.length - 1].width : page.width;
+    if (page.tiles && neededWidth() > largest) return drawTiles(page, img);
+    DOM.textContent.querySelector('.page-tiles')?.replaceChildren();
+    const src = pageSrc(page);
+    const current = (page.variants || []).findIndex(v => img.src.endsWith(v.url));
+    const wanted = (page.variants || []).findIndex(v => v.url === src);
+    // Solo se cambia a una imagen mayor: bajar de resolución no aporta nada
+    if (current !== -1 && (wanted === -1 || wanted > current)) img.src = src;
+}
+
+// Teselas del nivel adecuado que caen dentro de lo que se ve, sobre la variante ya cargada
+function drawTiles(page, img) {
+    const layer = DOM.textContent.querySelector('.page-tiles');
+    const tiles = page.tiles;
+    const need = neededWidth();
+    let level = tiles.levels.findIndex(([w]) => w >= need);
+    if (level === -1) level = tiles.levels.length - 1;
+    const [lw, lh] = tiles.levels[level];
+    
+    const rect = img.getBoundingClientRect();
+    const vv = window.visualViewport;
+    const view = vv
+        ? {left: vv.offsetLeft, top: vv.offsetTop, right: vv.offsetLeft + vv.width, bottom: vv.offsetTop + vv.height}
+        : {left: 0, top: 0, right: window.innerWidth, bottom: window.innerHeight};
+    const toTile = (px, size, levelSize) => Math.floor(px / size * levelSize / tiles.size);
+    const cols = [Math.max(0, toTile(view.left - rect.left, rect.width, lw)),
+                  Math.min(Math.ceil(lw / tiles.size) - 1, toTile(view.right - rect.left, rect.width, lw))];
+    const rows = [Math.max(0, toTile(view.top - rect.top, rect.height, lh)),
+                  Math.min(Math.ceil(lh / tiles.size) - 1, toTile(view.bottom - rect.top, rect.height, lh))];
+    
+    const wanted = new Set();
+    for (let row = rows[0]; row <= rows[1]; row++) {
+        for (let col = cols[0]; col <= cols[1]; col++) {
+            const key = `${level}/${col}_${row}`;
+            wanted.add(key);
+            if (layer.querySelector(`[data-tile="${key}"]`)) continue;
+            const tile = new Image();
+            tile.dataset.tile = key;
+            tile.src = `${tiles.url}/${key}.${tiles.format}`;
+            const x = col * tiles.size, y = row * tiles.size;
+            Object.assign(tile.style, {
+                position: 'absolute',
+                left: `${x / lw * 100}%`, top: `${y / lh * 100}%`,
+                width: `${Math.min(tiles.size, lw - x) / lw * 100}%`, height: `${Math.min(tiles.size, lh - y) / lh * 100}%`
+            });
+            layer.appendChild(tile);
+        }
+    }
+    for (const tile of [...layer.children]) {
+        if (!wanted.has(tile.dataset.tile)) tile.remove();
+    }
+}
+
 function setupCanvas() {
     const dpr = window.devicePixelRatio || 1;
     DOM.canvas.style.width = DOM.textContent.offsetWidth + 'px';
@@ -318,7 +473,7 @@ function startDraw(e) {
     if (State.tool === 'text') {
         const text = prompt('Texto:');
         if (text) {
-            State.annotations.push({
+            addAnnotation({
                 type: 'text',
                 color: State.color,
                 size: State.size,
@@ -339,6 +494,7 @@ function startDraw(e) {
     }
     
     State.currentAnn = {
+        id: newAnnId(),
         type: State.tool,
         color: State.color,
         size: State.size,
@@ -377,7 +533,7 @@ function draw(e) {
 
 function endDraw() {
     if (State.currentAnn && State.currentAnn.points && State.currentAnn.points.length > 0) {
-        State.annotations.push(State.currentAnn);
+        addAnnotation(State.currentAnn);
     }
     State.drawing = false;
     State.currentAnn = null;
@@ -406,27 +562,125 @@ function getPos(e) {
     };
 }
 
+// ========================================
+// TRAZOS COMPACTOS (mismo formato que strokes.py)
+// ========================================
+
+// Coordenadas cuantizadas a 1/16384 de la página, como diferencias con el punto
+// anterior en varints zigzag, en base64url. En el visor se trabaja con `points`
+const STROKE_QUANT = 16384;
+
+function encodeStroke(ann) {
+    if (!ann.points) return ann;
+    let bin = '';
+    let px = 0, py = 0;
+    for (const p of ann.points) {
+        const x = Math.round(p.x * STROKE_QUANT), y = Math.round(p.y * STROKE_QUANT);
+        for (const d of [x - px, y - py]) {
+            let v = d < 0 ? -2 * d - 1 : 2 * d;
+            while (v >= 0x80) {
+                bin += String.fromCharCode((v % 0x80) | 0x80);
+                v = Math.floor(v / 0x80);
+            }
+            bin += String.fromCharCode(v);
+        }
+        px = x;
+        py = y;
+    }
+    const {points, ...rest} = ann;
+    return {...rest, pts: btoa(bin).replace(/\+/g, '-').replace(/\//g, '_').replace(/=+$/, '')};
+}
+
+function decodeStroke(ann) {
+    if (!ann.pts) return ann;
+    const bin = atob(ann.pts.replace(/-/g, '+').replace(/_/g, '/'));
+    const points = [];
+    const xy = [0, 0];
+    let v = 0, mul = 1, axis = 0;
+    for (let i = 0; i < bin.length; i++) {
+        const b = bin.charCodeAt(i);
+        v += (b & 0x7f) * mul;
+        if (b & 0x80) {
+            mul *= 0x80;
+            continue;
+        }
+        xy[axis] += v % 2 ? -(v + 1) / 2 : v / 2;
+        if (axis === 1) points.push({x: xy[0] / STROKE_QUANT, y: xy[1] / STROKE_QUANT});
+        axis ^= 1;
+        v = 0;
+        mul = 1;
+    }
+    const {pts, ...rest} = ann;
+    return {...rest, points};
+}
+
+// ========================================
+// CAMBIOS PENDIENTES (guardado incremental)
+// ========================================
+
+function newAnnId() {
+    if (window.crypto?.randomUUID) return crypto.randomUUID().replace(/-/g, '');
+    return Date.now().toString(36) + Math.random().toString(36).slice(2);
+}
+
+function addAnnotation(ann) {
+    if (!ann.id) ann.id = newAnnId();
+    State.annotations.push(ann);
+    State.pendingAdd.set(ann.id, ann);
+}
+
+function removeAnnotations(shouldRemove) {
+    State.annotations = State.annotations.filter(ann => {
+        if (!shouldRemove(ann)) return true;
+        // Si nunca llegó al servidor basta con olvidarla
+        if (State.pendingAdd.has(ann.id)) State.pendingAdd.delete(ann.id);
+        else State.pendingRemove.add(ann.id);
+        return false;
+    });
+}
+
+// Caja de cada trazo, calculada una vez: el borrador descarta los trazos lejanos
+// sin recorrer sus puntos (los trazos no cambian después de dibujarlos)
+const strokeBoxes = new WeakMap();
+
+function strokeBox(ann) {
+    let box = strokeBoxes.get(ann);
+    if (!box) {
+        box = [Infinity, Infinity, -Infinity, -Infinity];
+        for (const p of ann.points) {
+            box[0] = Math.min(box[0], p.x);
+            box[1] = Math.min(box[1], p.y);
+            box[2] = Math.max(box[2], p.x);
+            box[3] = Math.max(box[3], p.y);
+        }
+        strokeBoxes.set(ann, box);
+    }
+    return box;
+}
+
 function erase(pos) {
     const threshold = 0.05;
-    State.annotations = State.annotations.filter(ann => {
-        if (ann.page !== State.page) return true;
+    removeAnnotations(ann => {
+        if (ann.page !== State.page) return false;
         if (ann.type === 'text') {
             const dist = Math.sqrt(Math.pow(ann.x - pos.x, 2) + Math.pow(ann.y - pos.y, 2));
-            return dist > threshold;
+            return dist <= threshold;
         } else if (ann.points) {
-            return !ann.points.some(p => {
+            const [x0, y0, x1, y1] = strokeBox(ann);
+            if (pos.x < x0 - threshold || pos.x > x1 + threshold || pos.y < y0 - threshold || pos.y > y1 + threshold) return false;
+            return ann.points.some(p => {
                 const dist = Math.sqrt(Math.pow(p.x - pos.x, 2) + Math.pow(p.y - pos.y, 2));
                 return dist < threshold;
             });
         }
-        return true;
+        return false;
     });
     redraw();
 }
 
 function clearPage() {
     if (!confirm('¿Limpiar página?')) return;
-    State.annotations = State.annotations.filter(a => a.page !== State.page);
+    removeAnnotations(a => a.page === State.page);
     redraw();
 }
 
@@ -438,16 +692,7 @@ async function save() {
     if (!State.docId) return notify('❌ Sin documento');
     
     try {
-        const res = await fetch('/save_annotations', {
-            method: 'POST',
-            headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify({
-                doc_id: State.docId,
-                annotations: State.annotations
-            })
-        });
-        
-        const data = await res.json();
+        const data = await pushChanges();
         notify(data.success ? '✅ Guardado' : '❌ Error');
         if (data.success) loadDocs();
     } catch (error) {
@@ -455,6 +700,79 @@ async function save() {
     }
 }
 
+// Enviar solo lo añadido/borrado desde la última versión guardada
+async function pushChanges(retry = true) {
+    // Lo enviado se aparta antes de la petición: lo que se dibuje o borre mientras
+    // tanto queda en pending* para el siguiente parche (borrar un trazo en vuelo
+    // lo añade a pendingRemove en vez de perderse)
+    const docId = State.docId;
+    const add = State.sendingAdd = State.pendingAdd;
+    const remove = State.sendingRemove = State.pendingRemove;
+    State.pendingAdd = new Map();
+    State.pendingRemove = new Set();
+    
+    let res, data;
+    try {
+        res = await fetch(`/annotations/${docId}/patch`, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({base_version: State.annVersion, add: [...add.values()].map(encodeStroke), remove: [...remove]})
+        });
+        data = await res.json();
+    } catch (error) {
+        restoreSending(docId, add, remove);
+        throw error;
+    }
+    
+    if (!data.success) {
+        restoreSending(docId, add, remove);
+        if (res.status === 409 && retry && State.docId === docId) {
+            // Alguien guardó antes: partir de su versión y volver a aplicar nuestros cambios
+            await rebaseAnnotations();
+            return pushChanges(false);
+        }
+        return data;
+    }
+    
+    if (State.docId === docId) {
+        State.annVersion = data.version;
+        if (State.sendingAdd === add) {
+            State.sendingAdd = new Map();
+            State.sendingRemove = new Set();
+        }
+    }
+    return data;
+}
+
+// Un parche que no se aplicó vuelve a pending*, junto a lo que llegó mientras tanto
+function restoreSending(docId, add, remove) {
+    if (State.docId !== docId) return;
+    if (State.sendingAdd === add) {
+        State.sendingAdd = new Map();
+        State.sendingRemove = new Set();
+    }
+    add.forEach((ann, id) => {
+        // Borrada mientras iba en el parche: nunca llegó al servidor
+        if (State.pendingRemove.has(id)) State.pendingRemove.delete(id);
+        else State.pendingAdd.set(id, ann);
+    });
+    remove.forEach(id => State.pendingRemove.add(id));
+}
+
+async function rebaseAnnotations() {
+    const data = await (await fetch(`/annotations/${State.docId}`)).json();
+    if (!data.success) return;
+    const removed = id => State.pendingRemove.has(id) || State.sendingRemove.has(id);
+    const local = [...State.sendingAdd.values(), ...State.pendingAdd.values()].filter(a => !removed(a.id));
+    const localIds = new Set(local.map(a => a.id));
+    State.annotations = data.annotations
+        .map(decodeStroke)
+        .filter(a => !removed(a.id) && !localIds.has(a.id))
+        .concat(local);
+    State.annVersion = data.version;
+    redraw();
+}
+
 async function shareWhatsApp() {
     if (!State.docId) return notify('❌ Sin documento');
     const text = encodeURIComponent(`📄 ${State.filename}`);
@@ -478,7 +796,7 @@ async function downloadDoc() {
             headers: {'Content-Type': 'application/json'},
             body: JSON.stringify({
                 doc_id: State.docId,
-                annotations: State.annotations
+                annotations: State.annotations.map(encodeStroke)
             })
         });
         
@@ -513,7 +831,12 @@ async function deleteDoc() {
             State.docId = null;
             State.filename = '';
             State.annotations = [];
+            State.pendingAdd.clear();
+            State.pendingRemove.clear();
+            State.sendingAdd = new Map();
+            State.sendingRemove = new Set();
             State.images = [];
+            State.pageCache.clear();
             
             DOM.documentViewer.style.display = 'none';
             DOM.uploadPrompt.style.display = 'flex';
@@ -547,9 +870,10 @@ async function sendChat() {
     
     const typingId = 'typing-' + Date.now();
     addMsg('bot', '...', typingId);
+    const started = performance.now();
     
     try {
-        const res = await fetch('/ask_chatbot', {
+        const res = await fetch('/ask_chatbot/stream', {
             method: 'POST',
             headers: {'Content-Type': 'application/json'},
             body: JSON.stringify({
@@ -558,20 +882,69 @@ async function sendChat() {
             })
         });
         
-        const data = await res.json();
-        document.getElementById(typingId)?.remove();
-        
-        if (data.success) {
-            addMsg('bot', data.answer);
-        } else {
-            addMsg('bot', '❌ Error');
+        const isStream = (res.headers.get('Content-Type') || '').startsWith('text/event-stream');
+        if (!isStream || !res.body) {
+            // 429 (IA ocupada) u otro error: respuesta JSON normal
+            const data = await res.json();
+            document.getElementById(typingId)?.remove();
+            if (res.status === 429) {
+                addMsg('bot', `⏳ La IA está ocupada. Vuelve a preguntar en ${data.retry_after || 10} s.`);
+            } else {
+                addMsg('bot', '❌ Error');
+            }
+            return;
         }
+        
+        // Pintar la respuesta según llegan los trozos (Server-Sent Events)
+        const msgDiv = document.getElementById(typingId);
+        let answer = '';
+        let firstChunk = null;
+        await readEvents(res.body, (event, data) => {
+            if (event === 'message') {
+                if (firstChunk === null) firstChunk = performance.now() - started;
+                answer += data.text;
+                msgDiv.textContent = answer;
+                DOM.chatMessages.scrollTop = DOM.chatMessages.scrollHeight;
+            } else if (event === 'error') {
+                msgDiv.textContent = answer + (data.retry_after
+                    ? `\n⏳ La IA está ocupada. Vuelve a preguntar en ${data.retry_after} s.`
+                    : `\n❌ ${data.error}`);
+            } else if (event === 'done') {
+                console.debug(`Chat: primer trozo ${Math.round(firstChunk ?? 0)} ms (servidor ${data.ttft_ms} ms), ` +
+                              `total ${Math.round(performance.now() - started)} ms (servidor ${data.total_ms} ms)`);
+            }
+        });
+        msgDiv.removeAttribute('id');
     } catch (error) {
         document.getElementById(typingId)?.remove();
         addMsg('bot', '❌ Error');
     }
 }
 
+async function readEvents(body, onEvent) {
+    // Lector mínimo de text/event-stream: bloques separados por una línea en blanco
+    const reader = body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let end;
+        while ((end = buffer.indexOf('\n\n')) !== -1) {
+            const block = buffer.slice(0, end);
+            buffer = buffer.slice(end + 2);
+            let event = 'message';
+            let data = '';
+            for (const line of block.split('\n')) {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            }
+            if (data) onEvent(event, JSON.parse(data));
+        }
+    }
+}
+
 function addMsg(type, text, id = '') {
     const msgDiv = document.createElement('div');
     msgDiv.className = `message ${type}`;
@@ -600,10 +973,16 @@ async function loadDocs() {
         const data = await res.json();
         
         if (data.success && data.documents.length > 0) {
+            // Miniaturas con URL versionada: tras la primera visita salen de la caché del navegador
             DOM.documentsList.innerHTML = data.documents.map(doc => `
-                <div onclick="loadDoc('${doc.id}')" style="cursor:pointer; padding:12px; margin:8px 0; border:1px solid #ddd; border-radius:8px;">
-                    <div style="font-weight:600;">${escapeHtml(doc.filename)}</div>
-                    <div style="font-size:0.75rem; color:#666;">${new Date(doc.date).toLocaleDateString()}</div>
+                <div onclick="loadDoc('${doc.id}')" style="cursor:pointer; padding:12px; margin:8px 0; border:1px solid #ddd; border-radius:8px; display:flex; gap:12px; align-items:center;">
+                    ${doc.thumbnail
+                        ? `<img src="${doc.thumbnail}" loading="lazy" alt="" onerror="this.style.visibility='hidden'" style="width:48px; height:64px; object-fit:cover; object-position:top; border:1px solid #eee; border-radius:4px; flex-shrink:0;">`
+                        : '<div style="width:48px; height:64px; background:#f3f3f3; border-radius:4px; flex-shrink:0;"></div>'}
+                    <div style="min-width:0;">
+                        <div style="font-weight:600;">${escapeHtml(doc.filename)}</div>
+                        <div style="font-size:0.75rem; color:#666;">${new Date(doc.date).toLocaleDateString()}</div>
+                    </div>
                 </div>
             `).join('');
         } else {
@@ -0,0 +1,836 @@
+"""
+Almacenamiento de documentos
+Backend intercambiable: en memoria (un solo proceso) o SQLite indexado,
+compartido entre los workers de gunicorn. Metadata, texto y anotaciones se
+guardan por separado para que listar o consultar el estado sea barato
+
+Los ficheros subidos se guardan una sola vez por contenido (hash SHA-256): el
+original, las páginas renderizadas, el texto y el estado del procesamiento
+forman un "artefacto" compartido con contador de referencias. Cada documento
+apunta a su artefacto y tiene sus propias anotaciones
+"""
+
+import os
+import json
+import uuid
+import hashlib
+import shutil
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+
+import jobs
+
+# Campos con columna propia; el resto de la metadata va en `meta` (JSON)
+DOCUMENT_COLUMNS = ('id', 'original_name', 'file_type', 'file_path', 'upload_date', 'status', 'last_modified', 'artifact_id')
+ARTIFACT_COLUMNS = ('id', 'content_hash', 'file_path', 'file_type', 'refcount')
+PAGE_COLUMNS = ('path', 'width', 'height')
+
+# Cambios de anotaciones acumulados en el diario antes de compactarlos en una instantánea
+ANNOTATION_COMPACT_OPS = int(os.getenv('ANNOTATION_COMPACT_OPS', 100))
+
+
+class VersionConflict(Exception):
+    """El cliente parte de una versión de anotaciones que ya no es la actual"""
+
+    def __init__(self, version):
+        super().__init__(f"Versión obsoleta (actual: {version})")
+        self.version = version
+
+
+def ensure_annotation_ids(annotations, prefix=None):
+    """Asignar id a las anotaciones que no lo tengan (formato antiguo)"""
+    for i, ann in enumerate(annotations):
+        if not ann.get('id'):
+            ann['id'] = f"{prefix}{i}" if prefix else uuid.uuid4().hex
+    return annotations
+
+
+def save_upload(file, folder, chunk_size=1024 * 1024):
+    """Guardar una subida en un temporal calculando su hash. Devuelve (hash, ruta temporal)"""
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.upload')
+    with os.fdopen(fd, 'wb') as out:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest(), tmp_path
+
+
+def new_artifact(content_hash, folder, file_type):
+    """Artefacto nuevo: el original se guarda como `<id>.<ext>` y sus páginas como `<id>_page_<n>.png`"""
+    artifact_id = uuid.uuid4().hex
+    return {'id': artifact_id, 'content_hash': content_hash, 'file_type': file_type,
+            'file_path': os.path.join(folder, f"{artifact_id}.{file_type}")}
+
+
+def artifact_files(artifact):
+    """Ficheros en disco de un artefacto (original, páginas, variantes y carpetas de teselas)"""
+    files = [artifact.get('file_path')]
+    for p in artifact.get('pages', []):
+        files.append(p['path'])
+        files += [v['path'] for v in p.get('variants', [])]
+        if p.get('tiles'):
+            files.append(p['tiles']['path'])
+    return files
+
+
+def remove_files(paths):
+    """Borrar ficheros y carpetas (las de teselas) que existan, sin parar por errores"""
+    for path in set(p for p in paths if p and os.path.exists(p)):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except Exception as e:
+            print(f"Error al borrar archivo: {e}")
+
+
+def apply_annotation_patch(annotations, add=(), remove=()):
+    """Aplicar un cambio: quitar ids de `remove` y añadir (o reemplazar) las de `add`"""
+    by_id = {a['id']: a for a in annotations}
+    for ann_id in remove:
+        by_id.pop(ann_id, None)
+    for ann in add:
+        by_id[ann['id']] = ann
+    return list(by_id.values())
+
+
+class DocumentStore:
+    """Interfaz común de los backends de almacenamiento"""
+
+    def create_document(self, doc):
+        """Crear un documento. `doc` lleva id, original_name, upload_date y metadata libre"""
+        raise NotImplementedError
+
+    def get_document(self, doc_id):
+        """Metadata + lista de páginas (sin texto ni anotaciones). None si no existe"""
+        raise NotImplementedError
+
+    def update_document(self, doc_id, **fields):
+        """Actualizar campos de metadata. Devuelve False si el documento no existe"""
+        raise NotImplementedError
+
+    def delete_document(self, doc_id):
+        """Borrar documento, páginas, texto y anotaciones. Devuelve el documento borrado o None
+
+        Si el documento comparte artefacto con otros, el documento devuelto lleva
+        `shared=True` y sus ficheros no deben borrarse"""
+        raise NotImplementedError
+
+    def list_documents(self, offset=0, limit=50, status=None):
+        """Documentos más recientes primero, con la clave de su miniatura. Devuelve (documentos, total)"""
+        raise NotImplementedError
+
+    def count(self):
+        raise NotImplementedError
+
+    def documents_by_content(self, keys, status=None):
+        """Documentos de cada contenido: {clave: [resúmenes]}. La clave es el artefacto
+        (o el id, en documentos anteriores a los artefactos)"""
+        raise NotImplementedError
+
+    def add_page(self, doc_id, page_num, page):
+        """Registrar una página renderizada ({'path', 'width', 'height'})"""
+        raise NotImplementedError
+
+    def clear_pages(self, doc_id):
+        raise NotImplementedError
+
+    def get_text(self, doc_id):
+        raise NotImplementedError
+
+    def set_text(self, doc_id, text):
+        raise NotImplementedError
+
+    def acquire_artifact(self, artifact):
+        """Sumar una referencia al artefacto con el hash de `artifact`, o crearlo.
+        Devuelve (artefacto, creado)"""
+        raise NotImplementedError
+
+    def get_artifact(self, artifact_id):
+        """Artefacto con su metadata y páginas, o None"""
+        raise NotImplementedError
+
+    def update_artifact(self, artifact_id, **fields):
+        """Actualizar la metadata compartida (estado del procesamiento, informes...)"""
+        raise NotImplementedError
+
+    def list_artifact_processing(self):
+        """Estado del procesamiento de cada artefacto que lo tiene: {artifact_id: processing}"""
+        raise NotImplementedError
+
+    def add_artifact_page(self, artifact_id, page_num, page):
+        raise NotImplementedError
+
+    def clear_artifact_pages(self, artifact_id):
+        raise NotImplementedError
+
+    def set_artifact_text(self, artifact_id, text):
+        raise NotImplementedError
+
+    def get_annotations(self, doc_id):
+        """Lista de anotaciones, o None si el documento no existe"""
+        return self.get_annotation_state(doc_id)[0]
+
+    def get_annotation_state(self, doc_id):
+        """(anotaciones, versión), o (None, None) si el documento no existe"""
+        raise NotImplementedError
+
+    def get_annotation_version(self, doc_id):
+        """Versión de las anotaciones sin leerlas, o None si el documento no existe"""
+        return self.get_annotation_state(doc_id)[1]
+
+    def set_annotations(self, doc_id, annotations):
+        """Reemplazar todas las anotaciones. Devuelve la nueva versión, o None si el documento no existe"""
+        raise NotImplementedError
+
+    def patch_annotations(self, doc_id, base_version, add=(), remove=()):
+        """Aplicar un cambio incremental sobre `base_version`.
+        Devuelve la nueva versión (None si el documento no existe); VersionConflict si es obsoleta"""
+        raise NotImplementedError
+
+
+def _summary(doc):
+    return {k: doc.get(k) for k in ('id', 'original_name', 'file_type', 'upload_date', 'status', 'last_modified', 'thumbnail')}
+
+
+class MemoryStore(DocumentStore):
+    """Todo en un diccionario del proceso (se pierde al reiniciar; solo para desarrollo)"""
+
+    def __init__(self):
+        self._docs = {}
+        self._texts = {}
+        self._annotations = {}
+        self._versions = {}
+        self._artifacts = {}
+        self._by_hash = {}
+        self._lock = threading.RLock()
+
+    def create_document(self, doc):
+        with self._lock:
+            self._docs[doc['id']] = {k: v for k, v in doc.items() if k not in ('text_content', 'annotations')}
+            self._docs[doc['id']]['pages'] = []
+            self._texts[doc['id']] = doc.get('text_content', '')
+            self._annotations[doc['id']] = ensure_annotation_ids(list(doc.get('annotations', [])))
+            self._versions[doc['id']] = 0
+
+    def get_document(self, doc_id):
+        with self._lock:
+            doc = self._docs.get(doc_id)
+            if doc is None:
+                return None
+            artifact = self._artifacts.get(doc.get('artifact_id'))
+            if artifact is not None:
+                return dict(artifact['meta'], **dict(doc, pages=[p for p in artifact['pages'] if p is not None]))
+            return dict(doc, pages=[p for p in doc['pages'] if p is not None])
+
+    def update_document(self, doc_id, **fields):
+        with self._lock:
+            if doc_id not in self._docs:
+                return False
+            self._docs[doc_id].update(fields)
+            return True
+
+    def delete_document(self, doc_id):
+        with self._lock:
+            doc = self.get_document(doc_id)
+            if doc is not None:
+                del self._docs[doc_id]
+                self._texts.pop(doc_id, None)
+                self._annotations.pop(doc_id, None)
+                self._versions.pop(doc_id, None)
+                artifact = self._artifacts.get(doc.get('artifact_id'))
+                if artifact is not None:
+                    artifact['refcount'] -= 1
+                    doc['shared'] = artifact['refcount'] > 0
+                    if not doc['shared']:
+                        del self._artifacts[artifact['id']]
+                        self._by_hash.pop(artifact['content_hash'], None)
+            return doc
+
+    def list_documents(self, offset=0, limit=50, status=None):
+        with self._lock:
+            docs = [_summary(d) for d in self._docs.values() if status is None or d.get('status') == status]
+        docs.sort(key=lambda d: d['upload_date'], reverse=True)
+        return docs[offset:offset + limit], len(docs)
+
+    def count(self):
+        return len(self._docs)
+
+    def documents_by_content(self, keys, status=None):
+        keys = set(keys)
+        found = {}
+        with self._lock:
+            for d in self._docs.values():
+                key = d.get('artifact_id') or d['id']
+                if key in keys and (status is None or d.get('status') == status):
+                    found.setdefault(key, []).append(_summary(d))
+        return found
+
+    def add_page(self, doc_id, page_num, page):
+        with self._lock:
+            doc = self._docs.get(doc_id)
+            if doc is None:
+                return
+            _set_page(doc['pages'], page_num, page)
+
+    def clear_pages(self, doc_id):
+        with self._lock:
+            if doc_id in self._docs:
+                self._docs[doc_id]['pages'] = []
+
+    def get_text(self, doc_id):
+        with self._lock:
+            doc = self._docs.get(doc_id)
+            artifact = self._artifacts.get(doc.get('artifact_id')) if doc else None
+            if artifact is not None:
+                return artifact['text'] or ''
+            return self._texts.get(doc_id)
+
+    def set_text(self, doc_id, text):
+        with self._lock:
+            if doc_id in self._docs:
+                self._texts[doc_id] = text
+
+    def acquire_artifact(self, artifact):
+        with self._lock:
+            existing = self._artifacts.get(self._by_hash.get(artifact['content_hash']))
+            if existing is not None:
+                existing['refcount'] += 1
+                return self.get_artifact(existing['id']), False
+            self._artifacts[artifact['id']] = {
+                **{k: artifact.get(k) for k in ARTIFACT_COLUMNS}, 'refcount': 1, 'meta': {}, 'pages': [], 'text': None
+            }
+            self._by_hash[artifact['content_hash']] = artifact['id']
+            return self.get_artifact(artifact['id']), True
+
+    def get_artifact(self, artifact_id):
+        with self._lock:
+            artifact = self._artifacts.get(artifact_id)
+            if artifact is None:
+                return None
+            return dict(artifact['meta'], **{k: artifact[k] for k in ARTIFACT_COLUMNS},
+                        pages=[p for p in artifact['pages'] if p is not None])
+
+    def update_artifact(self, artifact_id, **fields):
+        with self._lock:
+            if artifact_id not in self._artifacts:
+                return False
+            self._artifacts[artifact_id]['meta'].update(fields)
+            return True
+
+    def list_artifact_processing(self):
+        with self._lock:
+            return {a['id']: dict(a['meta']['processing']) for a in self._artifacts.values()
+                    if a['meta'].get('processing')}
+
+    def add_artifact_page(self, artifact_id, page_num, page):
+        with self._lock:
+            if artifact_id in self._artifacts:
+                _set_page(self._artifacts[artifact_id]['pages'], page_num, page)
+
+    def clear_artifact_pages(self, artifact_id):
+        with self._lock:
+            if artifact_id in self._artifacts:
+                self._artifacts[artifact_id]['pages'] = []
+
+    def set_artifact_text(self, artifact_id, text):
+        with self._lock:
+            if artifact_id in self._artifacts:
+                self._artifacts[artifact_id]['text'] = text
+
+    def get_annotation_state(self, doc_id):
+        with self._lock:
+            if doc_id not in self._docs:
+                return None, None
+            return list(self._annotations[doc_id]), self._versions[doc_id]
+
+    def get_annotation_version(self, doc_id):
+        with self._lock:
+            return self._versions.get(doc_id) if doc_id in self._docs else None
+
+    def set_annotations(self, doc_id, annotations):
+        with self._lock:
+            if doc_id not in self._docs:
+                return None
+            self._annotations[doc_id] = ensure_annotation_ids(list(annotations))
+            self._versions[doc_id] += 1
+            return self._versions[doc_id]
+
+    def patch_annotations(self, doc_id, base_version, add=(), remove=()):
+        with self._lock:
+            if doc_id not in self._docs:
+                return None
+            if self._versions[doc_id] != base_version:
+                raise VersionConflict(self._versions[doc_id])
+            self._annotations[doc_id] = apply_annotation_patch(self._annotations[doc_id], add, remove)
+            self._versions[doc_id] += 1
+            return self._versions[doc_id]
+
+
+def _set_page(pages, page_num, page):
+    pages.extend([None] * (page_num + 1 - len(pages)))
+    pages[page_num] = dict(page)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    original_name TEXT NOT NULL,
+    file_type TEXT,
+    file_path TEXT,
+    upload_date TEXT NOT NULL,
+    status TEXT,
+    last_modified TEXT,
+    artifact_id TEXT,
+    meta TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS idx_documents_date ON documents (upload_date DESC);
+CREATE INDEX IF NOT EXISTS idx_documents_status_date ON documents (status, upload_date DESC);
+CREATE INDEX IF NOT EXISTS idx_documents_artifact ON documents (artifact_id);
+
+-- Contenido subido, uno por hash, compartido por todos los documentos que lo referencian
+CREATE TABLE IF NOT EXISTS artifacts (
+    id TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL UNIQUE,
+    file_path TEXT,
+    file_type TEXT,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    meta TEXT NOT NULL DEFAULT '{}'
+);
+
+CREATE TABLE IF NOT EXISTS artifact_pages (
+    artifact_id TEXT NOT NULL REFERENCES artifacts (id) ON DELETE CASCADE,
+    page_num INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    meta TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (artifact_id, page_num)
+);
+
+CREATE TABLE IF NOT EXISTS artifact_texts (
+    artifact_id TEXT PRIMARY KEY REFERENCES artifacts (id) ON DELETE CASCADE,
+    content TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS pages (
+    doc_id TEXT NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+    page_num INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    meta TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (doc_id, page_num)
+);
+
+CREATE TABLE IF NOT EXISTS texts (
+    doc_id TEXT PRIMARY KEY REFERENCES documents (id) ON DELETE CASCADE,
+    content TEXT NOT NULL
+);
+
+-- Instantánea de anotaciones (en `snapshot_version`) + diario de cambios posteriores
+CREATE TABLE IF NOT EXISTS annotations (
+    doc_id TEXT PRIMARY KEY REFERENCES documents (id) ON DELETE CASCADE,
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    snapshot_version INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS annotation_ops (
+    doc_id TEXT NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+    version INTEGER NOT NULL,
+    op TEXT NOT NULL,
+    PRIMARY KEY (doc_id, version)
+);
+"""
+
+# Columnas añadidas después de la primera versión del esquema
+SCHEMA_UPGRADES = {
+    'documents': [
+        ('artifact_id', 'TEXT'),
+    ],
+    'annotations': [
+        ('version', 'INTEGER NOT NULL DEFAULT 0'),
+        ('snapshot_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ],
+    'artifact_pages': [
+        ('meta', "TEXT NOT NULL DEFAULT '{}'"),
+    ],
+    'pages': [
+        ('meta', "TEXT NOT NULL DEFAULT '{}'"),
+    ],
+}
+
+
+def _page_values(page):
+    """Columnas de una página; lo demás (variantes, teselas) va en `meta`"""
+    meta = {k: v for k, v in page.items() if k not in PAGE_COLUMNS}
+    return page['path'], page['width'], page['height'], json.dumps(meta, ensure_ascii=False)
+
+
+def _page_from_row(row):
+    page = json.loads(row['meta'] or '{}')
+    page.update({k: row[k] for k in PAGE_COLUMNS})
+    return page
+
+
+class SQLiteStore(DocumentStore):
+    """SQLite en modo WAL: varios workers leen y escriben el mismo fichero"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        self._upgrade_schema()
+        self._conn().executescript(SCHEMA)
+
+    def _upgrade_schema(self):
+        conn = self._conn()
+        for table, columns in SCHEMA_UPGRADES.items():
+            existing = {r['name'] for r in conn.execute(f"PRAGMA table_info({table})")}
+            if not existing:
+                continue  # Tabla nueva: la crea SCHEMA
+            for name, definition in columns:
+                if name not in existing:
+                    try:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                    except sqlite3.OperationalError:
+                        pass  # Otro worker la añadió a la vez
+
+    def _conn(self):
+        # Una conexión por hilo (sqlite3 no comparte conexiones entre hilos)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = _Transactions(conn)
+        return self._local.conn
+
+    def create_document(self, doc):
+        columns = {k: doc.get(k) for k in DOCUMENT_COLUMNS}
+        meta = {k: v for k, v in doc.items() if k not in DOCUMENT_COLUMNS and k not in ('pages', 'text_content', 'annotations')}
+        with self._conn() as conn:
+            conn.execute(
+                f"INSERT INTO documents ({', '.join(DOCUMENT_COLUMNS)}, meta) VALUES ({', '.join('?' * len(DOCUMENT_COLUMNS))}, ?)",
+                [columns[k] for k in DOCUMENT_COLUMNS] + [json.dumps(meta, ensure_ascii=False)]
+            )
+            conn.execute("INSERT INTO texts (doc_id, content) VALUES (?, ?)", (doc['id'], doc.get('text_content', '')))
+            conn.execute("INSERT INTO annotations (doc_id, data) VALUES (?, ?)",
+                         (doc['id'], _dumps(ensure_annotation_ids(list(doc.get('annotations', []))))))
+
+    def get_document(self, doc_id):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT d.*, a.meta AS artifact_meta FROM documents d "
+            "LEFT JOIN artifacts a ON a.id = d.artifact_id WHERE d.id = ?", (doc_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        # La metadata compartida (procesamiento, informes) queda debajo de la propia
+        doc = json.loads(row['artifact_meta'] or '{}')
+        doc.update(json.loads(row['meta']))
+        doc.update({k: row[k] for k in DOCUMENT_COLUMNS})
+        doc['pages'] = self._artifact_pages(conn, row['artifact_id']) if row['artifact_id'] else [
+            _page_from_row(p)
+            for p in conn.execute("SELECT path, width, height, meta FROM pages WHERE doc_id = ? ORDER BY page_num", (doc_id,))
+        ]
+        return doc
+
+    def update_document(self, doc_id, **fields):
+        columns = {k: v for k, v in fields.items() if k in DOCUMENT_COLUMNS and k != 'id'}
+        extra = {k: v for k, v in fields.items() if k not in DOCUMENT_COLUMNS}
+        with self._conn() as conn:
+            row = conn.execute("SELECT meta FROM documents WHERE id = ?", (doc_id,)).fetchone()
+            if row is None:
+                return False
+            if extra:
+                meta = json.loads(row['meta'])
+                meta.update(extra)
+                columns['meta'] = json.dumps(meta, ensure_ascii=False)
+            if columns:
+                conn.execute(f"UPDATE documents SET {', '.join(f'{k} = ?' for k in columns)} WHERE id = ?",
+                             list(columns.values()) + [doc_id])
+            return True
+
+    def delete_document(self, doc_id):
+        with self._conn() as conn:
+            doc = self.get_document(doc_id)
+            if doc is not None:
+                conn.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+                if doc.get('artifact_id'):
+                    conn.execute("UPDATE artifacts SET refcount = refcount - 1 WHERE id = ?", (doc['artifact_id'],))
+                    row = conn.execute("SELECT refcount FROM artifacts WHERE id = ?", (doc['artifact_id'],)).fetchone()
+                    doc['shared'] = bool(row and row['refcount'] > 0)
+                    if not doc['shared']:
+                        conn.execute("DELETE FROM artifacts WHERE id = ?", (doc['artifact_id'],))
+        return doc
+
+    def list_documents(self, offset=0, limit=50, status=None):
+        conn = self._conn()
+        where, params = ("WHERE status = ?", [status]) if status is not None else ("", [])
+        total = conn.execute(f"SELECT COUNT(*) FROM documents {where}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT id, original_name, file_type, upload_date, status, last_modified, "
+            f"json_extract(meta, '$.thumbnail') AS thumbnail FROM documents {where} "
+            "ORDER BY upload_date DESC LIMIT ? OFFSET ?", params + [limit, offset]
+        ).fetchall()
+        return [dict(r) for r in rows], total
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def documents_by_content(self, keys, status=None):
+        keys = list(keys)
+        if not keys:
+            return {}
+        marks = ', '.join('?' * len(keys))
+        where, params = (" AND status = ?", [status]) if status is not None else ("", [])
+        rows = self._conn().execute(
+            f"SELECT COALESCE(artifact_id, id) AS content_key, id, original_name, file_type, upload_date, status, last_modified "
+            f"FROM documents WHERE (artifact_id IN ({marks}) OR (artifact_id IS NULL AND id IN ({marks}))){where} "
+            "ORDER BY upload_date DESC", keys + keys + params
+        ).fetchall()
+        found = {}
+        for r in rows:
+            found.setdefault(r['content_key'], []).append({k: r[k] for k in r.keys() if k != 'content_key'})
+        return found
+
+    def add_page(self, doc_id, page_num, page):
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO pages (doc_id, page_num, path, width, height, meta) "
+                         "SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM documents WHERE id = ?)",
+                         (doc_id, page_num, *_page_values(page), doc_id))
+
+    def clear_pages(self, doc_id):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM pages WHERE doc_id = ?", (doc_id,))
+
+    def get_text(self, doc_id):
+        row = self._conn().execute(
+            "SELECT d.artifact_id, t.content AS own, at.content AS shared FROM documents d "
+            "LEFT JOIN texts t ON t.doc_id = d.id "
+            "LEFT JOIN artifact_texts at ON at.artifact_id = d.artifact_id WHERE d.id = ?", (doc_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return (row['shared'] or '') if row['artifact_id'] else row['own']
+
+    def set_text(self, doc_id, text):
+        with self._conn() as conn:
+            conn.execute("UPDATE texts SET content = ? WHERE doc_id = ?", (text, doc_id))
+
+    def acquire_artifact(self, artifact):
+        with self._conn() as conn:
+            row = conn.execute("SELECT id FROM artifacts WHERE content_hash = ?", (artifact['content_hash'],)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE artifacts SET refcount = refcount + 1 WHERE id = ?", (row['id'],))
+                return self.get_artifact(row['id']), False
+            columns = [k for k in ARTIFACT_COLUMNS if k != 'refcount']
+            conn.execute(f"INSERT INTO artifacts ({', '.join(columns)}, refcount) VALUES ({', '.join('?' * len(columns))}, 1)",
+                         [artifact.get(k) for k in columns])
+            return self.get_artifact(artifact['id']), True
+
+    def get_artifact(self, artifact_id):
+        conn = self._conn()
+        row = conn.execute("SELECT * FROM artifacts WHERE id = ?", (artifact_id,)).fetchone()
+        if row is None:
+            return None
+        artifact = json.loads(row['meta'])
+        artifact.update({k: row[k] for k in ARTIFACT_COLUMNS})
+        artifact['pages'] = self._artifact_pages(conn, artifact_id)
+        return artifact
+
+    def _artifact_pages(self, conn, artifact_id):
+        return [
+            _page_from_row(p)
+            for p in conn.execute("SELECT path, width, height, meta FROM artifact_pages WHERE artifact_id = ? ORDER BY page_num",
+                                  (artifact_id,))
+        ]
+
+    def update_artifact(self, artifact_id, **fields):
+        with self._conn() as conn:
+            row = conn.execute("SELECT meta FROM artifacts WHERE id = ?", (artifact_id,)).fetchone()
+            if row is None:
+                return False
+            meta = json.loads(row['meta'])
+            meta.update(fields)
+            conn.execute("UPDATE artifacts SET meta = ? WHERE id = ?", (json.dumps(meta, ensure_ascii=False), artifact_id))
+            return True
+
+    def list_artifact_processing(self):
+        rows = self._conn().execute("SELECT id, meta FROM artifacts WHERE meta LIKE '%\"processing\"%'")
+        found = {}
+        for row in rows:
+            processing = json.loads(row['meta']).get('processing')
+            if processing:
+                found[row['id']] = processing
+        return found
+
+    def add_artifact_page(self, artifact_id, page_num, page):
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO artifact_pages (artifact_id, page_num, path, width, height, meta) "
+                         "SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM artifacts WHERE id = ?)",
+                         (artifact_id, page_num, *_page_values(page), artifact_id))
+
+    def clear_artifact_pages(self, artifact_id):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM artifact_pages WHERE artifact_id = ?", (artifact_id,))
+
+    def set_artifact_text(self, artifact_id, text):
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO artifact_texts (artifact_id, content) "
+                         "SELECT ?, ? WHERE EXISTS (SELECT 1 FROM artifacts WHERE id = ?)", (artifact_id, text, artifact_id))
+
+    def get_annotation_state(self, doc_id):
+        return self._annotation_state(self._conn(), doc_id)
+
+    def get_annotation_version(self, doc_id):
+        row = self._conn().execute("SELECT version FROM annotations WHERE doc_id = ?", (doc_id,)).fetchone()
+        return row['version'] if row else None
+
+    def _annotation_state(self, conn, doc_id):
+        # Una sola consulta: instantánea y diario se leen de forma consistente
+        rows = conn.execute(
+            "SELECT a.data, a.version, o.op FROM annotations a "
+            "LEFT JOIN annotation_ops o ON o.doc_id = a.doc_id AND o.version > a.snapshot_version "
+            "WHERE a.doc_id = ? ORDER BY o.version", (doc_id,)
+        ).fetchall()
+        if not rows:
+            return None, None
+        # Las anotaciones antiguas sin id reciben uno estable (su posición en la instantánea)
+        annotations = ensure_annotation_ids(json.loads(rows[0]['data']), prefix='a')
+        for row in rows:
+            if row['op'] is not None:
+                op = json.loads(row['op'])
+                annotations = apply_annotation_patch(annotations, op.get('add', []), op.get('remove', []))
+        return annotations, rows[0]['version']
+
+    def set_annotations(self, doc_id, annotations):
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE annotations SET data = ?, version = version + 1, snapshot_version = version + 1 WHERE doc_id = ?",
+                (_dumps(ensure_annotation_ids(list(annotations))), doc_id))
+            if cur.rowcount == 0:
+                return None
+            conn.execute("DELETE FROM annotation_ops WHERE doc_id = ?", (doc_id,))
+            return conn.execute("SELECT version FROM annotations WHERE doc_id = ?", (doc_id,)).fetchone()[0]
+
+    def patch_annotations(self, doc_id, base_version, add=(), remove=()):
+        with self._conn() as conn:
+            row = conn.execute("SELECT version, snapshot_version FROM annotations WHERE doc_id = ?", (doc_id,)).fetchone()
+            if row is None:
+                return None
+            if row['version'] != base_version:
+                raise VersionConflict(row['version'])
+            # Solo se escribe el cambio: el coste depende del tamaño del cambio, no del documento
+            version = base_version + 1
+            conn.execute("INSERT INTO annotation_ops (doc_id, version, op) VALUES (?, ?, ?)",
+                         (doc_id, version, _dumps({'add': list(add), 'remove': list(remove)})))
+            conn.execute("UPDATE annotations SET version = ? WHERE doc_id = ?", (version, doc_id))
+            if version - row['snapshot_version'] >= ANNOTATION_COMPACT_OPS:
+                self._compact_annotations(conn, doc_id)
+            return version
+
+    def _compact_annotations(self, conn, doc_id):
+        """Convertir instantánea + diario en una nueva instantánea"""
+        annotations, version = self._annotation_state(conn, doc_id)
+        conn.execute("UPDATE annotations SET data = ?, snapshot_version = ? WHERE doc_id = ?",
+                     (_dumps(annotations), version, doc_id))
+        conn.execute("DELETE FROM annotation_ops WHERE doc_id = ? AND version <= ?", (doc_id, version))
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+class _Transactions:
+    """Conexión en autocommit que abre BEGIN IMMEDIATE al usarse con `with`"""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._depth = 0
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        if self._depth == 0:
+            self._conn.execute('BEGIN IMMEDIATE')
+        self._depth += 1
+        return self._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth == 0:
+            self._conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+
+# ==========================================
+# MIGRACIÓN DE LOS JSON ANTIGUOS
+# ==========================================
+
+def migrate_json_documents(store, folder):
+    """Importar los documentos guardados como `<id>.json` (formato de routes.py)"""
+    if not os.path.isdir(folder):
+        return 0
+    migrated = 0
+    for fn in os.listdir(folder):
+        if not fn.endswith('.json'):
+            continue
+        path = os.path.join(folder, fn)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                d = json.load(f)
+            if not isinstance(d, dict) or 'id' not in d:
+                continue  # Otro JSON de la carpeta (cachés, ajustes): no es un documento
+            if store.get_document(d['id']) is None:
+                sizes = d.get('page_sizes') or []
+                doc = {k: v for k, v in d.items() if k not in ('image_paths', 'page_sizes', 'upload_time')}
+                doc['upload_date'] = d.get('upload_time') or d.get('upload_date') or datetime.now().isoformat()
+                doc['file_path'] = os.path.join(folder, d['id'])
+                doc['last_modified'] = d.get('last_annotated')
+                store.create_document(doc)
+                for i, name in enumerate(d.get('image_paths', [])):
+                    page_path = os.path.join(folder, name)
+                    if i < len(sizes):
+                        w, h = sizes[i]
+                    else:
+                        from PIL import Image
+                        with Image.open(page_path) as img:
+                            w, h = img.size
+                    store.add_page(d['id'], i, {'path': page_path, 'width': w, 'height': h})
+            os.replace(path, path + '.migrated')
+            migrated += 1
+        except FileNotFoundError:
+            pass  # Otro worker lo migró a la vez
+        except Exception as e:
+            print(f"⚠️ No se pudo migrar {fn}: {e}")
+    if migrated:
+        print(f"📦 Migrados {migrated} documentos JSON al almacenamiento")
+    return migrated
+
+
+def open_store(url=None, upload_folder='uploads'):
+    """Abrir el backend indicado en DOCUMENT_STORE: 'memory' o 'sqlite:///ruta.db'"""
+    url = url or os.getenv('DOCUMENT_STORE') or f"sqlite:///{os.path.join(upload_folder, 'documents.db')}"
+    if url == 'memory':
+        store = MemoryStore()
+    elif url.startswith('sqlite:///'):
+        store = SQLiteStore(url[len('sqlite:///'):])
+    else:
+        raise ValueError(f"Backend de almacenamiento desconocido: {url}")
+    migrate_json_documents(store, upload_folder)
+    # Procesamientos que un worker reiniciado o caído dejó a medias
+    jobs.recover(store)
+    return store
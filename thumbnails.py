@@ -0,0 +1,107 @@
+"""
+Miniaturas de la primera página para la lista de documentos
+Se generan en segundo plano (al terminar el procesamiento, al cambiar las
+anotaciones o la primera vez que un documento aparece en la lista sin ella) y se
+guardan en WebP (o JPEG, como las variantes) en una caché en disco acotada. La
+clave es un hash de la página base y de sus anotaciones: la URL cambia cuando
+cambia la miniatura, así que se puede servir con caché de larga duración
+"""
+
+import os
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import pagecache
+import variants
+
+# Ancho de la miniatura y si lleva las anotaciones de la primera página
+THUMBNAIL_WIDTH = int(os.getenv('THUMBNAIL_WIDTH', 240))
+THUMBNAIL_ANNOTATIONS = os.getenv('THUMBNAIL_ANNOTATIONS', '1') != '0'
+THUMBNAIL_CACHE_MB = int(os.getenv('THUMBNAIL_CACHE_MB', 64))
+THUMBNAIL_QUALITY = 60
+# Ancho al que se pintan las anotaciones antes de reducir: los grosores se
+# ven como en el visor, que los dibuja en píxeles de pantalla
+_RENDER_WIDTH = 960
+# Procesamiento sin terminar: la miniatura se genera al acabar
+_PENDING_STATES = ('queued', 'rasterizing', 'ocr')
+
+
+class Thumbnails:
+    """Generación en segundo plano (una a la vez, sin repetir documentos en cola) y lectura"""
+
+    def __init__(self, store, folder, max_mb=None):
+        self.store = store
+        self.cache = pagecache.PageCache(folder, THUMBNAIL_CACHE_MB if max_mb is None else max_mb)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbnails')
+        self._queued = set()
+        self._lock = threading.Lock()
+
+    def _source(self, doc):
+        """Identidad de la primera página y cómo abrirla a un tamaño manejable"""
+        import layout
+        from PIL import Image
+
+        if doc.get('pages'):
+            page = doc['pages'][0]
+            path = variants.pick(page, _RENDER_WIDTH)
+            return pagecache.file_signature(path), lambda: Image.open(path)
+        # Sin páginas imagen (TXT, DOCX): la primera página maquetada del texto
+        font = layout.get_font()
+        lines = next(layout.iter_layout(self.store.get_text(doc['id']) or '', font))
+        return (pagecache.text_signature(lines, layout.PAGE_WIDTH, layout.PAGE_HEIGHT, getattr(font, 'size', None)),
+                lambda: layout.render_page(lines, font))
+
+    def _annotations(self, doc_id):
+        if not THUMBNAIL_ANNOTATIONS:
+            return []
+        return [a for a in self.store.get_annotations(doc_id) or [] if a.get('page', 0) == 0]
+
+    def refresh(self, doc_id):
+        """Generar la miniatura si falta o está desfasada. Devuelve su clave (o None)"""
+        import render
+        from PIL import Image
+
+        doc = self.store.get_document(doc_id)
+        if not doc or (doc.get('processing') or {}).get('state') in _PENDING_STATES:
+            return None
+        base, load = self._source(doc)
+        annotations = self._annotations(doc_id)
+        key = pagecache.page_key(base, annotations, 'thumbnail', THUMBNAIL_WIDTH, THUMBNAIL_QUALITY)
+        if self.cache.get(key, variants.extension()) is None:
+            with metrics.stage('thumbnail'):
+                img = load()
+                if img.width > _RENDER_WIDTH:
+                    img = img.resize((_RENDER_WIDTH, max(1, round(img.height * _RENDER_WIDTH / img.width))), Image.LANCZOS)
+                img = render.render_annotations(img, annotations)
+                img.thumbnail((THUMBNAIL_WIDTH, THUMBNAIL_WIDTH * 4), Image.LANCZOS)
+                out = BytesIO()
+                img.save(out, variants.VARIANT_FORMAT.upper(), quality=THUMBNAIL_QUALITY)
+                self.cache.put(key, out.getvalue(), variants.extension())
+        if doc.get('thumbnail') != key:
+            self.store.update_document(doc_id, thumbnail=key)
+        return key
+
+    def schedule(self, doc_id):
+        """Regenerar en segundo plano; si ya está en cola, esa pasada verá los últimos cambios"""
+        with self._lock:
+            if doc_id in self._queued:
+                return
+            self._queued.add(doc_id)
+        self._executor.submit(self._run, doc_id)
+
+    def _run(self, doc_id):
+        with self._lock:
+            self._queued.discard(doc_id)
+        try:
+            self.refresh(doc_id)
+        except Exception as e:
+            print(f"⚠️ No se pudo generar la miniatura de {doc_id}: {e}")
+
+    def get(self, doc_id, key):
+        """Bytes de la miniatura `key`; si se expulsó de la caché se vuelve a generar"""
+        data = self.cache.get(key, variants.extension())
+        if data is None and self.refresh(doc_id) == key:
+            data = self.cache.get(key, variants.extension())
+        return data
@@ -1,10 +1,13 @@
 import os
+import json
 import time
-import PyPDF2
-from docx import Document
-import pdf2image
-from PIL import Image, ImageDraw, ImageFont
-import google.generativeai as genai
+import threading
+# PyPDF2, docx, pdf2image y google.generativeai se importan al usarse: importarlos
+# aquí costaba casi medio segundo en cada arranque de worker
+import layout
+import ocr
+import render
+import retrieval
 
 ALLOWED_EXTENSIONS = {'pdf', 'docx', 'txt', 'png', 'jpg', 'jpeg'}
 
@@ -13,6 +16,7 @@ def allowed_file(filename):
 
 # --- TEXTO ---
 def extract_text_from_pdf(pdf_path):
+    import PyPDF2
     text = ""
     try:
         with open(pdf_path, 'rb') as file:
@@ -24,6 +28,7 @@ def extract_text_from_pdf(pdf_path):
     return text
 
 def extract_text_from_docx(docx_path):
+    from docx import Document
     text = ""
     try:
         doc = Document(docx_path)
@@ -40,114 +45,61 @@ def extract_text_from_txt(txt_path):
 
 # --- IMÁGENES Y PAGINACIÓN ---
 def pdf_to_images(pdf_path):
+    import pdf2image
     try:
         return pdf2image.convert_from_path(pdf_path)
     except:
         return []
 
-def wrap_text(text, font, max_width, draw):
-    lines = []
-    text = text.replace('\r\n', '\n').replace('\r', '\n')
-    for paragraph in text.split('\n'):
-        if not paragraph:
-            lines.append('')
-            continue
-        words = paragraph.split(' ')
-        current_line = []
-        for word in words:
-            test_line = ' '.join(current_line + [word])
-            bbox = draw.textbbox((0, 0), test_line, font=font)
-            if bbox[2] - bbox[0] <= max_width:
-                current_line.append(word)
-            else:
-                lines.append(' '.join(current_line))
-                current_line = [word]
-        if current_line:
-            lines.append(' '.join(current_line))
-    return lines
-
-def _render_page(lines, w, h, font, margin, lh):
-    img = Image.new('RGB', (w, h), 'white')
-    draw = ImageDraw.Draw(img)
-    y = margin
-    for line in lines:
-        draw.text((margin, y), line, font=font, fill="black")
-        y += lh
-    return img
+def pdf_page_count(pdf_path):
+    import pdf2image
+    try:
+        return pdf2image.pdfinfo_from_path(pdf_path)['Pages']
+    except:
+        import PyPDF2
+        try:
+            with open(pdf_path, 'rb') as file: return len(PyPDF2.PdfReader(file).pages)
+        except: return 0
 
-def create_pages_from_text(text_content):
-    width, height = 1240, 1754 
-    margin = 60
-    line_height = 35 
-    
-    img_temp = Image.new('RGB', (100, 100))
-    draw_temp = ImageDraw.Draw(img_temp)
-    try: font = ImageFont.truetype("arial.ttf", 24)
-    except: font = ImageFont.load_default()
+def iter_pdf_images(pdf_path):
+    """Rasterizar por rangos de páginas en paralelo, publicando cada una en cuanto está lista"""
+    try:
+        for _, img in ocr.rasterize_pdf(pdf_path, pdf_page_count(pdf_path)):
+            yield img
+    except Exception as e:
+        print(f"⚠️ No se pudo rasterizar: {e}")
 
-    all_lines = wrap_text(text_content, font, width - (margin * 2), draw_temp)
-    
-    pages = []
-    current_lines = []
-    y_curr = margin
-    
-    for line in all_lines:
-        current_lines.append(line)
-        y_curr += line_height
-        if y_curr > height - margin:
-            pages.append(_render_page(current_lines, width, height, font, margin, line_height))
-            current_lines = []
-            y_curr = margin
-            
-    if current_lines or not pages:
-        pages.append(_render_page(current_lines, width, height, font, margin, line_height))
-        
-    return pages
+def wrap_text(text, font, max_width, draw=None):
+    """Líneas de `text` que caben en `max_width` (ver layout.wrap_lines)"""
+    return [line for line, _, _ in layout.wrap_lines(text, font, max_width)]
+
+def iter_pages_from_text(text_content):
+    """Páginas (imágenes) del texto, generadas de una en una; la maquetación se calcula sin pintar"""
+    return layout.iter_rendered_pages(text_content)
+
+def create_pages_from_text(text_content):
+    return list(iter_pages_from_text(text_content))
 
 def create_image_from_text(text_content):
     pages = create_pages_from_text(text_content)
     return pages[0] if pages else None
 
 def process_annotations_on_image(img, annotations, page_index):
-    img = img.convert('RGBA')
-    draw = ImageDraw.Draw(img, 'RGBA')
-    width, height = img.size
-    
-    page_anns = [a for a in annotations if a.get('page', 0) == page_index]
-    
-    for ann in page_anns:
-        color_hex = ann.get('color', '#000000')
-        try: color_rgb = tuple(int(color_hex.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
-        except: color_rgb = (0,0,0)
-        
-        size = int(ann.get('size', 3)) * 2
-        
-        if ann['type'] == 'text':
-            x, y = int(ann['x'] * width), int(ann['y'] * height)
-            try: font_ann = ImageFont.truetype("arial.ttf", size * 10)
-            except: font_ann = ImageFont.load_default()
-            draw.text((x, y), ann['text'], fill=color_rgb + (255,), font=font_ann)
-            
-        elif 'points' in ann:
-            points = ann['points']
-            if len(points) > 1:
-                abs_points = [(p['x'] * width, p['y'] * height) for p in points]
-                if ann['type'] == 'highlighter':
-                    overlay = Image.new('RGBA', img.size, (0,0,0,0))
-                    d_over = ImageDraw.Draw(overlay)
-                    d_over.line(abs_points, fill=color_rgb + (40,), width=size * 3)
-                    img = Image.alpha_composite(img, overlay)
-                    draw = ImageDraw.Draw(img, 'RGBA')
-                else:
-                    op = 255 if ann['type'] == 'pen' else 200
-                    draw.line(abs_points, fill=color_rgb + (op,), width=size, joint='curve')
-    
-    return img.convert('RGB')
+    """Pintar sobre `img` las anotaciones de la página `page_index` (ver render.render_annotations)"""
+    return render.render_annotations(img, [a for a in annotations if a.get('page', 0) == page_index])
 
 # --- IA INTELIGENTE (VERSIÓN FLASH PRIORITARIA) ---
 
+# El modelo elegido se guarda en disco y se reutiliza durante GEMINI_MODEL_CACHE_TTL
+# segundos: los workers arrancan sin esperar a la red. GEMINI_MODEL se salta la búsqueda
+GEMINI_MODEL_CACHE_TTL = int(os.getenv('GEMINI_MODEL_CACHE_TTL', 24 * 3600))
+# Lo que espera la primera pregunta a la búsqueda si no hay nada en caché
+GEMINI_DISCOVERY_TIMEOUT = float(os.getenv('GEMINI_DISCOVERY_TIMEOUT', 15))
+FALLBACK_MODEL = 'gemini-1.5-flash'
+
 def get_working_model():
-    """Busca en tu cuenta qué modelos están disponibles y prioriza FLASH"""
+    """Busca en tu cuenta qué modelos están disponibles y prioriza FLASH (None si no se pudo listar)"""
+    import google.generativeai as genai
     try:
         print("🔍 Buscando modelos disponibles...")
         available_models = []
@@ -175,45 +127,84 @@ def get_working_model():
     except Exception as e:
         print(f"⚠️ Error listando modelos: {e}")
     
-    return 'gemini-1.5-flash' # Fallback duro si falla el listado
+    return None
+
+class GeminiModel:
+    """Gemini con generate_content(prompt).text, sin bloquear el arranque
+
+    El nombre del modelo sale de GEMINI_MODEL, de la caché en disco o de
+    get_working_model() en un hilo aparte. Con la caché caducada se sigue usando
+    el nombre guardado mientras se renueva; sin caché, la primera pregunta espera
+    a la búsqueda (como mucho GEMINI_DISCOVERY_TIMEOUT s, después FALLBACK_MODEL)
+    """
+
+    def __init__(self, api_key, cache_path):
+        self.api_key = api_key
+        self.cache_path = cache_path
+        self.model_name = os.getenv('GEMINI_MODEL') or None
+        self._model = None
+        self._built = None  # nombre con el que se creó _model
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        fresh = False
+        if not self.model_name:
+            self.model_name, fresh = self._read_cache()
+        if self.model_name:
+            self._ready.set()
+        if not fresh and not os.getenv('GEMINI_MODEL'):
+            threading.Thread(target=self._discover, daemon=True).start()
+
+    def _read_cache(self):
+        """(modelo guardado, si sigue vigente), o (None, False)"""
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            return cached['model'], time.time() - cached['time'] < GEMINI_MODEL_CACHE_TTL
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, False
 
-def configure_gemini():
+    def _write_cache(self, model_name):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+            tmp = f"{self.cache_path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump({'model': model_name, 'time': time.time()}, f)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            print(f"⚠️ No se pudo guardar el modelo elegido: {e}")
+
+    def _genai(self):
+        import google.generativeai as genai
+        genai.configure(api_key=self.api_key)
+        return genai
+
+    def _discover(self):
+        try:
+            self._genai()
+            model_name = get_working_model()
+            if model_name:
+                self._write_cache(model_name)
+                self.model_name = model_name
+            print(f"✅ Usando modelo IA SELECCIONADO: {self.model_name or FALLBACK_MODEL}")
+        finally:
+            self._ready.set()
+
+    def _get_model(self):
+        self._ready.wait(GEMINI_DISCOVERY_TIMEOUT)
+        model_name = self.model_name or FALLBACK_MODEL
+        with self._lock:
+            if self._built != model_name:
+                self._model = self._genai().GenerativeModel(model_name)
+                self._built = model_name
+            return self._model
+
+    def generate_content(self, *args, **kwargs):
+        return self._get_model().generate_content(*args, **kwargs)
+
+def configure_gemini(cache_path='uploads/cache/gemini_model.json'):
+    # Modelo local sin API (desarrollo y pruebas)
+    if os.getenv('CHAT_MODEL') == 'stub':
+        return retrieval.StubModel()
     api_key = os.getenv('GEMINI_API_KEY')
     if not api_key: return None
-    genai.configure(api_key=api_key)
-    
-    model_name = get_working_model()
-    print(f"✅ Usando modelo IA SELECCIONADO: {model_name}")
-    return genai.GenerativeModel(model_name)
-
-def ask_gemini(model, text, question, history=[]):
-    if not model: return "IA no configurada."
-    
-    # Recortar texto para no saturar tokens
-    prompt = f"Doc:\n{text[:30000]}\n\nPregunta: {question}\nResponde en español."
-    
-    if history:
-        h_str = "\n".join([f"U: {h['question']} A: {h['answer']}" for h in history[-5:]])
-        prompt = f"Historial:\n{h_str}\n\n{prompt}"
-    
-    # SISTEMA DE REINTENTOS PARA EVITAR ERROR 429
-    max_retries = 3
-    wait_time = 5 # Aumentado a 5 segundos iniciales
-    
-    for attempt in range(max_retries):
-        try:
-            return model.generate_content(prompt).text
-        except Exception as e:
-            error_str = str(e)
-            print(f"⚠️ Intento {attempt+1} fallido: {error_str}") # Log para ver qué pasa
-            
-            if "429" in error_str or "quota" in error_str.lower() or "503" in error_str:
-                if attempt < max_retries - 1: # Si no es el último intento
-                    print(f"⏳ IA ocupada (429/503), esperando {wait_time}s...")
-                    time.sleep(wait_time)
-                    wait_time *= 2 # Esperar más la próxima vez (5, 10, 20)
-                    continue 
-            
-            return f"Error IA: {error_str}"
-            
-    return "La IA está muy ocupada en este momento. Por favor, espera 1 minuto y vuelve a intentar."
\ No newline at end of file
+    return GeminiModel(api_key, cache_path)